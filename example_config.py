@@ -131,7 +131,9 @@ install_dirs = [util.expand('~/.nexuiz/data/')]
 #
 #   Use 1 for fully sequential builds.
 #
-#   If set to None, the amount of CPUs (cores) multiplied by 5 is used.
+#   If set to None, the sum of qcc_jobs, package_jobs and io_jobs is used.
+#   Tasks that have to wait for other tasks don't occupy a thread while they
+#   wait, so there's no need for more threads than that.
 #
 #   The value below is the default.
 #
@@ -139,6 +141,117 @@ install_dirs = [util.expand('~/.nexuiz/data/')]
 #threads = None
 
 
+#
+#   qcc_jobs
+#
+#   Maximum number of QC compilers to run at the same time.
+#
+#   If set to None, the amount of CPUs (cores) is used, but no more than one
+#   per 512 MiB of available memory.
+#
+#   The value below is the default.
+#
+
+#qcc_jobs = None
+
+
+#
+#   compress_jobs
+#
+#   Number of worker processes used to compress pk3s.
+#   Members of a single package are compressed in parallel.
+#
+#   Compression and image conversion (see image_jobs) share one pool of
+#   worker processes, as big as the larger of the two settings, but neither
+#   uses more of them at a time than its own setting allows. The pool is only
+#   started once something actually needs compressing or converting.
+#
+#   Use 1 to compress in the build threads instead.
+#
+#   If set to None, the amount of CPUs (cores) is used, but no more than one
+#   per 64 MiB of available memory.
+#
+#   The value below is the default.
+#
+
+#compress_jobs = None
+
+
+#
+#   package_jobs
+#
+#   Maximum number of packages (pk3s) to build at the same time. Independent
+#   of compress_jobs, so compressing in the build threads doesn't also build
+#   the packages one by one.
+#
+#   If set to None, the amount of CPUs (cores) is used, but no more than one
+#   per 64 MiB of available memory.
+#
+#   The value below is the default.
+#
+
+#package_jobs = None
+
+
+#
+#   io_jobs
+#
+#   Maximum number of tasks that mostly hash or copy files to run at the
+#   same time.
+#
+#   If set to None, twice the amount of CPUs (cores) is used.
+#
+#   The value below is the default.
+#
+
+#io_jobs = None
+
+
+#
+#   pk3_compression
+#
+#   How files are compressed inside the pk3s. A list of (pattern, mode)
+#   pairs, the first pattern matching a file's path in the pk3 wins.
+#   Patterns are case-insensitive. Modes are:
+#
+#       * 'store': no compression, for already compressed media.
+#       * 'deflate': deflate at the default level.
+#       * 0-9: deflate at this level.
+#       * 'auto': deflate, but store if that saves less than
+#          pk3_store_threshold (a fraction of the file size).
+#
+#   Files not matched by any pattern are deflated.
+#
+#   The values below are the defaults.
+#
+
+#pk3_compression = [
+#    ('*.jpg', 'store'),
+#    ('*.jpeg', 'store'),
+#    ('*.png', 'store'),
+#    ('*.ogg', 'store'),
+#    ('*.pk3', 'store'),
+#    ('*', 'auto'),
+#]
+
+#pk3_store_threshold = 0.05
+
+
+#
+#   pk3_incremental
+#
+#   When a package has to be rebuilt, copy the already compressed data of
+#   unchanged files over from its most recent version in cache_dir,
+#   instead of compressing everything again.
+#
+#   Has no effect without a cache_dir, or when rebuilding with -r.
+#
+#   The value below is the default.
+#
+
+#pk3_incremental = True
+
+
 #
 #   comment
 #
@@ -268,6 +381,52 @@ qcc_flags = '-O2'
 cache_dir = 'cache'
 
 
+#
+#   cache_max_size, cache_max_age
+#
+#   Keep cache_dir within a budget. After every build, the least recently
+#   used QC modules, pk3s and converted textures are removed until the cache
+#   is smaller than cache_max_size, and those not used for more than
+#   cache_max_age days are removed regardless. Whatever the build just used
+#   is always kept.
+#
+#   cache_max_size is in bytes, or a string like '500M' or '10G'.
+#
+#   'rmbuild cache stats|gc|verify|clear' shows the hit rates and how much
+#   would be reclaimed, and cleans up the cache by hand.
+#
+#   The default is None for both (no limit).
+#
+
+#cache_max_size = '10G'
+#cache_max_age = 30
+
+
+#
+#   remote_cache, remote_cache_push, remote_cache_timeout
+#
+#   Share the QC modules, pk3s and converted textures in cache_dir with
+#   other machines. Whatever isn't in cache_dir is looked up in the remote
+#   cache and downloaded into cache_dir if it's there. With remote_cache_push,
+#   whatever this build has to make itself is uploaded in the background.
+#   A single CI build can warm the cache for everyone that way.
+#
+#   remote_cache is either an http(s):// URL of a server started with
+#   'rmbuild cache-server <dir>', or a directory (e.g. on a network share).
+#   The server has no authentication; run it with --read-only for clients
+#   that shouldn't upload, or set remote_cache_push = False on them.
+#
+#   If the remote cache is unreachable or fails, the build goes on without
+#   it. remote_cache_timeout is in seconds.
+#
+#   Requires cache_dir. The default is None (no remote cache).
+#
+
+#remote_cache = 'http://buildcache.example.com:8737/'
+#remote_cache_push = True
+#remote_cache_timeout = 10
+
+
 #
 #   link_pk3dirs
 #
@@ -285,6 +444,24 @@ cache_dir = 'cache'
 #link_pk3dirs = False
 
 
+#
+#   use_hardlinks
+#
+#   Files restored from cache_dir and installed to install_dirs are
+#   reflinked where the filesystem supports it (btrfs, XFS), which is
+#   instant and safe, and copied otherwise.
+#
+#   With this enabled, they're hard-linked instead of copied when reflinks
+#   aren't available and both ends are on the same filesystem. That is
+#   nearly as fast, but the installed files are then the very same files
+#   as the ones in the cache: never edit them in place.
+#
+#   The value below is the default.
+#
+
+#use_hardlinks = False
+
+
 #
 #   compress_gfx
 #
@@ -312,6 +489,108 @@ cache_dir = 'cache'
 #compress_gfx_quality = 85
 
 
+#
+#   image_jobs
+#
+#   Number of worker processes used to convert textures to JPEG.
+#   They are shared by all packages.
+#
+#   Use 1 to convert in the build threads instead.
+#
+#   If set to None, the amount of CPUs (cores) is used, but no more than one
+#   per 256 MiB of available memory.
+#
+#   The value below is the default.
+#
+
+#image_jobs = None
+
+
+#
+#   compress_gfx_min_saving
+#
+#   Only convert a texture if the JPEG (plus the alpha JPEG, if needed)
+#   is smaller than the original by at least this fraction of its size.
+#   Textures that don't pass are shipped as they are.
+#
+#   The value below is the default (keep only textures the conversion
+#   would make bigger).
+#
+
+#compress_gfx_min_saving = 0.0
+
+
+#
+#   image_report
+#
+#   Path to a JSON file describing what was done to each texture and why:
+#   sizes, alpha channel statistics, source decode and conversion times.
+#
+#   By default it's written to reports/images.json inside cache_dir,
+#   or not at all if cache_dir is not set.
+#
+#   Installing numpy speeds up the alpha channel analysis.
+#
+
+#image_report = None
+
+
+#
+#   build_report
+#
+#   Path to a JSON file with statistics about the build: wall and CPU time
+#   of each stage, cache hit rates, bytes hashed, compressed and copied,
+#   the size and compression ratio of every pk3 and how long each QC module
+#   took to compile. Also passed to hook_post_build as 'report'.
+#
+#   By default it's written next to output_dir, as <output_dir>-report.json.
+#
+
+#build_report = None
+
+
+#
+#   profile, profile_memory, profile_dir
+#
+#   Profile every build stage and task separately. Same as the --profile,
+#   --profile-memory and --profile-dir command line options.
+#
+#   With profile, each one gets a <name>.pstats file from cProfile; open it
+#   with 'python -m pstats' or snakeviz. With profile_memory, each one gets
+#   a <name>.memory.txt listing the allocation sites that grew the most
+#   while it ran (tracemalloc, which slows the build down a lot).
+#
+#   By default they're written to <output_dir>-profile. The .pstats and
+#   .memory.txt files from earlier runs are removed first, nothing else is.
+#
+
+#profile = False
+#profile_memory = False
+#profile_dir = None
+
+
+#
+#   hash_method
+#
+#   How package and QC source digests are computed.
+#
+#   Possible values are:
+#
+#       * 'legacy': a single hash over every file, in the order the
+#          filesystem lists them.
+#       * 'merkle': files are hashed individually (in parallel) and the
+#          results are combined per directory in sorted order. Digests are
+#          the same on every machine, and only changed files are re-read
+#          if cache_dir is set.
+#
+#   Switching methods invalidates all cached packages and QC modules.
+#
+#   The value below is the default.
+#
+
+#hash_method = 'legacy'
+
+
 #
 #   suffix
 #
@@ -356,12 +635,14 @@ cache_dir = 'cache'
 #   You can customize the distribution in build_info.output_dir,
 #   the changes will be reflected in all installation directories.
 #
-#   No additional arguments.
+#   Additional arguments:
+#
+#       * report: the build report as a dict, see build_report.
 #
 
 """
-def hook_post_build(build_info, log, **rest):
-    log.info("Yay! Finished building at %r", str(build_info.output_dir))
+def hook_post_build(build_info, log, report, **rest):
+    log.info("Yay! Finished building at %r in %.1f seconds", str(build_info.output_dir), report['totals']['wall'])
 """
 
 
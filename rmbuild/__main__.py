@@ -1,4 +1,4 @@
 
 import sys
 from . import main
-main.main(sys.argv)
+sys.exit(main.main(sys.argv))
@@ -0,0 +1,412 @@
+import os
+import pathlib
+import struct
+import zipfile
+import zlib
+
+from concurrent import futures
+
+from .compat import *
+
+from . import util
+from . import report
+
+log = util.logger(__name__)
+
+CHUNK_SIZE = 1 << 20
+
+# Members are handed to the worker processes in batches of roughly this size,
+# so that small files don't drown in IPC overhead.
+BATCH_SIZE = 8 << 20
+BATCH_FILES = 256
+
+# Compressed data larger than this is passed back through a temporary file
+# instead of being pickled.
+SPILL_SIZE = 1 << 20
+
+# How often close() checks whether to abort while waiting for the workers
+POLL_INTERVAL = 0.25
+
+# First match wins. Patterns are matched case-insensitively against the name
+# of the member inside the archive.
+DEFAULT_COMPRESSION = [
+    ('*.jpg', 'store'),
+    ('*.jpeg', 'store'),
+    ('*.png', 'store'),
+    ('*.ogg', 'store'),
+    ('*.pk3', 'store'),
+    ('*', 'auto'),
+]
+
+DEFAULT_STORE_THRESHOLD = 0.05
+
+
+class CompressionPolicy(object):
+    # Decides how each member is stored. Every rule maps a pattern to one of:
+    #   'store'   - no compression
+    #   'deflate' - deflate at the default level
+    #   0-9       - deflate at this level
+    #   'auto'    - deflate, but store if that saves less than the threshold
+
+    def __init__(self, rules=None, store_threshold=DEFAULT_STORE_THRESHOLD):
+        if rules is None:
+            rules = DEFAULT_COMPRESSION
+
+        self.rules = [(pattern.lower(), self.parse(mode)) for pattern, mode in rules]
+        self.store_threshold = store_threshold
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.rules)
+
+    @staticmethod
+    def parse(mode):
+        # returns (level, auto); level is None for stored members
+        if mode == 'store':
+            return (None, False)
+        if mode == 'deflate':
+            return (zlib.Z_DEFAULT_COMPRESSION, False)
+        if mode == 'auto':
+            return (zlib.Z_DEFAULT_COMPRESSION, True)
+        if isinstance(mode, int) and 0 <= mode <= 9:
+            return (mode, False)
+
+        raise ValueError(
+            "Compression mode must be one of: 'store', 'deflate', 'auto', or a level in the 0-9 range; "
+            "got %r instead" % (mode,)
+        )
+
+    def resolve(self, name):
+        path = pathlib.PurePosixPath(name.lower())
+
+        for pattern, mode in self.rules:
+            if path.match(pattern):
+                return mode
+
+        return (zlib.Z_DEFAULT_COMPRESSION, False)
+
+
+def crc_file(path):
+    crc = 0
+    file_size = 0
+
+    with open(path, 'rb') as f:
+        for chunk in util.read_in_chunks(f, CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+
+    return crc, file_size
+
+
+def store_file(index, path):
+    crc, file_size = crc_file(path)
+
+    # the data is copied straight from the source file later
+    return (index, zipfile.ZIP_STORED, crc, file_size, file_size, None, path, False)
+
+
+def deflate_file(index, path, level, store_threshold, spill_dir):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    file_size = 0
+    compress_size = 0
+    data = []
+    spill = None
+
+    with open(path, 'rb') as f:
+        for chunk in util.read_in_chunks(f, CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            data.append(compressor.compress(chunk))
+
+            if spill is None and file_size > SPILL_SIZE:
+                spill = open(os.path.join(spill_dir, '%i.deflate' % index), 'wb')
+
+            if spill is not None:
+                for piece in data:
+                    compress_size += len(piece)
+                    spill.write(piece)
+                data = []
+
+    data.append(compressor.flush())
+
+    if spill is not None:
+        for piece in data:
+            compress_size += len(piece)
+            spill.write(piece)
+        spill.close()
+        data = None
+    else:
+        data = b''.join(data)
+        compress_size = len(data)
+
+    if store_threshold is not None and compress_size > file_size * (1 - store_threshold):
+        if spill is not None:
+            os.unlink(spill.name)
+        return (index, zipfile.ZIP_STORED, crc, file_size, file_size, None, path, False)
+
+    if spill is not None:
+        return (index, zipfile.ZIP_DEFLATED, crc, file_size, compress_size, None, spill.name, True)
+
+    return (index, zipfile.ZIP_DEFLATED, crc, file_size, compress_size, data, None, False)
+
+
+def compress_files(jobs, spill_dir):
+    results = []
+
+    for index, path, level, store_threshold, reuse_crc in jobs:
+        if reuse_crc is not None:
+            crc, file_size = crc_file(path)
+
+            if crc == reuse_crc:
+                # compress_type None means "copy it from the previous archive"
+                results.append((index, None, crc, file_size, None, None, None, False))
+                continue
+
+        if level is None:
+            results.append(store_file(index, path))
+        else:
+            results.append(deflate_file(index, path, level, store_threshold, spill_dir))
+
+    return results
+
+
+class Pk3Writer(object):
+    # A zipfile.ZipFile look-alike that defers all writes until close(), then
+    # compresses the file members concurrently and writes everything in the order
+    # it was added, so the archive layout doesn't depend on scheduling.
+    # Each member is compressed according to the CompressionPolicy.
+    #
+    # If a previous version of the archive is given, members whose name, size,
+    # timestamp and CRC haven't changed are copied over without recompressing.
+
+    def __init__(self, path, pool=None, policy=None, spill_dir=None, abort=None, previous=None):
+        self.path = path
+        self.pool = pool
+        self.previous = previous
+        self.reused = 0
+
+        if policy is None:
+            policy = CompressionPolicy()
+
+        self.policy = policy
+        self.spill_dir = str(spill_dir or util.temp_directory())
+        self.abort = abort
+        self.members = []
+        self.zip = zipfile.ZipFile(str(path), 'w', zipfile.ZIP_DEFLATED)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self.path))
+
+    def writestr(self, info, data):
+        self.members.append(('str', info, data))
+
+    def write(self, filename, arcname):
+        filename = str(filename)
+
+        if os.path.isdir(filename):
+            self.members.append(('dir', filename, arcname))
+        else:
+            self.members.append(('file', zipfile.ZipInfo.from_file(filename, arcname), filename))
+
+    def _check_abort(self):
+        if self.abort is not None:
+            self.abort()
+
+    def _submit(self, jobs):
+        if self.pool is None:
+            future = futures.Future()
+            future.set_result(compress_files(jobs, self.spill_dir))
+            return future
+
+        return self.pool.submit(compress_files, jobs, self.spill_dir)
+
+    def _reusable(self, info, level, auto, previous):
+        try:
+            old = previous.getinfo(info.filename)
+        except KeyError:
+            return None
+
+        # zip timestamps only have a 2 second resolution
+        date_time = info.date_time[:5] + (info.date_time[5] // 2 * 2,)
+
+        if old.file_size != info.file_size or old.date_time != date_time or old.flag_bits & 0x01:
+            return None
+
+        if level is None:
+            types = (zipfile.ZIP_STORED,)
+        elif auto:
+            types = (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+        else:
+            types = (zipfile.ZIP_DEFLATED,)
+
+        if old.compress_type not in types:
+            return None
+
+        return old.CRC
+
+    def _compress(self, previous, batches):
+        # fills batches with {index: future}, where the future resolves to the whole batch
+        jobs = []
+        batch_size = 0
+
+        def flush():
+            future = self._submit(jobs)
+            for job in jobs:
+                batches[job[0]] = future
+
+        for index, (kind, info, arg) in enumerate(self.members):
+            if kind != 'file':
+                continue
+
+            level, auto = self.policy.resolve(info.filename)
+            reuse_crc = None
+
+            if previous is not None:
+                reuse_crc = self._reusable(info, level, auto, previous)
+
+            jobs.append((index, arg, level, self.policy.store_threshold if auto else None, reuse_crc))
+            batch_size += info.file_size
+
+            if batch_size >= BATCH_SIZE or len(jobs) >= BATCH_FILES:
+                self._check_abort()
+                flush()
+                jobs = []
+                batch_size = 0
+
+        if jobs:
+            flush()
+
+    def _copy_previous(self, info, previous):
+        old = previous.getinfo(info.filename)
+        fp = previous.fp
+
+        fp.seek(old.header_offset)
+        fheader = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+        fp.seek(
+            fheader[zipfile._FH_FILENAME_LENGTH] +
+            fheader[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR
+        )
+
+        def read():
+            remaining = old.compress_size
+
+            while remaining > 0:
+                chunk = fp.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    raise zipfile.BadZipFile("Truncated member %r in %r" % (old.filename, previous.filename))
+                remaining -= len(chunk)
+                yield chunk
+
+        self.reused += 1
+        return (old.compress_type, old.CRC, old.file_size, old.compress_size, read(), None, False)
+
+    def _write_raw(self, info, compress_type, crc, file_size, compress_size, data, source, temporary):
+        # Mirrors ZipFile._open_to_write() and _ZipWriteFile.close() for data
+        # that has already been compressed (or is to be stored as is).
+        zf = self.zip
+
+        info.compress_type = compress_type
+        info.flag_bits = 0x00
+        info.CRC = crc
+        info.file_size = file_size
+        info.compress_size = compress_size
+
+        if not info.external_attr:
+            info.external_attr = 0o600 << 16
+
+        zip64 = file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT
+
+        zf.fp.seek(zf.start_dir)
+        info.header_offset = zf.fp.tell()
+        zf._writecheck(info)
+        zf._didModify = True
+        zf.fp.write(info.FileHeader(zip64))
+
+        if source is None:
+            if isinstance(data, bytes):
+                zf.fp.write(data)
+            else:
+                for chunk in data:
+                    zf.fp.write(chunk)
+        else:
+            with open(source, 'rb') as f:
+                for chunk in util.read_in_chunks(f, CHUNK_SIZE):
+                    zf.fp.write(chunk)
+
+            if temporary:
+                os.unlink(source)
+
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(info)
+        zf.NameToInfo[info.filename] = info
+
+    def _open_previous(self):
+        if self.previous is None:
+            return None
+
+        try:
+            return zipfile.ZipFile(str(self.previous), 'r')
+        except (OSError, zipfile.BadZipFile) as e:
+            log.warning('Not reusing members from %r: %s', str(self.previous), e)
+            return None
+
+    def _wait(self, future):
+        if self.abort is not None:
+            while not futures.wait([future], timeout=POLL_INTERVAL).done:
+                self._check_abort()
+
+        return future.result()
+
+    def close(self):
+        # If anything goes wrong, including abort() raising, the batches that
+        # haven't started are cancelled and the incomplete archive is removed.
+        previous = self._open_previous()
+        batches = {}
+        complete = False
+
+        try:
+            self._compress(previous, batches)
+            results = {}
+
+            for index, (kind, info, arg) in enumerate(self.members):
+                self._check_abort()
+
+                if kind == 'str':
+                    self.zip.writestr(info, arg)
+                elif kind == 'dir':
+                    self.zip.write(info, arg)
+                else:
+                    if index not in results:
+                        for result in self._wait(batches[index]):
+                            results[result[0]] = result[1:]
+
+                    result = results.pop(index)
+
+                    if result[0] is None:
+                        result = self._copy_previous(info, previous)
+                        report.count('bytes_reused', result[2])
+                    else:
+                        report.count('bytes_compressed_in', result[2])
+                        report.count('bytes_compressed_out', result[3])
+
+                    self._write_raw(info, *result)
+
+            complete = True
+        finally:
+            if not complete:
+                for future in set(batches.values()):
+                    future.cancel()
+
+            self.zip.close()
+
+            if previous is not None:
+                previous.close()
+                log.debug('Reused %i members from %r', self.reused, str(self.previous))
+
+            if not complete:
+                log.debug('Removing incomplete archive %r', str(self.path))
+
+                try:
+                    os.unlink(str(self.path))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,2 @@
+# Benchmarks for rmbuild itself, run on synthetic repositories.
+# See 'python -m rmbuild.bench -h'.
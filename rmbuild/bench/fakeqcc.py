@@ -0,0 +1,87 @@
+import hashlib
+import os
+import pathlib
+import sys
+import time
+
+from ..compat import *
+
+# A stand-in for rmqcc, for benchmarks and for trying rmbuild out without a
+# real compiler. Only understands -src; all other flags are ignored.
+#
+# It reads every file listed in progs.src, sleeps for a while as if it was
+# compiling them, and writes a .dat, .lno and .log into the current directory,
+# with contents derived from the sources (same sources, same output).
+#
+# Environment variables:
+#   RMBUILD_FAKEQCC_SECONDS     fixed compile time, overrides the rate
+#   RMBUILD_FAKEQCC_RATE        bytes of source "compiled" per second
+#   RMBUILD_FAKEQCC_FAIL        fail if the source directory contains this string
+
+DEFAULT_RATE = 4 << 20
+
+
+def read_progs_src(src):
+    with (src / 'progs.src').open() as f:
+        lines = [line.split('//')[0].strip() for line in f]
+
+    lines = [line for line in lines if line]
+    return lines[0], lines[1:]
+
+
+def output(path, seed, size):
+    # deterministic filler of the given size
+    block = hashlib.sha256(seed).digest()
+
+    with path.open('wb') as f:
+        f.write((block * (size // len(block) + 1))[:size])
+
+
+def main(argv):
+    try:
+        src = pathlib.Path(argv[argv.index('-src') + 1])
+    except (ValueError, IndexError):
+        print('usage: %s -src DIR [flags...]' % argv[0], file=sys.stderr)
+        return 1
+
+    fail = os.environ.get('RMBUILD_FAKEQCC_FAIL')
+
+    if fail and fail in str(src):
+        print('%s: error: failing on purpose (RMBUILD_FAKEQCC_FAIL=%s)' % (src, fail), file=sys.stderr)
+        return 1
+
+    dat, sources = read_progs_src(src)
+    name = pathlib.PurePosixPath(dat).stem
+    digest = hashlib.sha256(' '.join(argv[1:]).encode('utf-8'))
+    total = 0
+
+    for source in sources:
+        with (src / source).open('rb') as f:
+            data = f.read()
+
+        print('compiling %s' % source)
+        digest.update(data)
+        total += len(data)
+
+    seconds = os.environ.get('RMBUILD_FAKEQCC_SECONDS')
+
+    if seconds is not None:
+        seconds = float(seconds)
+    else:
+        seconds = total / float(os.environ.get('RMBUILD_FAKEQCC_RATE', DEFAULT_RATE))
+
+    time.sleep(seconds)
+
+    seed = digest.digest()
+    output(pathlib.Path(name + '.dat'), seed + b'dat', max(total // 4, 1))
+    output(pathlib.Path(name + '.lno'), seed + b'lno', max(total // 16, 1))
+
+    with open(name + '.log', 'w') as log:
+        log.write('%s: %i files, %i bytes, %.3f seconds\n' % (name, len(sources), total, seconds))
+
+    print('%s.dat: %i files, %i bytes' % (name, len(sources), total))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
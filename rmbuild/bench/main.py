@@ -0,0 +1,152 @@
+import argparse
+import logging
+import pathlib
+import shutil
+
+from ..compat import *
+
+from .. import util
+from .. import perf
+
+from . import synth
+from . import run
+
+log = util.logger(__name__)
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Benchmark rmbuild on a synthetic RocketMinsta repository. "
+                    "Every benchmark runs cold (empty caches) and warm (caches from the cold run). "
+                    "Exits with status 1 if --compare finds a regression.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    p.add_argument(
+        '-s', '--size',
+        choices=sorted(synth.SIZES, key=lambda s: synth.SIZES[s].packages * synth.SIZES[s].files_per_package),
+        default='small',
+        help="Size of the synthetic repository."
+    )
+
+    p.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help="Seed for the generated data."
+    )
+
+    p.add_argument(
+        '-r', '--repeat',
+        type=int,
+        default=3,
+        help="Run every benchmark this many times, the results are the median and the minimum."
+    )
+
+    p.add_argument(
+        '--only',
+        action='append',
+        choices=list(run.BENCHMARKS),
+        help="Only run this benchmark. Can be given more than once."
+    )
+
+    p.add_argument(
+        '-o', '--output',
+        type=pathlib.Path,
+        help="Write the results to this JSON file."
+    )
+
+    p.add_argument(
+        '--compare',
+        type=pathlib.Path,
+        metavar='RESULTS',
+        help="Compare with the results saved by an earlier --output."
+    )
+
+    p.add_argument(
+        '--threshold',
+        type=float,
+        default=perf.DEFAULT_THRESHOLD,
+        help="With --compare, flag benchmarks that got slower by more than this fraction."
+    )
+
+    p.add_argument(
+        '--min-seconds',
+        type=float,
+        default=run.DEFAULT_MIN_SECONDS,
+        help="With --compare, ignore benchmarks that got slower by less than this many seconds."
+    )
+
+    p.add_argument(
+        '--keep',
+        type=pathlib.Path,
+        metavar='DIR',
+        help="Generate the repository in this directory and keep it, or reuse it if it's already there."
+    )
+
+    p.add_argument(
+        '-g', '--git',
+        default='git',
+        help="The git executable to use."
+    )
+
+    p.add_argument(
+        '-v', '--verbose',
+        action='store_const',
+        const=logging.DEBUG,
+        default=logging.INFO,
+        help="Be noisy.",
+        dest='log_level'
+    )
+
+    return p.parse_args(args=argv[1:])
+
+
+def main(argv, defaults_overrides=None):
+    if pathlib.Path(argv[0]).name == '__main__.py':
+        argv[0] = 'python -m rmbuild.bench'
+
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+    util.GIT_EXECUTABLE = args.git
+
+    if args.repeat < 1:
+        raise ValueError("'repeat' must be at least 1, got %r instead" % args.repeat)
+
+    # the builds log a lot, keep the output readable unless asked otherwise
+    if args.log_level > logging.DEBUG:
+        logging.getLogger('rmbuild').setLevel(logging.WARNING)
+        logging.getLogger(__package__).setLevel(logging.INFO)
+
+    spec = synth.RepoSpec(**dict(synth.SIZES[args.size].as_dict(), seed=args.seed))
+
+    if args.keep is not None:
+        path = args.keep
+    else:
+        path = util.temp_directory() / 'bench'
+
+    try:
+        ws = run.Workspace(path, spec)
+        results = run.run(ws, args.only, args.repeat)
+    finally:
+        if args.keep is None:
+            shutil.rmtree(str(path), ignore_errors=True)
+
+    results['size'] = args.size
+    print(run.format_results(results))
+
+    if args.output is not None:
+        run.save(results, args.output)
+        log.info('Saved the results to %r', str(args.output))
+
+    if args.compare is not None:
+        comparisons = run.compare(run.load(args.compare), results, threshold=args.threshold,
+                                  min_seconds=args.min_seconds)
+        print()
+        print(run.format_comparisons(comparisons))
+
+        if any(c.regressed for c in comparisons):
+            return 1
+
+    return 0
@@ -0,0 +1,289 @@
+import collections
+import datetime
+import json
+import os
+import pathlib
+import platform
+import shutil
+import socket
+import statistics
+import time
+
+from ..compat import *
+
+from .. import util
+from .. import build
+from .. import fstree
+from .. import hashing
+from .. import package
+from .. import perf
+from .. import qcmodule
+from .. import report
+
+from . import synth
+
+log = util.logger(__name__)
+
+FORMAT = 1
+VARIANTS = ('cold', 'warm')
+
+# with --compare, ignore changes smaller than this
+DEFAULT_MIN_SECONDS = 0.01
+
+
+class Workspace(object):
+    # A synthetic repository plus scratch space for the benchmarks to build
+    # into. The repository is reused if it's already there (see --keep).
+
+    def __init__(self, path, spec):
+        self.path = pathlib.Path(path).resolve()
+        self.spec = spec
+        self.repo_path = self.path / 'repo'
+
+        if self.repo_path.exists():
+            log.info('Reusing the repository in %r', str(self.repo_path))
+            self.qcc = self.path / synth.FAKE_QCC_NAME
+        else:
+            util.make_directory(self.path)
+            self.qcc = synth.generate(self.repo_path, spec)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self.path))
+
+    def state(self):
+        # an empty directory for the caches and outputs of one cold/warm pair of runs
+        path = self.path / 'state'
+
+        if path.exists():
+            shutil.rmtree(str(path))
+
+        return util.make_directory(path)
+
+    def repo(self):
+        return build.Repo(self.repo_path)
+
+    def build_info(self, repo, state, **kwargs):
+        binfo = build.BuildInfo(repo,
+            qcc_cmd=self.qcc,
+            output_dir=state / 'output',
+            cache_dir=state / 'cache',
+            **kwargs
+        )
+
+        repo.hash_cache = binfo.hash_cache
+        repo.snapshot = binfo.snapshot
+        return binfo
+
+    def build(self, repo, state, **kwargs):
+        return repo.build(
+            qcc_cmd=self.qcc,
+            output_dir=state / 'output',
+            cache_dir=state / 'cache',
+            **kwargs
+        )
+
+
+class Timer(object):
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.seconds = time.time() - self.start
+
+
+def plain_packages(repo):
+    # the ones that can be built without compiling QC first
+    return [pkg for pkg in repo.packages.values() if not isinstance(pkg, package.LateBuildingPackage)]
+
+
+def finish(binfo):
+    binfo.finish_async_tasks()
+    report.stop()
+
+
+# Every benchmark takes the workspace and a state directory, and returns the
+# time it took. The warm variant runs it a second time in the same state
+# directory, so whatever the first run cached is reused.
+
+def bench_hash(ws, state):
+    repo = ws.repo()
+    repo.hash_cache = hashing.HashCache(util.make_directory(state / 'cache') / hashing.CACHE_FILENAME)
+    repo.snapshot = fstree.Snapshot()
+    graph = qcmodule.IncludeGraph(repo.hash_cache)
+
+    with Timer() as t:
+        for pkg in plain_packages(repo):
+            pkg.hash
+
+        for module in repo.qc_modules.values():
+            module.compute_hash(util.hash_constructor(), graph=graph)
+
+    repo.hash_cache.save()
+    return t.seconds
+
+
+def bench_images(ws, state):
+    repo = ws.repo()
+    binfo = ws.build_info(repo, state)
+
+    try:
+        with Timer() as t:
+            for pkg in plain_packages(repo):
+                pkg._compress_tga(binfo)
+    finally:
+        finish(binfo)
+
+    return t.seconds
+
+
+def bench_package(ws, state):
+    repo = ws.repo()
+    binfo = ws.build_info(repo, state)
+    util.clear_directory(binfo.output_dir)
+
+    try:
+        with Timer() as t:
+            for pkg in plain_packages(repo):
+                pkg.build(binfo)
+    finally:
+        finish(binfo)
+
+    binfo.hash_cache.save()
+    return t.seconds
+
+
+def bench_install(ws, state):
+    binfo = ws.build(ws.repo(), state)
+
+    with Timer() as t:
+        binfo.install(util.make_directory(state / 'install'))
+
+    return t.seconds
+
+
+def bench_srvpkg(ws, state):
+    binfo = ws.build(ws.repo(), state)
+    return binfo.get_report()['stages']['srvpkg']['wall']
+
+
+def bench_build(ws, state):
+    with Timer() as t:
+        ws.build(ws.repo(), state)
+
+    return t.seconds
+
+
+BENCHMARKS = collections.OrderedDict([
+    ('hash', bench_hash),
+    ('images', bench_images),
+    ('package', bench_package),
+    ('install', bench_install),
+    ('srvpkg', bench_srvpkg),
+    ('build', bench_build),
+])
+
+
+def summarize(runs):
+    return {
+        'runs': runs,
+        'median': statistics.median(runs),
+        'min': min(runs),
+    }
+
+
+def run(ws, names=None, repeat=3):
+    if names is None:
+        names = list(BENCHMARKS)
+
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError('Unknown benchmark %r, expected one of: %s' % (name, ', '.join(BENCHMARKS)))
+
+    results = collections.OrderedDict()
+
+    for name in names:
+        func = BENCHMARKS[name]
+        runs = {variant: [] for variant in VARIANTS}
+
+        for i in range(repeat):
+            state = ws.state()
+            runs['cold'].append(func(ws, state))
+            runs['warm'].append(func(ws, state))
+            log.info('%s #%i: cold %.3fs, warm %.3fs', name, i + 1, runs['cold'][-1], runs['warm'][-1])
+
+        results[name] = {variant: summarize(runs[variant]) for variant in VARIANTS}
+
+    return {
+        'format': FORMAT,
+        'date': datetime.datetime.now().isoformat(),
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'hash_method': util.HASH_METHOD,
+        'spec': ws.spec.as_dict(),
+        'repeat': repeat,
+        'benchmarks': results,
+    }
+
+
+def compare(old, new, threshold=perf.DEFAULT_THRESHOLD, min_seconds=DEFAULT_MIN_SECONDS):
+    # Compares the medians of two sets of results, see perf.Comparison
+    if old.get('format') != new.get('format'):
+        raise ValueError('Results have different formats: %r and %r' % (old.get('format'), new.get('format')))
+
+    if old['spec'] != new['spec']:
+        log.warning('The results are for different repositories, the comparison is meaningless')
+
+    comparisons = []
+
+    for name, variants in new['benchmarks'].items():
+        for variant, result in variants.items():
+            try:
+                baseline = old['benchmarks'][name][variant]['median']
+            except KeyError:
+                baseline = None
+
+            comparisons.append(perf.Comparison('%s (%s)' % (name, variant), baseline, result['median'],
+                                               threshold, min_seconds))
+
+    return comparisons
+
+
+def format_results(results):
+    lines = ['%-20s %10s %10s %10s %10s' % ('benchmark', 'cold', 'cold min', 'warm', 'warm min')]
+
+    for name, variants in results['benchmarks'].items():
+        lines.append('%-20s %9.3fs %9.3fs %9.3fs %9.3fs' % (
+            name,
+            variants['cold']['median'], variants['cold']['min'],
+            variants['warm']['median'], variants['warm']['min'],
+        ))
+
+    return '\n'.join(lines)
+
+
+def format_comparisons(comparisons):
+    lines = ['%-20s %10s %10s %8s' % ('benchmark', 'old', 'new', 'change')]
+
+    def seconds(value):
+        return '-' if value is None else '%.3fs' % value
+
+    for c in comparisons:
+        change = '-' if c.change is None else '%+.0f%%' % (c.change * 100)
+        lines.append('%-20s %10s %10s %8s%s' % (
+            c.stage, seconds(c.baseline), seconds(c.latest), change, '  REGRESSED' if c.regressed else ''
+        ))
+
+    return '\n'.join(lines)
+
+
+def load(path):
+    with open(str(path)) as f:
+        return json.load(f)
+
+
+def save(results, path):
+    with open(str(path), 'w') as f:
+        json.dump(results, f, indent=4)
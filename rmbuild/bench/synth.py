@@ -0,0 +1,197 @@
+import os
+import pathlib
+import random
+import stat
+import subprocess
+import sys
+
+from ..compat import *
+
+from .. import util
+
+log = util.logger(__name__)
+
+QC_MODULES = {
+    # module: name of the .dat it produces
+    'server': 'progs',
+    'client': 'csprogs',
+    'menu': 'menu',
+}
+
+FAKE_QCC_NAME = 'rmqcc'
+FAKE_QCC_TEMPLATE = '''#!%(python)s
+import sys
+sys.path.insert(0, %(path)r)
+from rmbuild.bench import fakeqcc
+sys.exit(fakeqcc.main(sys.argv))
+'''
+
+
+class RepoSpec(object):
+    # What a synthetic RocketMinsta repository looks like.
+    # Sizes are in bytes, fractions between 0 and 1.
+
+    def __init__(self,
+                    packages=4,
+                    files_per_package=50,
+                    file_size=16 << 10,
+                    compressible=0.5,
+                    textures_per_package=8,
+                    texture_size=256,
+                    alpha_fraction=0.5,
+                    png_fraction=0.5,
+                    qc_files=20,
+                    qc_include_depth=4,
+                    qc_file_size=4 << 10,
+                    repo_version=5,
+                    seed=0,
+                ):
+        self.__dict__.update(locals())
+        del self.__dict__['self']
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % item for item in sorted(self.__dict__.items())
+        ))
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+SIZES = {
+    'tiny': RepoSpec(packages=2, files_per_package=10, textures_per_package=2, texture_size=64, qc_files=5),
+    'small': RepoSpec(),
+    'medium': RepoSpec(packages=8, files_per_package=200, textures_per_package=32, qc_files=100, qc_include_depth=8),
+    'large': RepoSpec(packages=16, files_per_package=1000, file_size=64 << 10, textures_per_package=128,
+                      texture_size=512, qc_files=400, qc_include_depth=16, qc_file_size=16 << 10),
+}
+
+
+def random_bytes(rng, size, compressible):
+    # a mix of random data and repetitive text, in the given proportion
+    text_size = int(size * compressible)
+    text = (b'// The quick brown fox jumps over the lazy dog\n' * (text_size // 47 + 1))[:text_size]
+
+    if size == text_size:
+        return text
+
+    return text + rng.getrandbits((size - text_size) * 8).to_bytes(size - text_size, 'little')
+
+
+def write_file(path, data):
+    util.make_directory(path.parent)
+
+    with path.open('wb') as f:
+        f.write(data)
+
+
+def write_texture(rng, path, size, alpha):
+    from PIL import Image
+
+    mode = 'RGBA' if alpha else 'RGB'
+    img = Image.new(mode, (size, size))
+
+    # a few gradients and noise, so that the JPEGs look somewhat like real ones
+    r, g, b = rng.randrange(256), rng.randrange(256), rng.randrange(256)
+    pixels = []
+
+    for y in range(size):
+        for x in range(size):
+            noise = rng.randrange(32)
+            pixel = ((r + x + noise) & 0xff, (g + y + noise) & 0xff, (b + x + y) & 0xff)
+
+            if alpha:
+                pixel += (255 if (x // 8 + y // 8) % 2 else rng.randrange(256),)
+
+            pixels.append(pixel)
+
+    img.putdata(pixels)
+    util.make_directory(path.parent)
+    img.save(str(path))
+
+
+def write_qc(rng, root, spec):
+    common = root / 'qcsrc' / 'common'
+
+    # a chain of headers, each one including the next
+    headers = ['lib%i.qh' % i for i in range(spec.qc_include_depth)]
+
+    for i, name in enumerate(headers):
+        text = '// synthetic header %i\n' % i
+
+        if i + 1 < len(headers):
+            text += '#include "%s"\n' % headers[i + 1]
+
+        write_file(common / name, text.encode('utf-8') + random_bytes(rng, spec.qc_file_size, 1.0))
+
+    for module, dat in QC_MODULES.items():
+        mdir = root / 'qcsrc' / module
+        sources = ['%s%i.qc' % (module, i) for i in range(spec.qc_files)]
+
+        for name in sources:
+            text = '#include "../common/%s"\nvoid %s() {}\n' % (headers[0], name[:-3]) if headers else ''
+            write_file(mdir / name, text.encode('utf-8') + random_bytes(rng, spec.qc_file_size, 1.0))
+
+        progs = ['../%s.dat' % dat] + ['../common/%s' % h for h in reversed(headers)] + sources
+        write_file(mdir / 'progs.src', ('\n'.join(progs) + '\n').encode('utf-8'))
+
+
+def write_package(rng, path, spec):
+    for i in range(spec.files_per_package):
+        write_file(path / 'data' / ('file%04i.dat' % i), random_bytes(rng, spec.file_size, spec.compressible))
+
+    for i in range(spec.textures_per_package):
+        alpha = rng.random() < spec.alpha_fraction
+        suffix = '.png' if rng.random() < spec.png_fraction else '.tga'
+        write_texture(rng, path / 'gfx' / ('texture%03i%s' % (i, suffix)), spec.texture_size, alpha)
+
+    write_file(path / '.rmbuild' / 'serverside' / ('%s.cfg' % path.stem), b'// server-side config\n')
+
+
+def write_fake_qcc(path):
+    path.write_text(FAKE_QCC_TEMPLATE % {
+        'python': sys.executable,
+        'path': str(pathlib.Path(__file__).resolve().parents[2]),
+    })
+    path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def git(root, *args):
+    subprocess.check_call(
+        [util.GIT_EXECUTABLE, '-c', 'user.name=rmbuild', '-c', 'user.email=rmbuild@localhost'] + list(args),
+        cwd=str(root), stdout=subprocess.DEVNULL
+    )
+
+
+def generate(path, spec=None):
+    # Creates a repository at path, which must not exist yet, and returns the
+    # path to a fake rmqcc to build it with.
+
+    if spec is None:
+        spec = RepoSpec()
+
+    root = pathlib.Path(path)
+    os.makedirs(str(root))
+    rng = random.Random(spec.seed)
+
+    log.info('Generating a synthetic repository in %r: %r', str(root), spec)
+
+    write_file(root / '.rmbuild_repoversion', ('%i\n' % spec.repo_version).encode('utf-8'))
+    write_file(root / 'modfiles' / 'rocketminsta.cfg', b'// synthetic rocketminsta.cfg\n')
+    write_file(root / 'modfiles' / 'maps' / 'synthetic.mapinfo', b'title Synthetic\n')
+    write_qc(rng, root, spec)
+
+    for i in range(spec.packages):
+        # every other package is optional, like the o_ ones in the real repository
+        write_package(rng, root / ('%spkg%02i.pk3dir' % ('o_' if i % 2 else '', i)), spec)
+
+    util.make_directory(root / 'csqc.pk3dir')
+    util.make_directory(root / 'menu.pk3dir')
+
+    git(root, 'init', '-q')
+    git(root, 'add', '-A')
+    git(root, 'commit', '-q', '-m', 'Synthetic repository')
+    git(root, 'tag', 'v1')
+
+    return write_fake_qcc(root.parent / FAKE_QCC_NAME)
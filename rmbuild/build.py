@@ -1,9 +1,12 @@
 
+import contextlib
 import datetime
+import json
+import pathlib
 import shlex
 import shutil
+import time
 import functools
-import multiprocessing
 
 from concurrent import futures
 
@@ -14,9 +17,29 @@ from . import package
 from . import qcmodule
 from . import errors
 from . import install
+from . import hashing
+from . import fstree
+from . import archive
+from . import imaging
+from . import scheduler
+from . import trace
+from . import report
+from . import perf
+from . import profiling
+from . import cache
+from . import remote
 
 log = util.logger(__name__)
 
+# Rough peak memory use of a single job, used for the default job counts
+QCC_JOB_MEMORY = 512 << 20
+IMAGE_JOB_MEMORY = 256 << 20
+COMPRESS_JOB_MEMORY = 64 << 20
+PACKAGE_JOB_MEMORY = 64 << 20
+
+# What the process pool workers run, see util.ProcessPool
+PROCESS_POOL_PRELOAD = ('rmbuild.archive', 'rmbuild.imaging')
+
 
 class BuildInfo(object):
     def __init__(self, repo,
@@ -30,13 +53,35 @@ class BuildInfo(object):
                     extra_packages=(),
                     excluded_packages=(),
                     link_pk3dirs=False,
+                    use_hardlinks=False,
                     compress_gfx=True,
                     compress_gfx_quality=85,
                     compress_gfx_all=True,
+                    compress_gfx_min_saving=0.0,
+                    image_report=None,
+                    build_report=None,
+                    profile=False,
+                    profile_memory=False,
+                    profile_dir=None,
+                    qcc_jobs=None,
+                    image_jobs=None,
+                    compress_jobs=None,
+                    package_jobs=None,
+                    io_jobs=None,
+                    pk3_compression=None,
+                    pk3_store_threshold=archive.DEFAULT_STORE_THRESHOLD,
+                    pk3_incremental=True,
                     cache_dir=None,
                     cache_qc=True,
                     cache_pkg=True,
+                    cache_img=True,
+                    cache_max_size=None,
+                    cache_max_age=None,
+                    remote_cache=None,
+                    remote_cache_push=True,
+                    remote_cache_timeout=remote.DEFAULT_TIMEOUT,
                     force_rebuild=False,
+                    rehash=False,
                     hooks=None,
                     server_package='pk3',
                 ):
@@ -44,8 +89,35 @@ class BuildInfo(object):
         if hooks is None:
             hooks = {}
 
+        if qcc_jobs is None:
+            qcc_jobs = util.default_jobs(QCC_JOB_MEMORY)
+
+        if compress_jobs is None:
+            compress_jobs = util.default_jobs(COMPRESS_JOB_MEMORY)
+
+        if image_jobs is None:
+            image_jobs = util.default_jobs(IMAGE_JOB_MEMORY)
+
+        if package_jobs is None:
+            package_jobs = util.default_jobs(PACKAGE_JOB_MEMORY)
+
+        if io_jobs is None:
+            io_jobs = util.default_jobs(per_cpu=2)
+
+        for key, value in (('qcc_jobs', qcc_jobs), ('compress_jobs', compress_jobs), ('image_jobs', image_jobs),
+                           ('package_jobs', package_jobs), ('io_jobs', io_jobs)):
+            if value < 1:
+                raise ValueError("'%s' must be at least 1, got %r instead" % (key, value))
+
         if threads is None:
-            threads = multiprocessing.cpu_count() * 5
+            threads = qcc_jobs + package_jobs + io_jobs
+
+        if cache_max_size is not None:
+            cache_max_size = util.parse_size(cache_max_size)
+
+        for key, value in (('cache_max_size', cache_max_size), ('cache_max_age', cache_max_age)):
+            if value is not None and value < 0:
+                raise ValueError("'%s' must not be negative, got %r instead" % (key, value))
 
         qcc_cmd = str(qcc_cmd)
 
@@ -72,6 +144,25 @@ class BuildInfo(object):
         else:
             self.cache_dir = None
 
+        if remote_cache is not None and self.cache_dir is None:
+            log.warning("'remote_cache' is ignored without a 'cache_dir' to download into")
+            remote_cache = None
+
+        if remote_cache is not None:
+            self.remote_cache = remote.RemoteCache(remote.backend(remote_cache, remote_cache_timeout),
+                                                   push=remote_cache_push)
+            log.info('Using the remote cache %r', str(remote_cache))
+        else:
+            self.remote_cache = None
+
+        if self.cache_dir is not None:
+            self.hash_cache = hashing.HashCache(self.cache_dir / hashing.CACHE_FILENAME, rehash=rehash)
+            self.cache_manager = cache.CacheManager(self.cache_dir, self.remote_cache)
+        else:
+            self.hash_cache = None
+            self.cache_manager = None
+
+        self.snapshot = fstree.Snapshot()
         self.temp_dir = util.temp_directory()
 
         if output_dir is None:
@@ -79,6 +170,19 @@ class BuildInfo(object):
 
         self.output_dir = util.make_directory(output_dir).resolve()
 
+        if build_report is None:
+            self.build_report = self.output_dir.with_name(self.output_dir.name + '-report.json')
+
+        self.report = report.start()
+
+        if profile_dir is None:
+            self.profile_dir = self.output_dir.with_name(self.output_dir.name + '-profile')
+
+        if profile or profile_memory:
+            self.profiler = profiling.Profiler(self.profile_dir, cpu=profile, memory=profile_memory)
+        else:
+            self.profiler = None
+
         if qcc_flags is None:
             qcc_flags = []
         elif isinstance(qcc_flags, str):
@@ -86,19 +190,71 @@ class BuildInfo(object):
 
         self.qcc_flags = qcc_flags
 
-        self.qc_defs = self.get_qc_defs()
+        self.qc_graph = qcmodule.IncludeGraph(self.hash_cache)
+        self.qc_hashes = {}
+        self.qc_defs = None
         self.qc_module_config = {}
-        self.configure_qc_modules()
 
         self.built_qc_modules = {}
         self.built_packages = []
 
         self.install = functools.partial(install.install, self)
 
-        self.failed = False
-        self.futures = []
-        self.tasks = {}
-        self.executor = futures.ThreadPoolExecutor(self.threads)
+        if self.cache_dir is not None:
+            self.task_history = scheduler.History(self.cache_dir / scheduler.HISTORY_FILENAME)
+        else:
+            self.task_history = None
+
+        self.closed = False
+        self.cancel_token = scheduler.CancelToken()
+        self.scheduler = scheduler.Scheduler(
+            self.threads,
+            limits={
+                'qcc': qcc_jobs,
+                'zip': package_jobs,
+                'io': io_jobs,
+            },
+            on_failure=self._task_failed,
+            history=self.task_history
+        )
+        self.tasks = self.scheduler.tasks
+
+        self.pk3_policy = archive.CompressionPolicy(pk3_compression, pk3_store_threshold)
+
+        # Deflating and image conversion share a single pool, sized for
+        # whichever of the two wants more processes. Each of them only gets
+        # as many of its workers at a time as its own setting allows.
+        pool_jobs = max(compress_jobs, image_jobs if compress_gfx else 1)
+
+        if pool_jobs > 1:
+            self.process_pool = util.ProcessPool(pool_jobs, preload=PROCESS_POOL_PRELOAD)
+        else:
+            self.process_pool = None
+
+        if compress_jobs > 1:
+            self.deflate_pool = util.LimitedPool(self.process_pool, compress_jobs)
+        else:
+            self.deflate_pool = None
+
+        if compress_gfx and image_jobs > 1:
+            self.image_pool = util.LimitedPool(self.process_pool, image_jobs)
+        else:
+            self.image_pool = None
+
+        self.image_stats = []
+
+        if image_report is None and self.cache_dir is not None:
+            self.image_report = self.cache_dir / 'reports' / 'images.json'
+
+        if self.cache_dir is not None and cache_img and compress_gfx:
+            self.image_cache = imaging.ImageCache(self.cache_dir / 'img', self.cache_manager, hardlink=use_hardlinks)
+        else:
+            self.image_cache = None
+
+    def configure(self):
+        # needs the menu QC hash, see Repo.hash_sources
+        self.qc_defs = self.get_qc_defs()
+        self.configure_qc_modules()
 
     def configure_qc_module(self, name, *args, **kwargs):
         if name in self.qc_module_config:
@@ -228,47 +384,215 @@ class BuildInfo(object):
 
         return defs
 
-    def abort_if_failed(self):
-        if self.failed:
-            raise errors.BuildStepAborted
+    def write_image_report(self):
+        if not self.image_report or not self.image_stats:
+            return
+
+        path = pathlib.Path(self.image_report)
+        util.make_directory(path.parent)
+        log.info("Writing the image conversion report to %r", str(path))
+
+        decisions = {}
+        for stats in self.image_stats:
+            decisions[stats['decision']] = decisions.get(stats['decision'], 0) + 1
+
+        with path.open('w') as f:
+            json.dump({
+                'build': self.name,
+                'version': self.version,
+                'date': self.date_string,
+                'decisions': decisions,
+                'images': sorted(self.image_stats, key=lambda s: (s['package'], s['path'])),
+            }, f, indent=4, sort_keys=True)
+
+    def config_hash(self):
+        # Identifies builds that are comparable performance-wise
+        settings = [
+            self.qcc_cmd, self.qcc_flags, self.autocvars, self.threads,
+            self.qcc_jobs, self.compress_jobs, self.image_jobs, self.package_jobs, self.io_jobs,
+            sorted(self.extra_packages), sorted(self.excluded_packages), self.link_pk3dirs, self.use_hardlinks,
+            self.compress_gfx, self.compress_gfx_quality, self.compress_gfx_all, self.compress_gfx_min_saving,
+            self.pk3_compression, self.pk3_store_threshold, self.pk3_incremental,
+            self.cache_qc, self.cache_pkg, self.cache_img, self.force_rebuild, self.server_package,
+            self.profile, self.profile_memory, self.remote_cache is not None,
+            util.HASH_FUNCTION, util.HASH_METHOD,
+        ]
 
-    def add_async_task(self, name, task):
-        log.debug("Added task for %s", name)
+        h = util.hash_constructor()
+        h.update(json.dumps(settings, default=repr).encode('utf-8'))
+        return h.hexdigest()
 
-        def wrapped_task():
-            result = task()
-            log.debug("Finished task for %s", name)
-            return result
+    def record_perf(self, build_report):
+        if self.cache_dir is None:
+            return
 
-        subs = name.split('.')
-        lists = [self.futures, self.tasks.setdefault(name, [])] + [
-            self.tasks.setdefault('.'.join(subs[:i]), []) for i in range(1, len(subs))
-        ]
+        history = perf.PerfHistory(self.cache_dir / perf.DB_FILENAME)
+
+        try:
+            history.record(self, build_report)
+        finally:
+            history.close()
+
+    def collect_cache_garbage(self):
+        if self.cache_manager is None or (self.cache_max_size is None and self.cache_max_age is None):
+            return
+
+        # everything this build used is likely needed by the next one too
+        keep_after = time.mktime(self.date.timetuple())
+        self.cache_manager.gc(self.cache_max_size, self.cache_max_age, keep_after=keep_after)
+
+    def get_report(self):
+        counters = self.report.counters
 
-        future = self.executor.submit(wrapped_task)
+        def cache_stats(hits, misses):
+            return {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': float(hits) / (hits + misses) if hits + misses else None,
+            }
 
-        for lst in lists:
-            lst.append(future)
+        caches = {
+            'qc': cache_stats(counters.get('qc_cache.hit', 0), counters.get('qc_cache.miss', 0)),
+            'pkg': cache_stats(counters.get('pkg_cache.hit', 0), counters.get('pkg_cache.miss', 0)),
+        }
+
+        if self.image_cache is not None:
+            caches['img'] = cache_stats(self.image_cache.hits, self.image_cache.misses)
+
+        if self.hash_cache is not None:
+            caches['hash'] = cache_stats(self.hash_cache.hits, self.hash_cache.misses)
+
+        if self.remote_cache is not None:
+            caches['remote'] = cache_stats(self.remote_cache.hits, self.remote_cache.misses)
+            caches['remote']['uploads'] = self.remote_cache.uploads
+
+        return {
+            'format': report.FORMAT,
+            'build': self.name,
+            'version': self.version,
+            'comment': self.comment,
+            'date': self.date_string,
+            'output_dir': str(self.output_dir),
+            'totals': self.report.totals(),
+            'stages': self.report.stages,
+            'caches': caches,
+            'bytes': {
+                'hashed': counters.get('bytes_hashed', 0),
+                'compressed_in': counters.get('bytes_compressed_in', 0),
+                'compressed_out': counters.get('bytes_compressed_out', 0),
+                'reused': counters.get('bytes_reused', 0),
+                'copied': counters.get('bytes_copied', 0),
+                'linked': counters.get('bytes_linked', 0),
+                'downloaded': counters.get('bytes_downloaded', 0),
+                'uploaded': counters.get('bytes_uploaded', 0),
+            },
+            # how many files were reflinked, hard-linked or copied, see materialize.py
+            'materialized': {
+                key.split('.', 1)[1]: value for key, value in counters.items() if key.startswith('materialize.')
+            },
+            'packages': self.report.packages,
+            'qcc': self.report.qcc,
+        }
+
+    def write_report(self):
+        data = self.get_report()
+
+        if self.build_report:
+            path = pathlib.Path(self.build_report)
+            util.make_directory(path.parent)
+            log.info("Writing the build report to %r", str(path))
+
+            with path.open('w') as f:
+                json.dump(data, f, indent=4, sort_keys=True)
+
+        return data
+
+    @property
+    def failed(self):
+        return self.cancel_token.cancelled
+
+    def abort_if_failed(self):
+        self.cancel_token.check()
+
+    def _task_failed(self, task, exception):
+        if not isinstance(exception, errors.BuildStepAborted):
+            log.debug("Task for %s failed: %r", task.name, exception)
+
+        # don't start anything else, and interrupt whatever can be interrupted
+        self.scheduler.cancel()
+        self.cancel_token.cancel()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Times a stage or task for the build report, and profiles it if asked to
+        with self.report.stage(name):
+            if self.profiler is None:
+                yield
+            else:
+                with self.profiler.profile(name):
+                    yield
+
+    def add_async_task(self, name, task, after=(), kind='io'):
+        # The task only starts once all the tasks named in 'after' are done.
+        # kind is one of 'qcc' (runs the QC compiler), 'zip' (builds archives)
+        # or 'io' (hashes or copies files), see the *_jobs options.
+        def staged_task():
+            with self.stage(name):
+                return task()
+
+        return self.scheduler.add(name, staged_task, kind, after)
 
     def finish_async_tasks(self):
-        done, not_done = futures.wait(self.futures, return_when=futures.FIRST_EXCEPTION)
+        done, not_done = futures.wait([task.future for task in self.scheduler.all],
+                                      return_when=futures.FIRST_EXCEPTION)
 
         if not_done:
-            self.failed = True
-            for future in not_done:
-                future.cancel()
+            self.scheduler.cancel()
+            self.cancel_token.cancel()
+            futures.wait(not_done)
+
+        try:
+            # report the original error, not the tasks aborted or cancelled because of it
+            failed = [f for f in done if not f.cancelled() and f.exception() is not None]
+            failed.sort(key=lambda f: isinstance(f.exception(), errors.BuildStepAborted))
+
+            if failed:
+                failed[0].result()
+        finally:
+            self.scheduler.shutdown()
+
+            if self.process_pool is not None:
+                self.process_pool.shutdown()
+
+    def close(self):
+        # Stops everything the build has started. Safe to call more than once.
+        # After a failure, uploads to the remote cache that haven't started
+        # yet are dropped.
+        if self.closed:
+            return
+
+        self.closed = True
+        self.scheduler.shutdown()
+
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+
+        if self.remote_cache is not None:
+            self.remote_cache.close(cancel=self.cancel_token.cancelled)
 
-        for future in done:
-            future.result()
+        if self.profiler is not None:
+            self.profiler.close()
 
-        self.executor.shutdown()
+        report.stop()
+
+    def get_qc_hash(self, name):
+        self.wait_for_tasks('hash.qc.%s' % name)
+        return self.qc_hashes[name]
 
     def wait_for_tasks(self, *tasknames):
-        for taskname in tasknames:
-            log.debug("Waiting for %s", taskname)
-            for future in self.tasks[taskname]:
-                future.result()
-            log.debug("Done waiting for %s", taskname)
+        # Tasks should declare what they need with add_async_task(after=...)
+        # instead of waiting for it here
+        self.scheduler.wait(*tasknames)
 
 
 class Repo(object):
@@ -280,6 +604,7 @@ class Repo(object):
         self.qc_modules = {}
         self.root = path
         self.qchash_menu = None
+        self.hash_cache = None
 
     @property
     def root(self):
@@ -329,57 +654,124 @@ class Repo(object):
             self.qc_modules[name] = qcmodule.QCModule(name, self.qcsrc / name)
 
     def build(self, *buildinfo_args, **buildinfo_kwargs):
-        self.update_qcsrc_hashes()
         build_info = BuildInfo(self, *buildinfo_args, **buildinfo_kwargs)
-        log.info("Build started: %s %s (%s)", build_info.name, self.rm_version, build_info.comment)
-
-        util.clear_directory(build_info.output_dir)
-
-        auto_header_needed = False
-        for qc in self.qc_modules.values():
-            if qc.needs_auto_header:
-                auto_header_needed = True
-                break
-
-        with util.in_dir(build_info.temp_dir):
-            if auto_header_needed:
-                self.generate_qc_header(build_info)
-
-            self.build_qc_modules(build_info)
-            self.build_packages(build_info)
-            self.install_qc_modules(build_info)
-            self.copy_static_files(build_info)
-            self.update_rm_cfg(build_info)
-            self.create_server_package(build_info)
-            build_info.finish_async_tasks()
+        stage = build_info.stage
+        self.hash_cache = build_info.hash_cache
+        self.snapshot = build_info.snapshot
 
-        delta = datetime.datetime.now() - build_info.date
+        try:
+            with stage('hash'):
+                self.hash_sources(build_info)
 
-        log.info(
-            "Build finished: %s %s (%s), target: %r, build time: %s",
-            build_info.name,
-            self.rm_version,
-            build_info.comment,
-            str(build_info.output_dir),
-            delta
-        )
+            with stage('configure'):
+                build_info.configure()
+
+            log.info("Build started: %s %s (%s)", build_info.name, self.rm_version, build_info.comment)
+
+            with stage('clear'):
+                util.clear_directory(build_info.output_dir)
+
+            auto_header_needed = False
+            for qc in self.qc_modules.values():
+                if qc.needs_auto_header:
+                    auto_header_needed = True
+                    break
+
+            with util.in_dir(build_info.temp_dir):
+                if auto_header_needed:
+                    self.generate_qc_header(build_info)
+
+                self.build_qc_modules(build_info)
+                self.build_packages(build_info)
+                self.install_qc_modules(build_info)
+                self.copy_static_files(build_info)
+                self.update_rm_cfg(build_info)
+                self.create_server_package(build_info)
+
+                with stage('wait'):
+                    build_info.finish_async_tasks()
+
+            if build_info.remote_cache is not None:
+                with stage('upload'):
+                    build_info.remote_cache.close()
+
+            with stage('save'):
+                if build_info.hash_cache is not None:
+                    build_info.hash_cache.save()
+
+                if build_info.task_history is not None:
+                    build_info.task_history.save()
+
+                if build_info.cache_manager is not None:
+                    build_info.cache_manager.save()
+
+                build_info.write_image_report()
+
+            with stage('gc'):
+                build_info.collect_cache_garbage()
+
+            build_info.close()
+            build_report = build_info.write_report()
+            build_info.record_perf(build_report)
+
+            delta = datetime.datetime.now() - build_info.date
+
+            log.info(
+                "Build finished: %s %s (%s), target: %r, build time: %s",
+                build_info.name,
+                self.rm_version,
+                build_info.comment,
+                str(build_info.output_dir),
+                delta
+            )
+
+            build_info.call_hook('post_build', report=build_report)
+        except BaseException:
+            # stop whatever is still running, e.g. after a hook failed or on ^C
+            build_info.scheduler.cancel()
+            build_info.cancel_token.cancel()
+            raise
+        finally:
+            build_info.close()
 
-        build_info.call_hook('post_build')
         return build_info
 
-    def update_qcsrc_hashes(self):
-        log.info("Hashing the QC source files")
-        self.qchash_menu = self.qc_modules['menu'].compute_hash(util.hash_constructor())
+    def hash_sources(self, build_info):
+        log.info("Hashing the sources")
+
+        # Everything is hashed concurrently. Only the menu hash is waited for
+        # here, because the QC defines depend on it; the other tasks wait for
+        # their own keys when they need them.
+
+        def qc_task(name, module):
+            if name == 'client':
+                basehash = build_info.get_qc_hash('menu').copy()
+            else:
+                basehash = util.hash_constructor()
+
+            build_info.qc_hashes[name] = module.compute_hash(basehash, graph=build_info.qc_graph)
+
+        # the client hash is based on the menu one, so submit that first
+        for name, module in sorted(self.qc_modules.items(), key=lambda item: item[0] != 'menu'):
+            if name == 'menu' or (build_info.cache_dir and build_info.cache_qc):
+                build_info.add_async_task('hash.qc.%s' % name, functools.partial(qc_task, name, module),
+                                          after=['hash.qc.menu'] if name == 'client' else [])
+
+        for name, pkg in self.packages.items():
+            if build_info.should_build_package(pkg) and not isinstance(pkg, package.LateBuildingPackage):
+                build_info.add_async_task('hash.pkg.%s' % name, lambda pkg=pkg: pkg.hash)
+
+        try:
+            self.qchash_menu = build_info.get_qc_hash('menu')
+        except Exception:
+            build_info.finish_async_tasks()
+            raise
 
     def generate_qc_header(self, build_info):
         log.info("Generating the rm_auto header")
 
         with open(str(self.qcsrc / 'common' / 'rm_auto.qh'), 'w') as header:
-            for key, value in build_info.qc_defs.items():
-                if value:
-                    header.write('#define %s %s\n' % (key, value))
-                else:
-                    header.write('#define %s\n' % key)
+            header.write(qcmodule.auto_header(build_info.qc_defs))
 
     def build_packages(self, build_info):
         for name, pkg in self.packages.items():
@@ -391,7 +783,8 @@ class Repo(object):
                 pkg.build(build_info)
                 build_info.built_packages.append(pkg)
 
-            build_info.add_async_task("pkg.%s" % name, task)
+            build_info.add_async_task("pkg.%s" % name, task,
+                                      after=['hash.pkg.%s' % name] + list(pkg.build_dependencies), kind='zip')
 
     def build_qc_modules(self, build_info):
         built = build_info.built_qc_modules
@@ -401,15 +794,15 @@ class Repo(object):
             for config in build_info.qc_module_config[name]:
                 def task(name=name, built=built, module=module, build_info=build_info, config=config):
                     built[name].append(module.build(build_info, config))
-                build_info.add_async_task("qc.%s" % name, task)
+
+                build_info.add_async_task("qc.%s" % name, task, after=['hash.qc.%s' % name], kind='qcc')
 
     def install_qc_module(self, build_info, built_module):
         for fpath in filter(lambda p: p.suffix in util.QC_INSTALL_FILEEXT, built_module.iterdir()):
-            util.copy(fpath, build_info.output_dir)
+            util.copy(fpath, build_info.output_dir, hardlink=build_info.use_hardlinks)
 
     def install_qc_modules(self, build_info):
         def task():
-            build_info.wait_for_tasks('qc')
             log.info("Installing QC modules")
 
             for name, dirs in build_info.built_qc_modules.items():
@@ -418,12 +811,14 @@ class Repo(object):
 
                 for module in dirs:
                     self.install_qc_module(build_info, module)
-        build_info.add_async_task('copyqc', task)
+        build_info.add_async_task('copyqc', task, after=['qc'])
 
     def copy_static_files(self, build_info):
         def task():
             log.info("Copying static files")
-            util.copy_tree(self.modfiles, build_info.output_dir)
+
+            # never hard links, rocketminsta.cfg is appended to later
+            util.copy_tree(self.modfiles, build_info.output_dir, snapshot=build_info.snapshot)
 
             for name, pkg in self.packages.items():
                 if not build_info.should_build_package(pkg):
@@ -431,13 +826,11 @@ class Repo(object):
 
                 sdir = pkg.meta.serverside_dir
                 if sdir:
-                    util.copy_tree(sdir, build_info.output_dir)
+                    util.copy_tree(sdir, build_info.output_dir, snapshot=build_info.snapshot)
         build_info.add_async_task('static', task)
 
     def update_rm_cfg(self, build_info):
         def task():
-            build_info.wait_for_tasks('static', 'pkg')
-
             log.info("Updating rocketminsta.cfg")
 
             with (build_info.output_dir / 'rocketminsta.cfg').open('a') as rmcfg:
@@ -455,7 +848,7 @@ class Repo(object):
                             rmcfg.write('set %s %s.dat\n' % (cfg.cvar, cfg.dat_final_name))
 
                 rmcfg.write('\n')
-        build_info.add_async_task('rmcfg', task)
+        build_info.add_async_task('rmcfg', task, after=['static', 'pkg'])
 
     def create_server_package(self, build_info):
         if build_info.server_package == 'none':
@@ -465,27 +858,27 @@ class Repo(object):
             raise ValueError(build_info.server_package)
 
         def task():
-            build_info.wait_for_tasks('static', 'qc', 'copyqc', 'rmcfg')
             log.info("Creating the server-side package")
 
             files = []
             dirs = []
 
-            def add_files(path):
-                for p in path.iterdir():
-                    if p.suffix in ('.pk3', '.pk3dir'):
+            def add_files(entry):
+                for e in entry.iterdir():
+                    if e.suffix in ('.pk3', '.pk3dir'):
                         continue
 
-                    if p.is_symlink():
-                        raise errors.PathError(p, "symbolic links are not supported here")
+                    if e.is_symlink:
+                        raise errors.PathError(e.path, "symbolic links are not supported here")
 
-                    if p.is_dir():
-                        dirs.append(p.relative_to(build_info.output_dir))
-                        add_files(p)
+                    if e.is_dir:
+                        dirs.append(e.path.relative_to(build_info.output_dir))
+                        add_files(e)
                     else:
-                        files.append(p.relative_to(build_info.output_dir))
+                        files.append(e.path.relative_to(build_info.output_dir))
 
-            add_files(build_info.output_dir)
+            # the output directory is still changing, so don't take it from the build snapshot
+            add_files(fstree.Tree(build_info.output_dir).root)
 
             pk3dir = util.make_directory(
                 build_info.output_dir / ('zzz-rm-server-%s.pk3dir' % build_info.version)
@@ -501,12 +894,14 @@ class Repo(object):
                 (build_info.output_dir / d).rmdir()
 
             if build_info.server_package == 'pk3':
-                shutil.make_archive(str(pk3dir.with_suffix('')), 'zip', str(pk3dir),
-                                    logger=util.logger(__name__, 'srvpkg'))
-                pk3dir.with_suffix('.zip').rename(pk3dir.with_suffix('.pk3'))
-                shutil.rmtree(str(pk3dir))
-
-        build_info.add_async_task('srvpkg', task)
+                with trace.span('zip server package', 'zip', files=len(files)) as span:
+                    shutil.make_archive(str(pk3dir.with_suffix('')), 'zip', str(pk3dir),
+                                        logger=util.logger(__name__, 'srvpkg'))
+                    pk3dir.with_suffix('.zip').rename(pk3dir.with_suffix('.pk3'))
+                    shutil.rmtree(str(pk3dir))
+                    span.set(bytes=pk3dir.with_suffix('.pk3').stat().st_size)
+
+        build_info.add_async_task('srvpkg', task, after=['static', 'qc', 'copyqc', 'rmcfg'], kind='zip')
 
     def __repr__(self):
         return 'Repo(%r)' % str(self._root)
@@ -0,0 +1,490 @@
+import contextlib
+import errno
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import zipfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .compat import *
+
+from . import util
+
+log = util.logger(__name__)
+
+DB_FILENAME = 'cache.sqlite3'
+
+# Kinds of cache entries, by subdirectory of cache_dir:
+#   qc/<dat>/<hash>/     a compiled QC module
+#   pkg/<name>.pk3       a built package
+#   img/<xx>/<key>.jpg   a converted texture, plus <key>_alpha.jpg if needed
+KINDS = ('qc', 'pkg', 'img')
+
+# Leftover temporary files are only removed once they're this old, since a
+# concurrent build may still be writing them
+TMP_MAX_AGE = 3600
+
+# How often a build waiting for a lock checks whether it has failed
+LOCK_POLL_INTERVAL = 0.25
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    name TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS counters (
+    kind TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+
+def tree_size(path):
+    if not path.exists():
+        return 0
+
+    if not path.is_dir():
+        return path.stat().st_size
+
+    return sum(f.stat().st_size for f in path.rglob('*') if f.is_file() and not f.is_symlink())
+
+
+def temp_path(path):
+    # where to write something before publishing it to path
+    return path.with_name('%s.%i.%i.tmp' % (path.name, os.getpid(), threading.get_ident()))
+
+
+def publish(tmp, path):
+    # Moves a complete file or directory into place in one step, so that
+    # nobody ever sees half of it
+    if not tmp.is_dir():
+        tmp.replace(path)
+        return
+
+    if path.exists():
+        # only happens when rebuilding, while holding the lock on path
+        old = temp_path(path)
+        path.rename(old)
+        tmp.rename(path)
+        remove(old)
+    else:
+        tmp.rename(path)
+
+
+def try_lock(f):
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+
+    return True
+
+
+def remove(path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(str(path), ignore_errors=True)
+    elif path.exists() or path.is_symlink():
+        path.unlink()
+
+
+class Entry(object):
+    def __init__(self, kind, name, paths, size, mtime):
+        self.__dict__.update(locals())
+        self.accessed = mtime
+        self.hits = 0
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self.kind, self.name)
+
+    def remove(self):
+        # the first path marks the entry as complete, so it goes first
+        for path in self.paths:
+            remove(path)
+
+    def verify(self):
+        # Returns None if the entry looks fine, otherwise what's wrong with it
+        if self.kind == 'qc':
+            if not any(p.suffix == '.dat' for p in self.paths[0].iterdir()):
+                return 'no .dat file'
+        elif self.kind == 'pkg':
+            try:
+                with zipfile.ZipFile(str(self.paths[0])) as pk3:
+                    bad = pk3.testzip()
+            except (zipfile.BadZipfile, OSError) as e:
+                return str(e)
+
+            if bad is not None:
+                return 'corrupted member %r' % bad
+        elif self.kind == 'img':
+            for path in self.paths:
+                if path.exists():
+                    with path.open('rb') as f:
+                        if f.read(2) != b'\xff\xd8':
+                            return '%s is not a JPEG' % path.name
+
+
+def scan(path):
+    # Returns ([Entry], [leftover temporary file]) for the cache in path
+    entries = []
+    leftovers = []
+
+    def add(kind, paths):
+        entries.append(Entry(kind, paths[0].relative_to(path).as_posix(), paths,
+                             sum(tree_size(p) for p in paths), paths[0].stat().st_mtime))
+
+    for dat in sorted((path / 'qc').glob('*')):
+        for entry in sorted(dat.glob('*')):
+            if entry.name.endswith('.tmp'):
+                leftovers.append(entry)
+            elif entry.is_dir():
+                add('qc', [entry])
+
+    for fpath in sorted((path / 'pkg').glob('*')):
+        if fpath.name.endswith('.tmp'):
+            leftovers.append(fpath)
+        elif fpath.suffix == '.pk3':
+            add('pkg', [fpath])
+
+    for fpath in sorted((path / 'img').glob('*/*')):
+        if fpath.name.endswith('.tmp'):
+            leftovers.append(fpath)
+        elif fpath.suffix == '.jpg' and not fpath.stem.endswith('_alpha'):
+            add('img', [fpath, fpath.with_name(fpath.stem + '_alpha.jpg')])
+
+    return entries, leftovers
+
+
+class CacheManager(object):
+    # Keeps track of when each entry in cache_dir was last used and how big
+    # it is, so that the least recently used ones can be evicted to stay
+    # within a size or age budget.
+    #
+    # During a build, uses are only collected in memory; save() writes them to
+    # cache_dir/cache.sqlite3. Entries that were never recorded (e.g. ones
+    # from before this existed) count as last used when they were written.
+    #
+    # With a remote cache (see remote.RemoteCache), fetch() looks up local
+    # misses there, and put() uploads new entries to it.
+
+    def __init__(self, path, remote=None):
+        self.path = path
+        self.remote = remote
+        self._used = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self.path))
+
+    def _name(self, path):
+        return path.relative_to(self.path).as_posix()
+
+    def _lock_path(self, path):
+        return self.path / 'locks' / (self._name(path).replace('/', '_') + '.lock')
+
+    @contextlib.contextmanager
+    def lock(self, path, abort=None, wait=True):
+        # An exclusive lock on the cache entry at path, held against other
+        # threads and other builds sharing this cache_dir. Yields whether it
+        # got the lock, which is always the case if wait is set; abort() is
+        # called while waiting. Without fcntl (Windows), there is no locking.
+        if fcntl is None:
+            yield True
+            return
+
+        lock_path = self._lock_path(path)
+        util.make_directory(lock_path.parent)
+
+        with lock_path.open('a') as f:
+            locked = try_lock(f)
+
+            if not locked and wait:
+                log.info('Waiting for another build to finish with %r', self._name(path))
+
+                while not try_lock(f):
+                    if abort is not None:
+                        abort()
+
+                    time.sleep(LOCK_POLL_INTERVAL)
+
+                locked = True
+
+            try:
+                yield locked
+            finally:
+                if locked:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _remove(self, entry):
+        # Entries in use by a build are left alone; returns whether it was removed
+        with self.lock(entry.paths[0], wait=False) as locked:
+            if locked:
+                entry.remove()
+
+        return locked
+
+    def _remove_stale_locks(self, entries, now):
+        # Lock files of entries that are gone. A build could in theory still
+        # open one just before it's removed and end up not excluding another;
+        # the worst that does is build the same entry twice.
+        if fcntl is None:
+            return
+
+        needed = set(self._lock_path(e.paths[0]).name for e in entries)
+
+        for lock_path in (self.path / 'locks').glob('*.lock'):
+            if lock_path.name in needed or lock_path.stat().st_mtime >= now - TMP_MAX_AGE:
+                continue
+
+            with lock_path.open('a') as f:
+                if try_lock(f):
+                    lock_path.unlink()
+
+    def _count(self, kind, index):
+        with self._lock:
+            counters = self._counters.setdefault(kind, [0, 0])
+            counters[index] += 1
+
+    def _use(self, kind, path, hits):
+        size = tree_size(path)
+
+        if kind == 'img':
+            alpha = path.with_name(path.stem + '_alpha.jpg')
+
+            if alpha.exists():
+                size += alpha.stat().st_size
+
+        with self._lock:
+            name = self._name(path)
+            previous = self._used.get(name)
+            self._used[name] = (kind, size, time.time(), hits + (previous[3] if previous else 0))
+
+    def hit(self, kind, path):
+        self._count(kind, 0)
+        self._use(kind, path, 1)
+
+    def miss(self, kind):
+        self._count(kind, 1)
+
+    def touch(self, kind, path):
+        # used, but not as a cache hit, e.g. a pk3 reused incrementally
+        self._use(kind, path, 0)
+
+    def put(self, kind, path):
+        self._use(kind, path, 0)
+
+        if self.remote is not None:
+            self.remote.store(kind, self._name(path), path)
+
+    def fetch(self, kind, path):
+        # Tries to download an entry missing from cache_dir; returns whether
+        # it's there now. Doesn't count as a hit or a miss by itself.
+        if self.remote is None:
+            return False
+
+        return self.remote.fetch(kind, self._name(path), path)
+
+    def connect(self):
+        db = sqlite3.connect(str(self.path / DB_FILENAME), timeout=30)
+        db.executescript(SCHEMA)
+        return db
+
+    def save(self):
+        with self._lock:
+            used, self._used = self._used, {}
+            counters, self._counters = self._counters, {}
+
+        if not used and not counters:
+            return
+
+        db = self.connect()
+
+        try:
+            with db:
+                db.executemany(
+                    'INSERT INTO entries (name, kind, size, created, accessed, hits) VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (name) DO UPDATE SET size = excluded.size, '
+                    'accessed = max(accessed, excluded.accessed), hits = hits + excluded.hits', [
+                        (name, kind, size, accessed, accessed, hits)
+                            for name, (kind, size, accessed, hits) in used.items()
+                    ]
+                )
+
+                db.executemany(
+                    'INSERT INTO counters (kind, hits, misses) VALUES (?, ?, ?) '
+                    'ON CONFLICT (kind) DO UPDATE SET hits = hits + excluded.hits, '
+                    'misses = misses + excluded.misses', [
+                        (kind, hits, misses) for kind, (hits, misses) in counters.items()
+                    ]
+                )
+        finally:
+            db.close()
+
+        log.debug('Recorded %i cache entry uses in %r', len(used), str(self.path / DB_FILENAME))
+
+    def entries(self, db):
+        # What's actually in the cache, with the recorded uses. Forgets the
+        # recorded entries that no longer exist.
+        entries, leftovers = scan(self.path)
+        recorded = {
+            name: (accessed, hits) for name, accessed, hits in
+                db.execute('SELECT name, accessed, hits FROM entries')
+        }
+
+        for entry in entries:
+            if entry.name in recorded:
+                entry.accessed, entry.hits = recorded.pop(entry.name)
+
+        if recorded:
+            with db:
+                db.executemany('DELETE FROM entries WHERE name = ?', [(name,) for name in recorded])
+
+        return entries, leftovers
+
+    def plan_gc(self, entries, max_size=None, max_age=None, keep_after=None, now=None):
+        # The entries to evict, least recently used first. max_age is in days.
+        # Entries used after keep_after (a timestamp) are never evicted.
+        if now is None:
+            now = time.time()
+
+        candidates = sorted(entries, key=lambda e: e.accessed)
+        evict = []
+
+        if keep_after is not None:
+            candidates = [e for e in candidates if e.accessed < keep_after]
+
+        if max_age is not None:
+            evict = [e for e in candidates if e.accessed < now - max_age * 86400]
+            candidates = candidates[len(evict):]
+
+        if max_size is not None:
+            total = sum(e.size for e in entries) - sum(e.size for e in evict)
+
+            for entry in candidates:
+                if total <= max_size:
+                    break
+
+                evict.append(entry)
+                total -= entry.size
+
+        return evict
+
+    def gc(self, max_size=None, max_age=None, keep_after=None, dry_run=False):
+        # Returns the entries and leftover files that were (or would be) removed,
+        # the latter as {path: size}
+        now = time.time()
+        db = self.connect()
+
+        try:
+            entries, leftovers = self.entries(db)
+            evict = self.plan_gc(entries, max_size, max_age, keep_after, now)
+            leftovers = {p: tree_size(p) for p in leftovers if p.stat().st_mtime < now - TMP_MAX_AGE}
+
+            if dry_run:
+                return evict, leftovers
+
+            for entry in list(evict):
+                log.debug('Evicting %r, last used %s', entry.name, time.ctime(entry.accessed))
+
+                if not self._remove(entry):
+                    log.debug('%r is in use, not evicting it', entry.name)
+                    evict.remove(entry)
+
+            for path in leftovers:
+                log.debug('Removing leftover %r', str(path))
+                remove(path)
+
+            self._remove_stale_locks([e for e in entries if e not in evict], now)
+
+            with db:
+                db.executemany('DELETE FROM entries WHERE name = ?', [(e.name,) for e in evict])
+        finally:
+            db.close()
+
+        if evict or leftovers:
+            log.info('Removed %i cache entries (%s) and %i leftover files (%s) from %r',
+                     len(evict), util.format_size(sum(e.size for e in evict)),
+                     len(leftovers), util.format_size(sum(leftovers.values())), str(self.path))
+
+        return evict, leftovers
+
+    def verify(self, fix=False):
+        # Returns [(Entry, problem)]
+        db = self.connect()
+
+        try:
+            entries, leftovers = self.entries(db)
+            broken = []
+
+            for entry in entries:
+                problem = entry.verify()
+
+                if problem is not None:
+                    broken.append((entry, problem))
+
+            if fix:
+                for entry, problem in broken:
+                    log.info('Removing %r: %s', entry.name, problem)
+
+                    if not self._remove(entry):
+                        log.warning('%r is in use, not removing it', entry.name)
+
+                with db:
+                    db.executemany('DELETE FROM entries WHERE name = ?', [(e.name,) for e, problem in broken])
+        finally:
+            db.close()
+
+        return broken
+
+    def clear(self, kinds=KINDS):
+        db = self.connect()
+
+        try:
+            entries, leftovers = self.entries(db)
+            entries = [e for e in entries if e.kind in kinds and self._remove(e)]
+
+            with db:
+                db.executemany('DELETE FROM entries WHERE name = ?', [(e.name,) for e in entries])
+                db.executemany('DELETE FROM counters WHERE kind = ?', [(kind,) for kind in kinds])
+        finally:
+            db.close()
+
+        return entries
+
+    def stats(self):
+        # {kind: {'entries', 'size', 'hits', 'misses'}}, plus the leftovers
+        db = self.connect()
+
+        try:
+            entries, leftovers = self.entries(db)
+            counters = {kind: (hits, misses) for kind, hits, misses in
+                            db.execute('SELECT kind, hits, misses FROM counters')}
+        finally:
+            db.close()
+
+        stats = {}
+
+        for kind in KINDS:
+            hits, misses = counters.get(kind, (0, 0))
+            stats[kind] = {
+                'entries': len([e for e in entries if e.kind == kind]),
+                'size': sum(e.size for e in entries if e.kind == kind),
+                'hits': hits,
+                'misses': misses,
+            }
+
+        return stats, entries, leftovers
@@ -42,7 +42,8 @@ def apply(fpath, repo, argv):
     }
 
     misc_options = {
-        'hash_function': cfg.get('hash_function', util.HASH_FUNCTION)
+        'hash_function': cfg.get('hash_function', util.HASH_FUNCTION),
+        'hash_method': cfg.get('hash_method', util.HASH_METHOD),
     }
 
     return build_args, install_options, misc_options
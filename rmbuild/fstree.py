@@ -0,0 +1,150 @@
+import os
+import pathlib
+import stat
+import threading
+
+from .compat import *
+from .errors import *
+
+from . import util
+
+log = util.logger(__name__)
+
+
+class Entry(object):
+    __slots__ = ('path', 'relpath', 'stat', 'is_dir', 'is_symlink', '_children')
+
+    def __init__(self, path, relpath, st, is_symlink):
+        self.path = path
+        self.relpath = relpath
+        self.stat = st
+        self.is_dir = stat.S_ISDIR(st.st_mode)
+        self.is_symlink = is_symlink
+        self._children = None
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.relpath)
+
+    @property
+    def name(self):
+        return self.path.name
+
+    @property
+    def suffix(self):
+        return self.path.suffix
+
+    @property
+    def is_file(self):
+        return stat.S_ISREG(self.stat.st_mode)
+
+    def scan(self):
+        children = []
+
+        for dentry in os.scandir(str(self.path)):
+            is_symlink = dentry.is_symlink()
+
+            try:
+                st = dentry.stat()
+            except FileNotFoundError:
+                # dangling symlink
+                st = dentry.stat(follow_symlinks=False)
+
+            if self.relpath == '.':
+                relpath = dentry.name
+            else:
+                relpath = self.relpath + '/' + dentry.name
+
+            child = Entry(self.path / dentry.name, relpath, st, is_symlink)
+            children.append(child)
+
+            # symlinked directories are only scanned if someone asks for them
+            if child.is_dir and not is_symlink:
+                child.scan()
+
+        self._children = children
+
+    def iterdir(self):
+        # Entries come in the same order as pathlib.Path.iterdir() would list them
+        if not self.is_dir:
+            raise PathError(self.path, "Not a directory")
+
+        if self._children is None:
+            self.scan()
+
+        return iter(self._children)
+
+    def walk(self, follow_symlinks=False):
+        for child in self.iterdir():
+            yield child
+
+            if child.is_dir and (follow_symlinks or not child.is_symlink):
+                for sub in child.walk(follow_symlinks):
+                    yield sub
+
+
+class Tree(object):
+    def __init__(self, root):
+        root = util.directory(root)
+        self.root = Entry(root, '.', os.stat(str(root)), root.is_symlink())
+        self.root.scan()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self.root.path))
+
+    def walk(self, follow_symlinks=False):
+        return self.root.walk(follow_symlinks)
+
+    def get(self, relpath):
+        entry = self.root
+
+        for part in pathlib.PurePath(relpath).parts:
+            if part == '.':
+                continue
+
+            if not entry.is_dir:
+                return None
+
+            for child in entry.iterdir():
+                if child.path.name == part:
+                    entry = child
+                    break
+            else:
+                return None
+
+        return entry
+
+
+class Snapshot(object):
+    # Per-build cache of directory trees that are not expected to change while
+    # the build is running (i.e. the sources, not the outputs).
+
+    def __init__(self):
+        self.trees = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def tree(self, path):
+        key = os.path.abspath(str(path))
+
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        with lock:
+            try:
+                return self.trees[key]
+            except KeyError:
+                pass
+
+            log.debug('Scanning %r', key)
+            tree = Tree(key)
+            self.trees[key] = tree
+            return tree
+
+    def invalidate(self, path):
+        self.trees.pop(os.path.abspath(str(path)), None)
+
+
+def scan(path, snapshot=None):
+    if snapshot is None:
+        return Tree(path)
+    return snapshot.tree(path)
@@ -0,0 +1,305 @@
+import binascii
+import gzip
+import json
+import multiprocessing
+import os
+import threading
+
+from concurrent import futures
+
+from .compat import *
+
+from . import util
+from . import fstree
+from . import trace
+from . import report
+
+log = util.logger(__name__)
+
+CACHE_FILENAME = 'hashcache.json.gz'
+CACHE_FORMAT = 1
+CHUNK_SIZE = 1 << 20
+
+MERKLE_FILE = b'f'
+MERKLE_DIR = b'd'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# A read-only stand-in for a hashlib object whose digest came from the cache
+class StaticHash(object):
+    def __init__(self, name, hexdigest):
+        self.name = name
+        self._hexdigest = hexdigest
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self.name, self._hexdigest)
+
+    def hexdigest(self):
+        return self._hexdigest
+
+    def digest(self):
+        return binascii.unhexlify(self._hexdigest.encode('ascii'))
+
+    def copy(self):
+        return self
+
+
+class HashCache(object):
+    # Every path maps to a single entry, so the cache grows with the number of
+    # distinct paths, not with the number of changes made to them.
+
+    def __init__(self, path=None, rehash=False):
+        self.path = path
+        self.rehash = rehash
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+
+        if path is not None and not rehash:
+            self.load()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self.path) if self.path else None)
+
+    def load(self):
+        try:
+            with gzip.open(str(self.path), 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            log.warning('Hash cache %r is corrupted, starting over', str(self.path))
+            return
+
+        if data.get('format') != CACHE_FORMAT:
+            log.debug('Ignoring hash cache %r with unknown format %r', str(self.path), data.get('format'))
+            return
+
+        self.entries = data['entries']
+        log.debug('Loaded %i entries from hash cache %r', len(self.entries), str(self.path))
+
+    def save(self):
+        if self.path is None or not self._dirty:
+            return
+
+        with self._lock:
+            data = json.dumps({
+                'format': CACHE_FORMAT,
+                'entries': self.entries,
+            }, sort_keys=True).encode('utf-8')
+            self._dirty = False
+
+        tmp = self.path.with_name('%s.%i.tmp' % (self.path.name, os.getpid()))
+
+        with gzip.open(str(tmp), 'wb') as f:
+            f.write(data)
+
+        tmp.replace(self.path)
+        log.debug('Saved %i entries to hash cache %r', len(self.entries), str(self.path))
+
+    def get(self, kind, path, key):
+        with self._lock:
+            entry = self.entries.get('%s:%s' % (kind, path))
+
+            if entry is not None and entry[:-1] == key:
+                self.hits += 1
+                return entry[-1]
+
+            self.misses += 1
+
+    def put(self, kind, path, key, value):
+        with self._lock:
+            self.entries['%s:%s' % (kind, path)] = list(key) + [value]
+            self._dirty = True
+
+
+def entry_name(entry, root):
+    name = entry.path.relative_to(root).as_posix()
+
+    if entry.is_dir:
+        name += '/'
+
+    return name
+
+
+def tree_manifest(entry, root, namefilter=None):
+    # Same traversal as util.hash_path, but only looks at the stat data
+    h = util.hash_constructor()
+
+    def recurse(entry):
+        name = entry_name(entry, root)
+
+        if namefilter is not None and not namefilter(name):
+            return
+
+        h.update(name.encode('utf-8'))
+
+        if entry.is_dir:
+            for child in entry.iterdir():
+                recurse(child)
+        else:
+            st = entry.stat
+            h.update(('\0%i:%i:%i\0' % (st.st_size, st.st_mtime_ns, st.st_ino)).encode('utf-8'))
+
+    recurse(entry)
+    return h.hexdigest()
+
+
+def legacy_hash(entry, hashobject, root, namefilter=None):
+    # util.hash_path() over a snapshot entry; the digest is identical
+    name = entry_name(entry, root)
+
+    if namefilter is not None and not namefilter(name):
+        return hashobject
+
+    hashobject.update(name.encode('utf-8'))
+
+    if entry.is_dir:
+        for child in entry.iterdir():
+            legacy_hash(child, hashobject, root, namefilter)
+    else:
+        with open(str(entry.path), 'rb') as f:
+            for chunk in util.read_in_chunks(f, CHUNK_SIZE):
+                hashobject.update(chunk)
+
+        trace.current().add('bytes', entry.stat.st_size)
+        report.count('bytes_hashed', entry.stat.st_size)
+
+    return hashobject
+
+
+def executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = futures.ThreadPoolExecutor(multiprocessing.cpu_count())
+        return _executor
+
+
+def file_digest(path, cache=None, st=None):
+    path = str(path)
+
+    if st is None:
+        st = os.stat(path)
+
+    key = [util.HASH_FUNCTION, st.st_size, st.st_mtime_ns, st.st_ino]
+
+    if cache is not None:
+        hexdigest = cache.get('file', path, key)
+        if hexdigest is not None:
+            return hexdigest
+
+    h = util.hash_constructor()
+
+    with trace.span('digest %s' % path, 'hash', bytes=st.st_size):
+        with open(path, 'rb') as f:
+            for chunk in util.read_in_chunks(f, CHUNK_SIZE):
+                h.update(chunk)
+
+    hexdigest = h.hexdigest()
+    report.count('bytes_hashed', st.st_size)
+
+    if cache is not None:
+        cache.put('file', path, key, hexdigest)
+
+    return hexdigest
+
+
+def merkle_digest(entry, root, namefilter=None, cache=None):
+    # Directory entries are sorted by name, so the result doesn't depend on the
+    # filesystem. File contents are digested concurrently (hashlib releases the
+    # GIL), and only files whose stat data changed are actually read.
+
+    pool = executor()
+
+    def scan(entry):
+        nodes = []
+
+        for child in sorted(entry.iterdir(), key=lambda e: e.name):
+            name = entry_name(child, root)
+
+            if namefilter is not None and not namefilter(name):
+                continue
+
+            if child.is_dir:
+                nodes.append((MERKLE_DIR, child.name, scan(child)))
+            else:
+                nodes.append((MERKLE_FILE, child.name, pool.submit(file_digest, child.path, cache, child.stat)))
+
+        return nodes
+
+    def combine(nodes):
+        h = util.hash_constructor()
+
+        for kind, name, node in nodes:
+            if kind == MERKLE_DIR:
+                digest = combine(node).digest()
+            else:
+                digest = binascii.unhexlify(node.result().encode('ascii'))
+
+            h.update(kind + name.encode('utf-8') + b'\0' + digest)
+
+        return h
+
+    return combine(scan(entry))
+
+
+def hash_path(path, hashobject=None, root=None, namefilter=None, cache=None, snapshot=None):
+    # util.hash_path() for a directory, using the configured util.HASH_METHOD
+
+    if util.HASH_METHOD not in ('legacy', 'merkle'):
+        raise ValueError("Unknown hash method %r, expected 'legacy' or 'merkle'" % util.HASH_METHOD)
+
+    entry = fstree.scan(path, snapshot).root
+
+    if root is None:
+        root = entry.path
+
+    if hashobject is None:
+        h = util.hash_constructor()
+    else:
+        h = hashobject
+
+    if util.HASH_METHOD == 'legacy':
+        return legacy_hash(entry, h, root, namefilter)
+
+    name = entry.path.relative_to(root).as_posix()
+    h.update(name.encode('utf-8') + b'\0')
+    h.update(merkle_digest(entry, root, namefilter=namefilter, cache=cache).digest())
+    return h
+
+
+def hash_tree(path, namefilter=None, suffix=b'', cache=None, snapshot=None):
+    # hash_path() followed by update(suffix).
+    #
+    # Merkle digests are cached per file. Legacy digests are served from the
+    # cache if nothing in the tree has been touched since it was last hashed;
+    # they must stay identical to the uncached ones, so any change inside the
+    # tree still means re-reading all of it.
+
+    with trace.span('hash %s' % path, 'hash', method=util.HASH_METHOD) as span:
+        if cache is None or util.HASH_METHOD != 'legacy':
+            h = hash_path(path, namefilter=namefilter, cache=cache, snapshot=snapshot)
+            h.update(suffix)
+            return h
+
+        entry = fstree.scan(path, snapshot).root
+        key = [util.HASH_FUNCTION, tree_manifest(entry, entry.path, namefilter=namefilter), suffix.decode('latin-1')]
+        hexdigest = cache.get('tree', entry.path, key)
+
+        if hexdigest is not None:
+            log.debug('Hash cache hit for %r', str(entry.path))
+            span.set(cache='hit')
+            return StaticHash(util.HASH_FUNCTION, hexdigest)
+
+        log.debug('Hash cache miss for %r', str(entry.path))
+        span.set(cache='miss')
+        h = legacy_hash(entry, util.hash_constructor(), entry.path, namefilter)
+        h.update(suffix)
+        cache.put('tree', entry.path, key, h.hexdigest())
+        return h
@@ -0,0 +1,250 @@
+import os
+import threading
+import time
+
+from concurrent import futures
+
+from .compat import *
+
+from . import util
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = util.logger(__name__)
+
+# How often a package waiting for its images checks whether the build failed
+POLL_INTERVAL = 0.25
+
+# Images are sent to the workers in batches of this many
+BATCH_SIZE = 8
+
+# Bump this if the conversion itself changes
+CACHE_KEY_VERSION = 1
+
+
+def pil_version():
+    import PIL
+    return getattr(PIL, '__version__', None) or getattr(PIL, 'PILLOW_VERSION', 'unknown')
+
+
+class ImageCache(object):
+    # Converted JPEGs, addressed by the digest of the source image, the JPEG
+    # quality and the PIL version. Shared by all packages, branches and builds.
+
+    def __init__(self, path, manager=None, hardlink=False):
+        self.path = util.make_directory(path)
+        self.manager = manager
+        self.hardlink = hardlink
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pil_version = pil_version()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self.path))
+
+    def key(self, src_digest, quality):
+        h = util.hash_constructor()
+        h.update(('%i:%s:%i:%s' % (CACHE_KEY_VERSION, src_digest, quality, self._pil_version)).encode('utf-8'))
+        return h.hexdigest()
+
+    def paths(self, key):
+        d = self.path / key[:2]
+        return d / (key + '.jpg'), d / (key + '_alpha.jpg')
+
+    def get(self, key, dst=None, alpha_dst=None):
+        # Returns None on a miss, otherwise whether there is an alpha JPEG.
+        # Copies keep the cached timestamps, so the pk3 members stay reusable.
+        jpeg, alpha = self.paths(key)
+
+        try:
+            if not jpeg.is_file() and not (self.manager is not None and self.manager.fetch('img', jpeg)):
+                raise FileNotFoundError(str(jpeg))
+
+            # the alpha JPEG is published first, see put()
+            has_alpha = alpha.is_file()
+
+            if dst is not None:
+                util.copy(jpeg, dst, hardlink=self.hardlink, preserve_times=True)
+
+                if has_alpha and alpha_dst is not None:
+                    util.copy(alpha, alpha_dst, hardlink=self.hardlink, preserve_times=True)
+        except FileNotFoundError:
+            # also when evicted by 'rmbuild cache gc' while being read
+            with self._lock:
+                self.misses += 1
+
+            if self.manager is not None:
+                self.manager.miss('img')
+
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        if self.manager is not None:
+            self.manager.hit('img', jpeg)
+
+        return has_alpha
+
+    def put(self, key, dst, alpha_dst, has_alpha):
+        jpeg, alpha = self.paths(key)
+        util.make_directory(jpeg.parent)
+
+        def publish(src, target):
+            tmp = target.with_name('%s.%i.%i.tmp' % (target.name, os.getpid(), threading.get_ident()))
+            util.copy(src, tmp, hardlink=self.hardlink, preserve_times=True)
+            tmp.replace(target)
+
+        if has_alpha:
+            publish(alpha_dst, alpha)
+
+        # the colour JPEG marks the entry as complete, so it goes last
+        publish(dst, jpeg)
+
+        if self.manager is not None:
+            self.manager.put('img', jpeg)
+
+
+class ConvertJob(object):
+    # dst and alpha_dst may be None, in which case the image is only inspected
+    def __init__(self, src, dst, alpha_dst, quality):
+        self.__dict__.update(locals())
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.src)
+
+
+def alpha_stats(alpha):
+    if numpy is not None:
+        a = numpy.asarray(alpha)
+        return {
+            'alpha_min': int(a.min()),
+            'alpha_max': int(a.max()),
+            'alpha_mean': float(a.mean()),
+            'translucent': float(numpy.count_nonzero(a < 255)) / a.size,
+        }
+
+    # same thing from PIL's histogram, if numpy is not available
+    hist = alpha.histogram()
+    total = float(sum(hist)) or 1.0
+    used = [value for value, count in enumerate(hist) if count]
+
+    return {
+        'alpha_min': used[0],
+        'alpha_max': used[-1],
+        'alpha_mean': sum(value * count for value, count in enumerate(hist)) / total,
+        'translucent': (total - hist[255]) / total,
+    }
+
+
+def convert_image(job):
+    from PIL import Image
+
+    start = time.time()
+    save_jpeg = lambda i, p: i.convert('RGB').save(p, format='JPEG', quality=job.quality, optimize=True)
+
+    img = Image.open(job.src)
+    img.load()
+
+    stats = {
+        'mode': img.mode,
+        'width': img.size[0],
+        'height': img.size[1],
+        'src_size': os.path.getsize(job.src),
+        'decode_src': time.time() - start,
+        'has_alpha': False,
+        'cached': False,
+    }
+
+    if job.dst is not None:
+        save_jpeg(img, job.dst)
+        stats['jpeg_size'] = os.path.getsize(job.dst)
+
+    if img.mode in ('RGBA', 'LA'):
+        alpha = img.split()[-1]
+        stats.update(alpha_stats(alpha))
+
+        if stats['alpha_min'] < 255:
+            stats['has_alpha'] = True
+
+            if job.alpha_dst is not None:
+                save_jpeg(alpha, job.alpha_dst)
+                stats['alpha_size'] = os.path.getsize(job.alpha_dst)
+
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def convert_batch(jobs):
+    return [convert_image(job) for job in jobs]
+
+
+def cached_stats(src, dst, alpha_dst, has_alpha):
+    stats = {
+        'src_size': os.path.getsize(str(src)),
+        'jpeg_size': os.path.getsize(str(dst)),
+        'has_alpha': has_alpha,
+        'cached': True,
+        'seconds': 0.0,
+    }
+
+    if has_alpha:
+        stats['alpha_size'] = os.path.getsize(str(alpha_dst))
+
+    return stats
+
+
+def decide(stats, min_saving=0.0):
+    # Returns 'keep' if the conversion doesn't save at least min_saving of the
+    # original size, otherwise 'jpeg' or 'jpeg+alpha'. Only sizes count:
+    # timings vary from run to run and aren't known for cached conversions.
+
+    if 'jpeg_size' in stats:
+        size = stats['jpeg_size'] + stats.get('alpha_size', 0)
+
+        if size > stats['src_size'] * (1 - min_saving):
+            return 'keep'
+
+    if stats['has_alpha']:
+        return 'jpeg+alpha'
+
+    return 'jpeg'
+
+
+def convert_images(pool, jobs, abort=None):
+    # Returns the statistics of every job, in order.
+    # The jobs run in batches on the shared process pool if there is one.
+    # Whatever hasn't started yet is cancelled as soon as abort() raises.
+
+    if pool is None:
+        results = []
+
+        for job in jobs:
+            if abort is not None:
+                abort()
+            results.append(convert_image(job))
+
+        return results
+
+    pending = [pool.submit(convert_batch, jobs[i:i + BATCH_SIZE]) for i in range(0, len(jobs), BATCH_SIZE)]
+    not_done = set(pending)
+
+    try:
+        while not_done:
+            done, not_done = futures.wait(not_done, timeout=POLL_INTERVAL, return_when=futures.FIRST_EXCEPTION)
+
+            for future in done:
+                future.result()
+
+            if abort is not None:
+                abort()
+    except BaseException:
+        for future in not_done:
+            future.cancel()
+        raise
+
+    return [stats for future in pending for stats in future.result()]
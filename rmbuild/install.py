@@ -6,26 +6,21 @@ import functools
 from .compat import *
 
 from . import util
+from . import fstree
+from . import trace
 
 log = util.logger(__name__)
 
 INDEX_FILENAME = '.rmbuild_index'
 
 
-def build_index(path):
-    path = util.directory(path)
-    index = []
-
-    def recurse(path):
-        for fpath in path.iterdir():
-            if fpath.is_file() or fpath.is_symlink():
-                index.append(fpath)
-            elif fpath.is_dir():
-                recurse(fpath)
-
-    recurse(path)
-    index = sorted(map(lambda p: p.relative_to(path), index))
-    return index
+def build_index(path, snapshot=None):
+    tree = fstree.scan(path, snapshot)
+    index = [
+        pathlib.Path(entry.relpath) for entry in tree.walk()
+            if entry.is_file or entry.is_symlink
+    ]
+    return sorted(index)
 
 
 def open_index(path, mode):
@@ -83,18 +78,25 @@ def remove_old_files(path):
             log.debug('Removed empty directory %r', str(d))
 
 
-def copy_by_index(index, src, dst, link=False):
+def copy_by_index(index, src, dst, link=False, hardlink=False):
     src = util.directory(src).resolve()
     dst = util.directory(dst).resolve()
 
     for d in index_directories(index):
         util.make_directory(dst / d)
 
+    span = trace.current()
+
     for f in index:
         if link:
             (dst / f).symlink_to(src / f)
         else:
-            util.copy(src / f, dst / f)
+            util.copy(src / f, dst / f, hardlink=hardlink)
+
+            if trace.enabled():
+                span.add('bytes', (dst / f).stat().st_size)
+
+    span.add('files', len(index))
 
 
 link_by_index = functools.partial(copy_by_index, link=True)
@@ -110,8 +112,9 @@ def install(build_info, path, link=False, pathfilter=None):
 
     log.info("Installing to %r (%s)", str(path), 'link' if link else 'copy')
 
-    path = util.directory(path)
-    remove_old_files(path)
-    index = list(filter(pathfilter, build_index(build_info.output_dir)))
-    write_index(index, path)
-    copy_by_index(index, build_info.output_dir, path, link=link)
+    with trace.span('install %s' % path, 'install', link=link):
+        path = util.directory(path)
+        remove_old_files(path)
+        index = list(filter(pathfilter, build_index(build_info.output_dir)))
+        write_index(index, path)
+        copy_by_index(index, build_info.output_dir, path, link=link, hardlink=build_info.use_hardlinks)
@@ -2,6 +2,7 @@
 import logging
 import argparse
 import pathlib
+import time
 
 from .compat import *
 
@@ -9,6 +10,10 @@ from . import config
 from . import build
 from . import util
 from . import errors
+from . import trace
+from . import perf
+from . import cache
+from . import remote
 
 log = util.logger(__name__)
 
@@ -27,6 +32,9 @@ def parse_args(argv, defaults_overrides=None):
         prog=argv[0],
         fromfile_prefix_chars='@',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog="Other commands: %s. Run '%s <command> -h' for their usage." % (
+            ', '.join(sorted(SUBCOMMANDS)), argv[0]
+        ),
         add_help=False
     )
 
@@ -62,6 +70,58 @@ def parse_args(argv, defaults_overrides=None):
              "If caching is in use, the cached versions will be updated."
     )
 
+    p.add_argument(
+        '--rehash',
+        action='store_true',
+        help="Ignore the persistent hash cache and re-read every file.\n"
+             "The cache will be rebuilt from scratch."
+    )
+
+    p.add_argument(
+        '--trace',
+        metavar='FILE',
+        type=pathlib.Path,
+        help="Record what the build spends its time on and write it to FILE\n"
+             "in the Chrome trace event format (chrome://tracing, Perfetto)."
+    )
+
+    p.add_argument(
+        '--profile',
+        action='store_true',
+        help="Profile every build stage and task with cProfile and write\n"
+             "a .pstats file for each one to the profile directory."
+    )
+
+    p.add_argument(
+        '--profile-memory',
+        action='store_true',
+        help="Trace memory allocations with tracemalloc and write the top\n"
+             "allocation sites of every stage and task to the profile directory."
+    )
+
+    p.add_argument(
+        '--profile-dir',
+        metavar='DIR',
+        type=pathlib.Path,
+        help="Where --profile and --profile-memory write their results.\n"
+             "Defaults to <output_dir>-profile."
+    )
+
+    p.add_argument(
+        '--remote-cache',
+        metavar='URL',
+        help="Share cached QC modules, pk3s and textures through this remote\n"
+             "cache (see 'cache-server'), overriding remote_cache from the config."
+    )
+
+    p.add_argument(
+        '--no-remote-push',
+        action='store_false',
+        dest='remote_cache_push',
+        default=None,
+        help="Only download from the remote cache, don't upload to it."
+    )
+
     p.add_argument(
         'config',
         nargs='?',
@@ -96,25 +156,401 @@ def parse_args(argv, defaults_overrides=None):
     return p.parse_args(args=argv[1:])
 
 
+def subcommand_parser(argv, command, description, defaults_overrides=None):
+    # The options shared by all subcommands. They only need the repository
+    # and the config to find out where the cache is.
+    defaults = {
+        'path': '.',
+        'git': 'git',
+        'config': 'config.py',
+    }
+
+    if defaults_overrides is not None:
+        defaults.update(defaults_overrides)
+
+    p = argparse.ArgumentParser(
+        prog='%s %s' % (argv[0], command),
+        description=description,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    p.add_argument(
+        '-p', '--path',
+        default=defaults['path'],
+        help="Path to the RocketMinsta git repository (working tree)."
+    )
+
+    p.add_argument(
+        '-g', '--git',
+        default=defaults['git'],
+        help="The git executable to use."
+    )
+
+    p.add_argument(
+        '-c', '--config',
+        default=defaults['config'],
+        help="Path to the build configuration file, relative to the repository."
+    )
+
+    p.add_argument(
+        '--cache-dir',
+        type=pathlib.Path,
+        help="Use this cache directory instead of the one from the configuration."
+    )
+
+    p.add_argument(
+        '-v', '--verbose',
+        action='store_const',
+        const=logging.DEBUG,
+        default=logging.INFO,
+        help="Be noisy.",
+        dest='log_level'
+    )
+
+    return p
+
+
+def find_cache_dir(args):
+    # Returns the cache directory and the build arguments from the
+    # configuration, which isn't read at all if --cache-dir is given.
+    if args.cache_dir is not None:
+        return util.directory(args.cache_dir).resolve(), {}
+
+    util.GIT_EXECUTABLE = args.git
+    path = util.directory(args.path).resolve()
+
+    with util.in_dir(path):
+        repo = build.Repo(path)
+        build_args = config.apply(util.file(args.config).resolve(), repo, [])[0]
+
+        if build_args.get('cache_dir') is None:
+            raise errors.RMBuildError("The configuration doesn't set cache_dir, use --cache-dir")
+
+        return util.directory(build_args['cache_dir']).resolve(), build_args
+
+
+def perf_main(argv, defaults_overrides=None):
+    p = subcommand_parser(argv, 'perf', "Compare the latest build's performance with the ones before it. "
+                                        "Exits with status 1 if any stage got slower.", defaults_overrides)
+
+    p.add_argument(
+        '--baseline',
+        type=int,
+        default=perf.DEFAULT_BASELINE,
+        help="Compare against the median of this many earlier builds of the same configuration on this host."
+    )
+
+    p.add_argument(
+        '--threshold',
+        type=float,
+        default=perf.DEFAULT_THRESHOLD,
+        help="Flag stages that got slower by more than this fraction of the baseline."
+    )
+
+    p.add_argument(
+        '--min-seconds',
+        type=float,
+        default=perf.DEFAULT_MIN_SECONDS,
+        help="Ignore slowdowns smaller than this many seconds."
+    )
+
+    p.add_argument(
+        '--build',
+        type=int,
+        help="Compare this build instead of the latest one."
+    )
+
+    p.add_argument(
+        '--list',
+        action='store_true',
+        help="List the recorded builds instead."
+    )
+
+    args = p.parse_args(argv[2:])
+    logging.basicConfig(level=args.log_level)
+
+    history = perf.PerfHistory(find_cache_dir(args)[0] / perf.DB_FILENAME)
+
+    try:
+        if args.list:
+            for b in history.builds():
+                print('%5i  %s  %-24s %-16s %s  %8.3fs' % (
+                    b['id'], b['date'], b['rm_version'], b['host'], b['config_hash'][:8], b['wall']
+                ))
+            return 0
+
+        latest, comparisons = history.compare(args.build, args.baseline, args.threshold, args.min_seconds)
+    finally:
+        history.close()
+
+    if latest is None:
+        log.info("No builds recorded yet")
+        return 0
+
+    print(perf.format_comparison(latest, comparisons))
+
+    if any(c.regressed for c in comparisons):
+        return 1
+
+    return 0
+
+
+def cache_main(argv, defaults_overrides=None):
+    p = subcommand_parser(argv, 'cache', "Inspect and clean up the build cache. "
+                                         "'verify' exits with status 1 if it finds broken entries.",
+                          defaults_overrides)
+
+    p.add_argument(
+        'action',
+        choices=('stats', 'gc', 'verify', 'clear'),
+        help="stats: sizes, hit rates and how much gc would remove; "
+             "gc: evict the least recently used entries to fit the budget; "
+             "verify: look for broken entries; "
+             "clear: remove all entries."
+    )
+
+    p.add_argument(
+        '--max-size',
+        type=util.parse_size,
+        help="Size budget, e.g. 10G. Defaults to cache_max_size from the configuration."
+    )
+
+    p.add_argument(
+        '--max-age',
+        type=float,
+        help="Evict entries not used in this many days. Defaults to cache_max_age from the configuration."
+    )
+
+    p.add_argument(
+        '-n', '--dry-run',
+        action='store_true',
+        help="gc: only list what would be removed."
+    )
+
+    p.add_argument(
+        '--fix',
+        action='store_true',
+        help="verify: remove the broken entries."
+    )
+
+    p.add_argument(
+        '--kind',
+        action='append',
+        choices=cache.KINDS,
+        help="clear: only remove entries of this kind. Can be given more than once."
+    )
+
+    args = p.parse_args(argv[2:])
+    logging.basicConfig(level=args.log_level)
+
+    cache_dir, build_args = find_cache_dir(args)
+    manager = cache.CacheManager(cache_dir)
+    max_size = args.max_size
+    max_age = args.max_age
+
+    if max_size is None and build_args.get('cache_max_size') is not None:
+        max_size = util.parse_size(build_args['cache_max_size'])
+
+    if max_age is None:
+        max_age = build_args.get('cache_max_age')
+
+    def budget():
+        return ', '.join(filter(None, [
+            'max size %s' % util.format_size(max_size) if max_size is not None else None,
+            'max age %g days' % max_age if max_age is not None else None,
+        ])) or 'no budget'
+
+    if args.action == 'stats':
+        stats, entries, leftovers = manager.stats()
+        evict = manager.plan_gc(entries, max_size, max_age)
+
+        print('Cache %r (%s)' % (str(cache_dir), budget()))
+        print()
+        print('%-6s %8s %12s %8s %8s %9s' % ('kind', 'entries', 'size', 'hits', 'misses', 'hit rate'))
+
+        for kind in cache.KINDS:
+            s = stats[kind]
+            lookups = s['hits'] + s['misses']
+            print('%-6s %8i %12s %8i %8i %9s' % (
+                kind, s['entries'], util.format_size(s['size']), s['hits'], s['misses'],
+                '%.0f%%' % (100.0 * s['hits'] / lookups) if lookups else '-'
+            ))
+
+        print('%-6s %8i %12s' % ('total', len(entries), util.format_size(sum(e.size for e in entries))))
+        print()
+        print('Reclaimable: %i entries (%s) over budget, %i leftover temporary files (%s)' % (
+            len(evict), util.format_size(sum(e.size for e in evict)),
+            len(leftovers), util.format_size(sum(cache.tree_size(p) for p in leftovers)),
+        ))
+        return 0
+
+    if args.action == 'gc':
+        if max_size is None and max_age is None:
+            log.warning("No budget set, only removing leftover temporary files. "
+                        "Use --max-size/--max-age or set cache_max_size/cache_max_age.")
+
+        evict, leftovers = manager.gc(max_size, max_age, dry_run=args.dry_run)
+
+        if args.dry_run:
+            for entry in evict:
+                print('%s  %10s  %s' % (time.strftime('%F %T', time.localtime(entry.accessed)),
+                                        util.format_size(entry.size), entry.name))
+
+            for path, size in leftovers.items():
+                print('%-19s  %10s  %s' % ('leftover', util.format_size(size),
+                                           path.relative_to(cache_dir).as_posix()))
+
+        print('%s %i entries (%s) and %i leftover files (%s), %s' % (
+            'Would remove' if args.dry_run else 'Removed', len(evict), util.format_size(sum(e.size for e in evict)),
+            len(leftovers), util.format_size(sum(leftovers.values())), budget()
+        ))
+        return 0
+
+    if args.action == 'verify':
+        broken = manager.verify(fix=args.fix)
+
+        for entry, problem in broken:
+            print('%s: %s' % (entry.name, problem))
+
+        if not broken:
+            log.info('No broken entries')
+            return 0
+
+        if args.fix:
+            log.info('Removed %i broken entries', len(broken))
+            return 0
+
+        return 1
+
+    if args.action == 'clear':
+        entries = manager.clear(args.kind or cache.KINDS)
+        print('Removed %i entries (%s)' % (len(entries), util.format_size(sum(e.size for e in entries))))
+        return 0
+
+
+def cache_server_main(argv, defaults_overrides=None):
+    # doesn't need a repository, so none of the usual subcommand options
+    p = argparse.ArgumentParser(
+        prog='%s cache-server' % argv[0],
+        description="Serve a directory as a remote build cache over HTTP, for the remote_cache option. "
+                    "There is no authentication; only expose it to networks you trust.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    p.add_argument(
+        'path',
+        type=pathlib.Path,
+        help="Where to store the cached entries. Created if it doesn't exist."
+    )
+
+    p.add_argument(
+        '-b', '--bind',
+        default='localhost',
+        help="Address to listen on. Use 0.0.0.0 for all interfaces."
+    )
+
+    p.add_argument(
+        '--port',
+        type=int,
+        default=remote.DEFAULT_PORT,
+        help="Port to listen on."
+    )
+
+    p.add_argument(
+        '--read-only',
+        action='store_true',
+        help="Refuse uploads, e.g. for a server that developers only download from."
+    )
+
+    p.add_argument(
+        '-v', '--verbose',
+        action='store_const',
+        const=logging.DEBUG,
+        default=logging.INFO,
+        help="Be noisy.",
+        dest='log_level'
+    )
+
+    args = p.parse_args(argv[2:])
+    logging.basicConfig(level=args.log_level)
+
+    server = remote.CacheServer(args.path.resolve(), (args.bind, args.port), read_only=args.read_only)
+    log.info('Serving %r at %s%s', str(server.store.path), server.url, ' (read-only)' if args.read_only else '')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
+
+
+SUBCOMMANDS = {
+    'perf': perf_main,
+    'cache': cache_main,
+    'cache-server': cache_server_main,
+}
+
+
 def main(argv, defaults_overrides=None):
     if pathlib.Path(argv[0]).name == '__main__.py':
         argv[0] = 'rmbuild'
 
+    if len(argv) > 1 and argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[argv[1]](argv, defaults_overrides)
+
     args = parse_args(argv, defaults_overrides)
     logging.basicConfig(level=args.log_level)
     util.GIT_EXECUTABLE = args.git
 
     log.info('Using RocketMinsta repository %r', str(args.path))
 
+    if args.trace is not None:
+        tracer = trace.start()
+        args.trace = args.trace.resolve()
+
+    if args.profile_dir is not None:
+        args.profile_dir = args.profile_dir.resolve()
+
+    try:
+        build_and_install(args)
+    finally:
+        if args.trace is not None:
+            tracer.export_chrome(args.trace)
+            trace.stop()
+
+
+def build_and_install(args):
     with util.in_dir(args.path.resolve()):
         repo = build.Repo(args.path)
         build_args, install_options, misc_options = config.apply(args.config, repo, args.config_argv)
 
         util.HASH_FUNCTION = misc_options['hash_function']
+        util.HASH_METHOD = misc_options['hash_method']
 
         if args.rebuild:
             build_args['force_rebuild'] = True
 
+        if args.rehash:
+            build_args['rehash'] = True
+
+        if args.profile:
+            build_args['profile'] = True
+
+        if args.profile_memory:
+            build_args['profile_memory'] = True
+
+        if args.profile_dir is not None:
+            build_args['profile_dir'] = args.profile_dir
+
+        if args.remote_cache is not None:
+            build_args['remote_cache'] = args.remote_cache
+
+        if args.remote_cache_push is not None:
+            build_args['remote_cache_push'] = args.remote_cache_push
+
         binfo = repo.build(**build_args)
 
         for path in install_options['dirs']:
@@ -0,0 +1,126 @@
+import errno
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .compat import *
+
+# util uses this module, so don't import it here
+log = logging.getLogger(__name__)
+
+# From linux/fs.h: make the destination share the source's extents (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# In order of preference. The ones that aren't available here, or that failed
+# before between the same two filesystems, are skipped.
+METHODS = ('reflink', 'hardlink', 'copy_file_range', 'copy')
+
+# Methods that share storage with the source instead of copying it
+LINKS = ('reflink', 'hardlink')
+
+# Errors that mean a method can't be used here, rather than that copying failed
+UNSUPPORTED = frozenset(getattr(errno, name) for name in (
+    'EXDEV', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EINVAL', 'ENOSYS', 'EPERM', 'EMLINK',
+) if hasattr(errno, name))
+
+# (method, source device, destination device)
+_unsupported = set()
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _hardlink(src, dst):
+    os.link(src, dst)
+
+
+def _copy_file_range(src, dst):
+    # copies inside the kernel, or shares extents where the filesystem can
+    size = os.stat(src).st_size
+    copied = 0
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        while copied < size:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+
+            if n == 0:
+                # some filesystems claim support but copy nothing
+                raise OSError(errno.ENOSYS, 'copy_file_range() copied nothing')
+
+            copied += n
+
+
+def _copy(src, dst):
+    # uses sendfile() where it can
+    shutil.copyfile(src, dst)
+
+
+_functions = {
+    'reflink': _reflink,
+    'hardlink': _hardlink,
+    'copy_file_range': _copy_file_range,
+    'copy': _copy,
+}
+
+
+def available(method):
+    if method == 'reflink':
+        return fcntl is not None and hasattr(fcntl, 'ioctl') and os.uname()[0] == 'Linux'
+
+    if method == 'hardlink':
+        return hasattr(os, 'link')
+
+    if method == 'copy_file_range':
+        return hasattr(os, 'copy_file_range')
+
+    return True
+
+
+def materialize(src, dst, hardlink=False, preserve_times=False):
+    # Makes the file dst a copy of src, as cheaply as the filesystems allow,
+    # and returns the method used.
+    #
+    # Hard links are only made if asked for: the two paths are then the same
+    # file, so neither may be modified in place afterwards. dst itself is
+    # always replaced, never written to, since it may be such a link.
+    src = str(src)
+    dst = str(dst)
+    st = os.stat(src)
+    dst_dev = os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+
+    if os.path.lexists(dst):
+        os.unlink(dst)
+
+    for method in METHODS:
+        key = (method, st.st_dev, dst_dev)
+
+        if (method == 'hardlink' and not hardlink) or key in _unsupported or not available(method):
+            continue
+
+        try:
+            _functions[method](src, dst)
+        except OSError as e:
+            if os.path.lexists(dst):
+                os.unlink(dst)
+
+            if method == 'copy' or e.errno not in UNSUPPORTED:
+                raise
+
+            log.debug('Not using %s from %r to %r: %s', method, src, dst, e)
+            _unsupported.add(key)
+            continue
+
+        if method != 'hardlink':
+            shutil.copymode(src, dst)
+
+            if preserve_times:
+                os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        return method
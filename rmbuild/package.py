@@ -8,6 +8,12 @@ from .compat import *
 from .errors import *
 
 from . import util
+from . import hashing
+from . import fstree
+from . import archive
+from . import imaging
+from . import trace
+from . import cache
 
 
 class Meta(object):
@@ -43,10 +49,17 @@ class Meta(object):
         except FileNotFoundError:
             return compress_tga
 
+        tree = fstree.scan(self.pkg.path, self.pkg.repo.snapshot)
+
         for cdir in cdirs:
-            for fpath in cdir.iterdir():
-                if fpath.is_file() and fpath.suffix in self.pkg.SRC_IMAGE_SUFFIXLIST:
-                    compress_tga.append(fpath)
+            entry = tree.get(cdir.relative_to(self.pkg.path))
+
+            if entry is None or not entry.is_dir:
+                raise PathError(cdir, "Not a directory")
+
+            for child in entry.iterdir():
+                if child.is_file and child.suffix in self.pkg.SRC_IMAGE_SUFFIXLIST:
+                    compress_tga.append(child.path)
 
         return compress_tga
 
@@ -62,6 +75,9 @@ class Package(object):
     OUTPUT_NAME_FORMAT = "zzz-rm-%(name)s-%(hash)s.pk3"
     SRC_IMAGE_SUFFIXLIST = ['.tga', '.png']
 
+    # names of the build tasks that have to finish before this package is built
+    build_dependencies = ()
+
     def __init__(self, repo, name, path):
         self.repo = repo
         self.name = name
@@ -80,8 +96,13 @@ class Package(object):
     def hash(self):
         if self._hash is not None:
             return self._hash
-        self._hash = util.hash_path(self.path, namefilter=self.filter_filename)
-        self._hash.update(util.HASH_PKG_APPEND_BYTES)
+        self._hash = hashing.hash_tree(
+            self.path,
+            namefilter=self.filter_filename,
+            suffix=util.HASH_PKG_APPEND_BYTES,
+            cache=self.repo.hash_cache,
+            snapshot=self.repo.snapshot
+        )
         return self._hash
 
     @property
@@ -102,16 +123,47 @@ class Package(object):
         ) and not re.match(r'^_pkginfo_.*\.txt$', filename) and not filename.startswith('.rmbuild')
 
     def files(self):
-        for fpath in self.path.glob('**/*'):
-            rpath = fpath.relative_to(self.path).as_posix()
-            if self.filter_filename(rpath):
-                yield fpath, rpath
+        for entry in fstree.scan(self.path, self.repo.snapshot).walk():
+            if self.filter_filename(entry.relpath):
+                yield entry.path, entry.relpath
+
+    def find_previous_pk3(self, build_info):
+        # the most recently cached version of this package, if any
+        if not (build_info.cache_dir and build_info.cache_pkg):
+            return None
+
+        candidates = []
+
+        for fpath in (build_info.cache_dir / 'pkg').glob('zzz-rm-%s-*.pk3' % self.name):
+            name, sep, hash = fpath.stem[len('zzz-rm-'):].rpartition('-')
+
+            if name == self.name and fpath.name != self.output_file_name:
+                candidates.append((fpath.stat().st_mtime, fpath))
+
+        if candidates:
+            return max(candidates)[1]
 
     def _create_pk3(self, build_info):
         self.log.info("Making package %s", self.output_file_name)
 
+        previous = None
+
+        if build_info.pk3_incremental and not build_info.force_rebuild:
+            previous = self.find_previous_pk3(build_info)
+
+            if previous is not None:
+                self.log.info("Reusing unchanged files from %r", str(previous))
+                build_info.cache_manager.touch('pkg', previous)
+
         output_path = build_info.output_dir / self.output_file_name
-        pk3 = zipfile.ZipFile(str(output_path), 'w', zipfile.ZIP_DEFLATED)
+        pk3 = archive.Pk3Writer(
+            output_path,
+            pool=build_info.deflate_pool,
+            policy=build_info.pk3_policy,
+            spill_dir=util.make_directory(build_info.temp_dir / ('pkg_deflate_' + self.name)),
+            abort=build_info.abort_if_failed,
+            previous=previous
+        )
         return pk3
 
     def _add_metafile(self, build_info, pk3):
@@ -145,9 +197,10 @@ class Package(object):
         if not tgalist:
             return cmap, extrafiles
 
-        from PIL import Image
-
         tdir = util.make_directory(build_info.temp_dir / ('pkg_compresstga_' + self.name))
+        image_cache = build_info.image_cache
+        quality = build_info.compress_gfx_quality
+        images = []
 
         for tga in tgalist:
             build_info.abort_if_failed()
@@ -157,51 +210,173 @@ class Package(object):
             cmap[tga] = (abs, rel.as_posix())
             util.make_directory(cmap[tga][0].parent)
 
-            img = Image.open(str(tga))
-            save_jpeg = lambda i, p: i.convert('RGB').save(str(p), format='JPEG', quality=build_info.compress_gfx_quality, optimize=True)
+            alphajpeg_basename = tga.stem + "_alpha" + abs.suffix
+            alphajpeg = abs.with_name(alphajpeg_basename)
 
-            if tga.is_symlink():
+            image = {
+                'src': tga,
+                'rel': rel,
+                'jpeg': abs,
+                'alpha': alphajpeg,
+                'symlink': tga.is_symlink(),
+                'key': None,
+                'stats': None,
+            }
+
+            if image_cache is not None:
+                image['key'] = image_cache.key(hashing.file_digest(tga, build_info.hash_cache), quality)
+
+            if image['symlink']:
                 targ = tga.resolve().relative_to(tga.parent).with_suffix('.jpg')
                 self.log.debug('Adding symlink %r pointing to %r', str(abs), str(targ))
                 abs.symlink_to(targ)
+
+                # still need to know whether the target has an alpha channel
+                if image['key'] is not None:
+                    has_alpha = image_cache.get(image['key'])
+
+                    if has_alpha is not None:
+                        image['stats'] = {'has_alpha': has_alpha, 'cached': True, 'seconds': 0.0}
+
+                image['job'] = imaging.ConvertJob(str(tga), None, None, quality)
             else:
-                self.log.debug('Converting %r to JPEG', str(tga))
-                save_jpeg(img, abs)
-
-            if img.mode in ('RGBA', 'LA'):
-                alpha = img.split()[-1]
-                colors = alpha.getcolors(1)
-
-                if not colors or colors[0][1] < 255:
-                    alphajpeg_basename = tga.stem + "_alpha" + abs.suffix
-                    alphajpeg = abs.with_name(alphajpeg_basename)
-                    alphajpeg_rel = rel.with_name(alphajpeg_basename)
-                    extrafiles.append((alphajpeg, alphajpeg_rel.as_posix()))
-
-                    if tga.is_symlink():
-                        srcname = tga.resolve().relative_to(tga.parent).with_suffix('')
-                        targ = srcname.with_name(srcname.stem + '_alpha').with_suffix('.jpg')
-                        self.log.debug('Symlink %r points to an image with a non-white alpha channel. Adding symlink %r pointing to %r', str(tga), str(alphajpeg), str(targ))
-                        alphajpeg.symlink_to(targ)
-                    else:
-                        self.log.debug('Image %r has a non-white alpha channel, saving it to %r', str(tga), str(alphajpeg))
-                        save_jpeg(alpha, alphajpeg)
+                if image['key'] is not None:
+                    has_alpha = image_cache.get(image['key'], abs, alphajpeg)
+
+                    if has_alpha is not None:
+                        self.log.debug('Using a cached JPEG for %r', str(tga))
+                        image['stats'] = imaging.cached_stats(tga, abs, alphajpeg, has_alpha)
+
+                image['job'] = imaging.ConvertJob(str(tga), str(abs), str(alphajpeg), quality)
+
+            images.append(image)
+
+        pending = [image for image in images if image['stats'] is None]
+
+        for image in pending:
+            self.log.debug('Converting %r to JPEG', str(image['src']))
+
+        results = imaging.convert_images(
+            build_info.image_pool,
+            [image['job'] for image in pending],
+            abort=build_info.abort_if_failed
+        )
+
+        if trace.enabled():
+            trace.current().set(
+                images=len(images),
+                converted=len(pending),
+                cached=len([image for image in images if image['stats'] and image['stats']['cached']]),
+                bytes=sum(image['src'].stat().st_size for image in pending),
+            )
+
+        for image, stats in zip(pending, results):
+            image['stats'] = stats
+            self.log.debug('Processed %r in %.3f seconds', str(image['src']), stats['seconds'])
+
+            if image['key'] is not None and not image['symlink']:
+                image_cache.put(image['key'], image['jpeg'], image['alpha'], stats['has_alpha'])
+
+        # Symlinks follow whatever was decided for their target, if it's converted here too
+        decisions = {}
+
+        for image in images:
+            if not image['symlink']:
+                decisions[image['src'].resolve()] = imaging.decide(image['stats'], build_info.compress_gfx_min_saving)
+
+        for image in images:
+            tga = image['src']
+            stats = image['stats']
+            decision = decisions.get(tga.resolve()) or imaging.decide(stats)
+
+            entry = dict(stats, package=self.name, path=tga.relative_to(self.path).as_posix(), decision=decision)
+            build_info.image_stats.append(entry)
+
+            if decision == 'keep':
+                self.log.debug('Keeping %r, converting it would not make it smaller', str(tga))
+                del cmap[tga]
+
+                if image['symlink']:
+                    image['jpeg'].unlink()
+
+                continue
+
+            if decision != 'jpeg+alpha':
+                continue
+
+            alphajpeg = image['alpha']
+            alphajpeg_rel = image['rel'].with_name(alphajpeg.name)
+            extrafiles.append((alphajpeg, alphajpeg_rel.as_posix()))
+
+            if image['symlink']:
+                srcname = tga.resolve().relative_to(tga.parent).with_suffix('')
+                targ = srcname.with_name(srcname.stem + '_alpha').with_suffix('.jpg')
+                self.log.debug('Symlink %r points to an image with a non-white alpha channel. Adding symlink %r pointing to %r', str(tga), str(alphajpeg), str(targ))
+                alphajpeg.symlink_to(targ)
+            else:
+                self.log.debug('Image %r has a non-white alpha channel, saved it to %r', str(tga), str(alphajpeg))
 
         return cmap, extrafiles
 
+    def _report_pk3(self, build_info, **info):
+        path = build_info.output_dir / self.output_file_name
+
+        with zipfile.ZipFile(str(path)) as pk3:
+            members = pk3.infolist()
+
+        size = path.stat().st_size
+        uncompressed = sum(m.file_size for m in members)
+
+        build_info.report.add_package(self.name,
+            file=self.output_file_name,
+            size=size,
+            uncompressed=uncompressed,
+            ratio=float(size) / uncompressed if uncompressed else None,
+            members=len(members),
+            **info
+        )
+
+    def cache_path(self, build_info):
+        if not (build_info.cache_dir and build_info.cache_pkg):
+            return None
+
+        return build_info.cache_dir / 'pkg' / self.output_file_name
+
     def _build(self, build_info):
-        use_cache = bool(build_info.cache_dir and build_info.cache_pkg)
+        with trace.span('package %s' % self.name, 'package') as span:
+            cached_pkg = self.cache_path(build_info)
+
+            if cached_pkg is None:
+                return self._build_pk3(build_info, span, None)
+
+            # a build sharing the cache that is making the same pk3 is waited
+            # for, and then its result is used
+            with build_info.cache_manager.lock(cached_pkg, abort=build_info.abort_if_failed):
+                self._build_pk3(build_info, span, cached_pkg)
+
+    def _build_pk3(self, build_info, span, cached_pkg):
+        use_cache = cached_pkg is not None
 
         if use_cache:
-            cache_dir = util.make_directory(build_info.cache_dir / 'pkg')
-            cached_pkg = cache_dir / self.output_file_name
+            util.make_directory(cached_pkg.parent)
 
-            if cached_pkg.exists() and not build_info.force_rebuild:
+            if not build_info.force_rebuild and (cached_pkg.exists() or
+                                                 build_info.cache_manager.fetch('pkg', cached_pkg)):
                 self.log.info('Using a cached version (%r)', str(cached_pkg))
-                util.copy(cached_pkg, build_info.output_dir)
+                util.copy(cached_pkg, build_info.output_dir, hardlink=build_info.use_hardlinks)
+                span.set(cache='hit', bytes=cached_pkg.stat().st_size)
+                build_info.report.count('pkg_cache.hit')
+                build_info.cache_manager.hit('pkg', cached_pkg)
+                self._report_pk3(build_info, cached=True)
                 return
 
-        cmap, extrafiles = self._compress_tga(build_info)
+            span.set(cache='miss')
+            build_info.report.count('pkg_cache.miss')
+            build_info.cache_manager.miss('pkg')
+
+        with trace.span('images %s' % self.name, 'image'):
+            cmap, extrafiles = self._compress_tga(build_info)
+
         pk3 = self._create_pk3(build_info)
 
         for fpath, rpath in itertools.chain(self.files(), extrafiles):
@@ -237,7 +412,13 @@ class Package(object):
                 pk3.write(str(fpath), rpath)
 
         self._add_metafile(build_info, pk3)
-        pk3.close()
+
+        with trace.span('zip %s' % self.name, 'zip') as zip_span:
+            pk3.close()
+            zip_span.set(members=len(pk3.members), reused=pk3.reused)
+
+        span.set(bytes=(build_info.output_dir / self.output_file_name).stat().st_size)
+        self._report_pk3(build_info, cached=False, reused=pk3.reused)
         self.log.info("Done")
 
         build_info.abort_if_failed()
@@ -248,7 +429,17 @@ class Package(object):
 
         if use_cache:
             self.log.info('Caching for reuse (%r)', str(cached_pkg))
-            util.copy(build_info.output_dir / self.output_file_name, cached_pkg)
+            tmp = cache.temp_path(cached_pkg)
+
+            try:
+                util.copy(build_info.output_dir / self.output_file_name, tmp, hardlink=build_info.use_hardlinks)
+                cache.publish(tmp, cached_pkg)
+            except BaseException:
+                if tmp.exists():
+                    tmp.unlink()
+                raise
+
+            build_info.cache_manager.put('pkg', cached_pkg)
 
     def build(self, build_info):
         if build_info.link_pk3dirs:
@@ -273,24 +464,27 @@ class QCPackage(LateBuildingPackage):
 
 
 class CSQCPackage(QCPackage):
+    build_dependencies = ('qc.client',)
+
     def _compute_hash(self):
         h = util.hash_constructor()
 
-        for path in self._qc_modules:
-            util.hash_path(path, root=path.parent, hashobject=h)
+        # built_qc_modules lists the modules in the order they finished building
+        for path in sorted(self._qc_modules):
+            hashing.hash_path(path, root=path.parent, hashobject=h, cache=self.repo.hash_cache)
 
         return h
 
     def build(self, build_info):
-        build_info.wait_for_tasks('qc.client')
         self._qc_modules = build_info.built_qc_modules['client']
         self._hash = self._compute_hash()
         self._build(build_info)
 
 
 class MenuPackage(QCPackage):
+    build_dependencies = ('qc.menu',)
+
     def build(self, build_info):
-        build_info.wait_for_tasks('qc.menu')
         self._qc_modules = build_info.built_qc_modules['menu']
         self._hash = build_info.repo.qchash_menu.copy()
         self._build(build_info)
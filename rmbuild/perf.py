@@ -0,0 +1,204 @@
+import socket
+import sqlite3
+import statistics
+
+from .compat import *
+
+from . import util
+
+log = util.logger(__name__)
+
+DB_FILENAME = 'perf.sqlite3'
+
+# Compare against the median of this many earlier builds
+DEFAULT_BASELINE = 5
+
+# Flag stages that got slower by more than this fraction...
+DEFAULT_THRESHOLD = 0.25
+
+# ...and by more than this many seconds, so that tiny stages don't cause noise
+DEFAULT_MIN_SECONDS = 0.5
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL,
+    rm_version TEXT NOT NULL,
+    rm_branch TEXT NOT NULL,
+    host TEXT NOT NULL,
+    config_hash TEXT NOT NULL,
+    wall REAL NOT NULL,
+    cpu REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS stages (
+    build_id INTEGER NOT NULL REFERENCES builds(id) ON DELETE CASCADE,
+    stage TEXT NOT NULL,
+    wall REAL NOT NULL,
+    cpu REAL NOT NULL,
+    runs INTEGER NOT NULL,
+    PRIMARY KEY (build_id, stage)
+);
+
+CREATE INDEX IF NOT EXISTS builds_by_config ON builds (host, config_hash);
+'''
+
+
+class Comparison(object):
+    def __init__(self, stage, baseline, latest, threshold, min_seconds):
+        self.__dict__.update(locals())
+
+        if baseline is None or latest is None:
+            self.change = None
+            self.regressed = False
+        else:
+            self.change = (latest - baseline) / baseline if baseline else None
+            self.regressed = latest - baseline > max(baseline * threshold, min_seconds)
+
+    def __repr__(self):
+        return '%s(%r, %r, %r)' % (self.__class__.__name__, self.stage, self.baseline, self.latest)
+
+
+class PerfHistory(object):
+    # One row per build and one per stage of every build, in an SQLite
+    # database. Builds are only compared with builds of the same
+    # configuration on the same host.
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(str(path), timeout=30)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(SCHEMA)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self.path))
+
+    def close(self):
+        self.db.close()
+
+    def record(self, build_info, report):
+        totals = report['totals']
+
+        with self.db:
+            cursor = self.db.execute(
+                'INSERT INTO builds (date, rm_version, rm_branch, host, config_hash, wall, cpu) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                    build_info.date.isoformat(),
+                    build_info.repo.rm_version,
+                    build_info.repo.rm_branch,
+                    socket.gethostname(),
+                    build_info.config_hash(),
+                    totals['wall'],
+                    totals['cpu'] + totals['cpu_children'],
+                )
+            )
+
+            build_id = cursor.lastrowid
+
+            self.db.executemany(
+                'INSERT INTO stages (build_id, stage, wall, cpu, runs) VALUES (?, ?, ?, ?, ?)', [
+                    (build_id, name, stage['wall'], stage['cpu'], stage['runs'])
+                        for name, stage in report['stages'].items()
+                ]
+            )
+
+        log.debug('Recorded build %i in %r', build_id, str(self.path))
+        return build_id
+
+    def builds(self, limit=None, host=None, config_hash=None):
+        # newest first
+        query = 'SELECT id, date, rm_version, rm_branch, host, config_hash, wall, cpu FROM builds'
+        conditions = []
+        params = []
+
+        if host is not None:
+            conditions.append('host = ?')
+            params.append(host)
+
+        if config_hash is not None:
+            conditions.append('config_hash = ?')
+            params.append(config_hash)
+
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        query += ' ORDER BY id DESC'
+
+        if limit is not None:
+            query += ' LIMIT %i' % limit
+
+        keys = ('id', 'date', 'rm_version', 'rm_branch', 'host', 'config_hash', 'wall', 'cpu')
+        return [dict(zip(keys, row)) for row in self.db.execute(query, params)]
+
+    def stages(self, build_id):
+        return {
+            stage: wall for stage, wall in
+                self.db.execute('SELECT stage, wall FROM stages WHERE build_id = ?', (build_id,))
+        }
+
+    def compare(self, build_id=None, baseline=DEFAULT_BASELINE, threshold=DEFAULT_THRESHOLD,
+                min_seconds=DEFAULT_MIN_SECONDS):
+        # Compares a build (the latest one by default) against the median of
+        # the previous ones with the same host and configuration.
+        # Returns (build, [Comparison]), or (None, []) if there are no builds.
+
+        if build_id is None:
+            latest = self.builds(limit=1)
+        else:
+            latest = [b for b in self.builds() if b['id'] == build_id]
+
+        if not latest:
+            return None, []
+
+        latest = latest[0]
+        previous = [
+            b for b in self.builds(host=latest['host'], config_hash=latest['config_hash'])
+                if b['id'] < latest['id']
+        ][:baseline]
+
+        latest_stages = self.stages(latest['id'])
+        latest_stages['total'] = latest['wall']
+
+        previous_stages = [self.stages(b['id']) for b in previous]
+        for b, stages in zip(previous, previous_stages):
+            stages['total'] = b['wall']
+
+        names = set(latest_stages)
+        for stages in previous_stages:
+            names.update(stages)
+
+        comparisons = []
+
+        for name in sorted(names):
+            values = [stages[name] for stages in previous_stages if name in stages]
+            comparisons.append(Comparison(
+                name,
+                statistics.median(values) if values else None,
+                latest_stages.get(name),
+                threshold,
+                min_seconds
+            ))
+
+        latest['baseline_builds'] = len(previous)
+        return latest, comparisons
+
+
+def format_comparison(build, comparisons):
+    lines = [
+        'Build %i (%s, %s on %s), compared with the median of %i earlier build(s)' % (
+            build['id'], build['date'], build['rm_version'], build['host'], build['baseline_builds']
+        ),
+        '',
+        '%-40s %10s %10s %8s' % ('stage', 'baseline', 'latest', 'change'),
+    ]
+
+    def seconds(value):
+        return '-' if value is None else '%.3fs' % value
+
+    for c in comparisons:
+        change = '-' if c.change is None else '%+.0f%%' % (c.change * 100)
+        lines.append('%-40s %10s %10s %8s%s' % (
+            c.stage, seconds(c.baseline), seconds(c.latest), change, '  REGRESSED' if c.regressed else ''
+        ))
+
+    return '\n'.join(lines)
@@ -0,0 +1,133 @@
+import cProfile
+import contextlib
+import re
+import threading
+import tracemalloc
+
+from .compat import *
+
+from . import util
+
+log = util.logger(__name__)
+
+# How many allocation sites to list in the memory summaries
+TOP_ALLOCATIONS = 25
+
+# What the profiles are written as, and removed on the next run
+OUTPUT_PATTERNS = ('*.pstats', '*.memory.txt')
+
+# Allocations made by the profilers themselves, or by imports
+TRACEMALLOC_IGNORE = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, cProfile.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+class Profiler(object):
+    # Profiles every build stage and task on its own, see BuildInfo.stage().
+    #
+    # With cpu, each one gets a <name>.pstats file (cProfile, which only sees
+    # the thread the stage runs in). With memory, each one gets a
+    # <name>.memory.txt listing the allocation sites that grew the most while
+    # it ran. tracemalloc can't tell threads apart, so those include whatever
+    # ran concurrently.
+
+    def __init__(self, path, cpu=True, memory=False):
+        self.path = util.make_directory(path)
+        self.cpu = cpu
+        self.memory = memory
+        self.profiles = 0
+        self._names = {}
+        self._lock = threading.Lock()
+        self._warned = False
+        self._started_tracemalloc = False
+
+        # the directory may be shared with other files, only remove our own
+        for pattern in OUTPUT_PATTERNS:
+            for old in self.path.glob(pattern):
+                old.unlink()
+
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self.path))
+
+    def _basename(self, name):
+        # tasks may run more than once under the same name, e.g. qc.server
+        name = re.sub(r'[^\w.-]+', '_', name)
+
+        with self._lock:
+            count = self._names[name] = self._names.get(name, 0) + 1
+            self.profiles += 1
+
+        if count > 1:
+            name += '.%i' % count
+
+        return str(self.path / name)
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(TRACEMALLOC_IGNORE)
+
+    def _enable(self, profile):
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Python 3.12 and later only allow one profiler at a time
+            with self._lock:
+                warned, self._warned = self._warned, True
+
+            if not warned:
+                log.warning("Can't profile concurrent tasks separately (%s), some profiles will be missing. "
+                            "Set threads = 1 to get all of them.", e)
+
+            return False
+
+        return True
+
+    def _write_memory(self, path, name, before, after):
+        current, peak = tracemalloc.get_traced_memory()
+        stats = after.compare_to(before, 'lineno')
+
+        with open(path, 'w') as f:
+            f.write('%s: %s traced now, %s at peak\n' % (name, util.format_size(current), util.format_size(peak)))
+            f.write('Top %i allocation sites by growth, in all threads:\n\n' % TOP_ALLOCATIONS)
+
+            for stat in stats[:TOP_ALLOCATIONS]:
+                f.write('%s\n' % stat)
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        base = self._basename(name)
+        profile = None
+        before = None
+
+        if self.memory:
+            before = self._snapshot()
+
+        if self.cpu:
+            profile = cProfile.Profile()
+
+            if not self._enable(profile):
+                profile = None
+
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(base + '.pstats')
+
+            if before is not None:
+                self._write_memory(base + '.memory.txt', name, before, self._snapshot())
+
+    def close(self):
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+        log.info("Wrote %i profiles to %r, see 'python -m pstats'", self.profiles, str(self.path))
@@ -1,10 +1,62 @@
 
+import binascii
+import json
+import os
 import pathlib
 import re
+import shutil
+import time
 
 from .compat import *
 
 from . import util
+from . import hashing
+from . import trace
+from . import report
+from . import cache
+
+log = util.logger(__name__)
+
+# Bump this if what goes into the QC cache keys changes
+CACHE_KEY_VERSION = 2
+
+# Defines that only label the build. A cached module built with different
+# values is still used, otherwise nothing would ever be reused.
+CACHE_KEY_IGNORED_DEFS = ('RM_BUILD_DATE', 'RM_BUILD_VERSION')
+
+
+def auto_header(defs):
+    # contents of rm_auto.qh
+    return ''.join(
+        ('#define %s %s\n' % (key, value)) if value else ('#define %s\n' % key)
+            for key, value in defs.items()
+    )
+
+
+def cache_key_flags(flags):
+    # -D flags can come in any order, and some only label the build
+    defines = []
+    others = []
+
+    for flag in flags:
+        if flag.startswith('-D'):
+            name = flag[2:].split('=', 1)[0]
+            defines.append('-D' + name if name in CACHE_KEY_IGNORED_DEFS else flag)
+        else:
+            others.append(flag)
+
+    return others + sorted(defines)
+
+
+def compiler_digest(qcc_cmd, cache=None):
+    path = shutil.which(qcc_cmd)
+
+    if path is None:
+        # fine as long as everything is cached, and compiling fails anyway
+        log.debug('%r not found, the QC cache keys only include its name', qcc_cmd)
+        return 'name:' + qcc_cmd
+
+    return hashing.file_digest(os.path.realpath(path), cache)
 
 
 class BuildConfig(object):
@@ -12,6 +64,61 @@ class BuildConfig(object):
         self.__dict__.update(locals())
 
 
+class IncludeGraph(object):
+    # Maps every QC source file to its content digest and the files it includes.
+    # Nodes are computed at most once per build and shared between all modules;
+    # with a hash cache, unchanged files aren't even read.
+
+    include_re = re.compile(r'#include\s*[<"](.*?)[>"]')
+    strip_re = re.compile(r'\s*//.*|\s*$|^\s*')
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.nodes = {}
+
+    @classmethod
+    def strip(cls, line):
+        return cls.strip_re.sub('', line)
+
+    def node(self, path):
+        try:
+            return self.nodes[path]
+        except KeyError:
+            pass
+
+        st = os.stat(path)
+        key = [util.HASH_FUNCTION, st.st_size, st.st_mtime_ns, st.st_ino]
+        node = None
+
+        if self.cache is not None:
+            node = self.cache.get('qc', path, key)
+
+        if node is None:
+            node = self.scan(path)
+            report.count('bytes_hashed', st.st_size)
+
+            if self.cache is not None:
+                self.cache.put('qc', path, key, node)
+
+        node = tuple(node)
+        self.nodes[path] = node
+        return node
+
+    def scan(self, path):
+        h = util.hash_constructor()
+        includes = []
+        parent = pathlib.Path(path).parent
+
+        with open(path, 'rb') as qcfile:
+            for line in qcfile:
+                h.update(line)
+                match = self.include_re.match(self.strip(line.decode('utf-8')))
+                if match and match.group(1) != 'rm_auto.qh':
+                    includes.append(str((parent / match.group(1)).resolve()))
+
+        return [h.hexdigest(), includes]
+
+
 class QCModule(object):
     def __init__(self, name, path):
         self.name = name
@@ -25,74 +132,134 @@ class QCModule(object):
                     self.needs_auto_header = True
                     break
 
-    def compute_hash(self, hash):
-        include_re = re.compile(r'#include\s*[<"](.*?)[>"]')
-        strip_re = re.compile(r'\s*//.*|\s*$|^\s*')
+    def compute_hash(self, hash, graph=None):
+        if graph is None:
+            graph = IncludeGraph()
 
         p = self.path
-        strip = lambda s: strip_re.sub('', s)
         progspath = p / 'progs.src'
+        merkle = util.HASH_METHOD == 'merkle'
+        visited = set()
 
         def hash_qc_file(path):
-            includes = []
-            hash.update(str(path).encode('utf-8'))
+            if path in visited:
+                return
+
+            visited.add(path)
+            digest, includes = graph.node(path)
+
+            if merkle:
+                # relative names, so that the key can be shared between checkouts
+                name = pathlib.PurePath(os.path.relpath(str(path), str(p.parent))).as_posix()
+            else:
+                name = str(path)
 
-            with path.open('rb') as qcfile:
-                for line in qcfile:
-                    hash.update(line)
-                    match = include_re.match(strip(line.decode('utf-8')))
-                    if match:
-                        includes.append(match.group(1))
+            hash.update(name.encode('utf-8') + b'\0')
+            hash.update(binascii.unhexlify(digest.encode('ascii')))
 
-            for inc in filter(lambda i: i != 'rm_auto.qh', includes):
-                hash_qc_file((path.parent / inc).resolve())
+            for inc in includes:
+                hash_qc_file(inc)
 
         with progspath.open() as progsfile:
-            for line in filter(lambda l: l and not l.endswith('.dat'), map(strip, progsfile)):
-                hash_qc_file(util.file((progspath.parent / line).resolve()))
+            for line in filter(lambda l: l and not l.endswith('.dat'), map(IncludeGraph.strip, progsfile)):
+                hash_qc_file(str(util.file((progspath.parent / line).resolve())))
 
         return hash
 
+    def cache_key(self, build_info, module_config):
+        # Everything the compiled module depends on: the sources, the
+        # compiler binary, its arguments and the generated rm_auto.qh.
+        # The source directory isn't included, so checkouts share keys.
+        key = {
+            'version': CACHE_KEY_VERSION,
+            'sources': build_info.get_qc_hash(self.name).hexdigest(),
+            'qcc': compiler_digest(module_config.qcc_cmd, build_info.hash_cache),
+            'flags': cache_key_flags(module_config.qcc_flags),
+            'dat': [module_config.dat_expected_name, module_config.dat_final_name],
+        }
+
+        if self.needs_auto_header:
+            key['auto_header'] = sorted(
+                (name, None if name in CACHE_KEY_IGNORED_DEFS else value)
+                    for name, value in build_info.qc_defs.items()
+            )
+
+        h = util.hash_constructor()
+        h.update(json.dumps(key, sort_keys=True).encode('utf-8'))
+        self.log.debug('Cache key for %s: %s %r', module_config.dat_final_name, h.hexdigest(), key)
+        return h.hexdigest()
+
+    def cache_path(self, build_info, module_config):
+        if not (build_info.cache_dir and build_info.cache_qc):
+            return None
+
+        key = self.cache_key(build_info, module_config)
+        return build_info.cache_dir / 'qc' / module_config.dat_final_name / key
+
     def build(self, build_info, module_config):
-        build_info.abort_if_failed()
-        use_cache = bool(build_info.cache_dir and build_info.cache_qc)
-        build_dir = util.make_directory(pathlib.Path.cwd() / 'qcc' / module_config.dat_final_name)
+        with trace.span('qcc %s' % module_config.dat_final_name, 'qcc', module=self.name) as span:
+            cache_dir = self.cache_path(build_info, module_config)
 
-        if use_cache:
-            if self.name == 'menu':
-                myhash = build_info.repo.qchash_menu.hexdigest()
-            else:
-                if self.name == 'client':
-                    basehash = build_info.repo.qchash_menu.copy()
-                else:
-                    basehash = util.hash_constructor()
+            if cache_dir is None:
+                return self._build(build_info, module_config, span, None)
 
-                myhash = self.compute_hash(basehash).hexdigest()
+            # a build sharing the cache that is compiling the same thing is
+            # waited for, and then its result is used
+            with build_info.cache_manager.lock(cache_dir, abort=build_info.abort_if_failed):
+                return self._build(build_info, module_config, span, cache_dir)
 
-            cache_dir = build_info.cache_dir / 'qc' / module_config.dat_final_name / myhash
+    def _build(self, build_info, module_config, span, cache_dir):
+        build_info.abort_if_failed()
+        use_cache = cache_dir is not None
+        build_dir = util.make_directory(pathlib.Path.cwd() / 'qcc' / module_config.dat_final_name)
 
-            if cache_dir.is_dir() and not build_info.force_rebuild:
+        if use_cache:
+            if not build_info.force_rebuild and (cache_dir.is_dir() or
+                                                 build_info.cache_manager.fetch('qc', cache_dir)):
                 self.log.info('Using a cached version for %s (%r)', module_config.dat_final_name, str(cache_dir))
-                util.copy_tree(cache_dir, build_dir)
+                util.copy_tree(cache_dir, build_dir, hardlink=build_info.use_hardlinks)
+                span.set(cache='hit')
+                build_info.report.count('qc_cache.hit')
+                build_info.cache_manager.hit('qc', cache_dir)
+                build_info.report.add_qcc(module_config.dat_final_name, module=self.name, cached=True, seconds=0.0)
                 return build_dir
 
+            span.set(cache='miss')
+            build_info.report.count('qc_cache.miss')
+            build_info.cache_manager.miss('qc')
+
         self.log.info('Building %s from %r', module_config.dat_final_name, str(self.path))
 
         build_info.abort_if_failed()
+        start = time.time()
         util.logged_subprocess(
             [module_config.qcc_cmd, '-src', str(self.path)] + module_config.qcc_flags,
             self.log,
+            cancel=build_info.cancel_token,
             cwd=str(build_dir)
         )
 
+        size = sum(f.stat().st_size for f in build_dir.iterdir() if f.is_file())
+        span.set(bytes=size)
+        build_info.report.add_qcc(module_config.dat_final_name, module=self.name, cached=False,
+                                  seconds=time.time() - start, bytes=size)
+
         if module_config.dat_expected_name != module_config.dat_final_name:
             for fpath in build_dir.glob('*'):
                 if fpath.stem == module_config.dat_expected_name:
                     fpath.rename(fpath.with_name('%s%s' % (module_config.dat_final_name, fpath.suffix)))
 
         if use_cache:
-            cache_dir = util.make_directory(cache_dir)
             self.log.info('Caching %s for reuse (%r)', module_config.dat_final_name, str(cache_dir))
-            util.copy_tree(build_dir, cache_dir)
+            tmp = util.make_directory(cache.temp_path(cache_dir))
+
+            try:
+                util.copy_tree(build_dir, tmp, hardlink=build_info.use_hardlinks)
+                cache.publish(tmp, cache_dir)
+            except BaseException:
+                shutil.rmtree(str(tmp), ignore_errors=True)
+                raise
+
+            build_info.cache_manager.put('qc', cache_dir)
 
         return build_dir
@@ -0,0 +1,585 @@
+import base64
+import hashlib
+import http.client
+import http.server
+import os
+import pathlib
+import re
+import shutil
+import socketserver
+import tarfile
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from concurrent import futures
+
+from .compat import *
+
+from . import util
+from . import report
+from . import cache
+
+log = util.logger(__name__)
+
+# Blobs are cache entries packed into uncompressed tarballs (the contents are
+# compressed already), stored under the entry's name in cache_dir, e.g.
+#   qc/rocketminsta_sv/<key>
+#   pkg/zzz-rm-<name>-<hash>.pk3
+#   img/<xx>/<key>.jpg
+# All of those names are derived from hashes of everything that went into
+# the entry, so a blob never changes once stored.
+NAME_PATTERN = re.compile(r'^(%s)(/[A-Za-z0-9_][A-Za-z0-9_.+-]*){1,2}$' % '|'.join(cache.KINDS))
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_PORT = 8737
+
+# Uploads running in the background at once
+UPLOAD_JOBS = 2
+
+# Give up on the remote cache for the rest of the build after this many
+# failed requests in a row
+MAX_ERRORS = 3
+
+# The reference server refuses bigger blobs
+MAX_BLOB_SIZE = 4 << 30
+
+CHUNK_SIZE = 1 << 20
+
+# What a backend may raise when the remote cache is unreachable or broken
+BACKEND_ERRORS = (OSError, http.client.HTTPException)
+
+
+class BlobError(Exception):
+    pass
+
+
+class ReadOnlyError(Exception):
+    pass
+
+
+def valid_name(name):
+    return bool(NAME_PATTERN.match(name)) and not name.endswith('.tmp')
+
+
+def check_name(name):
+    if not valid_name(name):
+        raise ValueError('Not a cache entry name: %r' % name)
+
+    return name
+
+
+def format_digest(h):
+    # RFC 3230 instance digest, e.g. 'sha-256=<base64>'
+    return 'sha-256=' + base64.b64encode(h.digest()).decode('ascii')
+
+
+def parse_digest(header):
+    if header is None:
+        return None
+
+    for part in header.split(','):
+        algorithm, _, value = part.strip().partition('=')
+
+        if algorithm.lower() == 'sha-256':
+            return 'sha-256=' + value
+
+    return None
+
+
+def copy_hashed(src, dst, size=None):
+    # Copies between file objects, and returns the hash of what was copied
+    h = hashlib.sha256()
+    remaining = size
+
+    while remaining is None or remaining > 0:
+        chunk = src.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+
+        if not chunk:
+            break
+
+        h.update(chunk)
+        dst.write(chunk)
+
+        if remaining is not None:
+            remaining -= len(chunk)
+
+    if remaining:
+        raise BlobError('Blob truncated, %i bytes missing' % remaining)
+
+    return h
+
+
+def file_digest(f):
+    h = hashlib.sha256()
+
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        h.update(chunk)
+
+    f.seek(0)
+    return format_digest(h)
+
+
+def entry_files(kind, path):
+    # The files of the entry at path, in the order they need to be restored in
+    if kind == 'qc':
+        return sorted(p for p in path.iterdir() if p.is_file())
+
+    if kind == 'img':
+        # the colour JPEG marks the entry as complete, so it goes last
+        alpha = path.with_name(path.stem + '_alpha.jpg')
+        return ([alpha] if alpha.exists() else []) + [path]
+
+    return [path]
+
+
+def pack(kind, path, f):
+    if kind == 'qc' and not path.is_dir():
+        raise FileNotFoundError(str(path))
+
+    with tarfile.open(fileobj=f, mode='w', format=tarfile.PAX_FORMAT) as tar:
+        for fpath in entry_files(kind, path):
+            tar.add(str(fpath), arcname=fpath.name, recursive=False)
+
+
+def unpack(kind, path, f):
+    # Restores the entry at path from a blob, publishing each part atomically
+    if kind == 'img':
+        allowed = {path.name, path.stem + '_alpha.jpg'}
+    elif kind == 'pkg':
+        allowed = {path.name}
+    else:
+        allowed = None
+
+    with tarfile.open(fileobj=f, mode='r:') as tar:
+        members = tar.getmembers()
+
+        for member in members:
+            if not member.isfile() or '/' in member.name or member.name.startswith('.') or \
+                    (allowed is not None and member.name not in allowed):
+                raise BlobError('Unexpected member %r' % member.name)
+
+        if kind == 'qc':
+            if not members:
+                raise BlobError('No files')
+        elif not any(m.name == path.name for m in members):
+            raise BlobError('%r is missing' % path.name)
+
+        util.make_directory(path.parent)
+
+        if kind == 'qc':
+            tmp = util.make_directory(cache.temp_path(path))
+
+            try:
+                for member in members:
+                    extract(tar, member, tmp / member.name)
+
+                cache.publish(tmp, path)
+            except BaseException:
+                shutil.rmtree(str(tmp), ignore_errors=True)
+                raise
+
+            return
+
+        for member in members:
+            target = path.with_name(member.name)
+            tmp = cache.temp_path(target)
+
+            try:
+                extract(tar, member, tmp)
+                cache.publish(tmp, target)
+            except BaseException:
+                if tmp.exists():
+                    tmp.unlink()
+                raise
+
+
+def extract(tar, member, target):
+    with tar.extractfile(member) as src, target.open('wb') as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+    os.chmod(str(target), member.mode & 0o755 | 0o644)
+
+    # keeps pk3 members built from restored images reusable, see ImageCache
+    os.utime(str(target), (member.mtime, member.mtime))
+
+
+class DirectoryBackend(object):
+    # Blobs as plain files in a directory, e.g. on a network filesystem.
+    # This is also how the reference server stores them.
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self.path))
+
+    def path_of(self, name):
+        return self.path / check_name(name)
+
+    def get(self, name, f):
+        # Returns whether the blob exists
+        try:
+            src = self.path_of(name).open('rb')
+        except FileNotFoundError:
+            return False
+
+        with src:
+            shutil.copyfileobj(src, f, CHUNK_SIZE)
+
+        return True
+
+    def put(self, name, f, size, digest=None):
+        path = self.path_of(name)
+        util.make_directory(path.parent)
+        tmp = cache.temp_path(path)
+
+        try:
+            with tmp.open('wb') as dst:
+                h = copy_hashed(f, dst, size)
+
+            if digest is not None and format_digest(h) != digest:
+                raise BlobError('Digest mismatch for %r' % name)
+
+            tmp.replace(path)
+        except BaseException:
+            if tmp.exists():
+                tmp.unlink()
+            raise
+
+
+class HTTPBackend(object):
+    # Blobs on an HTTP server: GET and PUT <url>/<name>, with the sha-256 of
+    # the body in a Digest header both ways. See CacheServer.
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT):
+        self.url = url.rstrip('/') + '/'
+        self.timeout = timeout
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.url)
+
+    def _open(self, method, name, data=None, headers=None):
+        request = urllib.request.Request(self.url + urllib.parse.quote(check_name(name)),
+                                         data=data, headers=headers or {}, method=method)
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def get(self, name, f):
+        try:
+            response = self._open('GET', name)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+
+        with response:
+            length = response.headers.get('Content-Length')
+            h = copy_hashed(response, f, int(length) if length is not None else None)
+            digest = parse_digest(response.headers.get('Digest'))
+
+        if digest is not None and format_digest(h) != digest:
+            raise BlobError('Digest mismatch for %r' % name)
+
+        return True
+
+    def put(self, name, f, size, digest=None):
+        headers = {
+            'Content-Type': 'application/x-tar',
+            'Content-Length': str(size),
+        }
+
+        if digest is not None:
+            headers['Digest'] = digest
+
+        try:
+            self._open('PUT', name, data=f, headers=headers).close()
+        except urllib.error.HTTPError as e:
+            if e.code in (403, 405):
+                raise ReadOnlyError('%s %s' % (e.code, e.reason))
+            raise
+
+
+def backend(url, timeout=DEFAULT_TIMEOUT):
+    # http(s)://host/path, file:///path, or a plain path
+    parsed = urllib.parse.urlparse(str(url))
+
+    if parsed.scheme in ('http', 'https'):
+        return HTTPBackend(str(url), timeout)
+
+    if parsed.scheme == 'file':
+        return DirectoryBackend(urllib.request.url2pathname(parsed.path))
+
+    if parsed.scheme and len(parsed.scheme) > 1:
+        raise ValueError("'remote_cache' must be an http(s):// or file:// URL or a path, got %r instead" % url)
+
+    return DirectoryBackend(str(url))
+
+
+class RemoteCache(object):
+    # Puts a shared cache behind the local one in cache_dir, see CacheManager.
+    #
+    # Read-through: entries missing locally are downloaded into cache_dir if
+    # the remote has them. Write-back: entries built here are uploaded in the
+    # background once they're in cache_dir, and close() waits for that.
+    #
+    # The remote cache is an optimization only. If it's unreachable, broken
+    # or read-only, the build goes on without it.
+
+    def __init__(self, backend, push=True, jobs=UPLOAD_JOBS):
+        self.backend = backend
+        self.push = push
+        self.disabled = False
+        self.hits = 0
+        self.misses = 0
+        self.uploads = 0
+        self._errors = 0
+        self._lock = threading.Lock()
+        self._uploads = []
+        self._executor = futures.ThreadPoolExecutor(jobs) if push else None
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.backend)
+
+    def _error(self, what, e):
+        with self._lock:
+            self._errors += 1
+            give_up = self._errors >= MAX_ERRORS and not self.disabled
+
+            if give_up:
+                self.disabled = True
+
+        log.warning("Couldn't %s the remote cache %r: %s", what, self.backend, e)
+
+        if give_up:
+            log.warning('Not using the remote cache for the rest of this build')
+
+    def _ok(self):
+        with self._lock:
+            self._errors = 0
+
+    def fetch(self, kind, name, path):
+        # Returns whether the entry is now at path
+        if self.disabled:
+            return False
+
+        if not valid_name(name):
+            log.debug('%r is not a remote cache entry name, not downloading it', name)
+            return False
+
+        with tempfile.TemporaryFile() as f:
+            try:
+                found = self.backend.get(name, f)
+            except BlobError as e:
+                log.warning('Ignoring broken remote cache entry %r: %s', name, e)
+                found = False
+            except BACKEND_ERRORS as e:
+                self._error('download %r from' % name, e)
+                return False
+
+            self._ok()
+
+            if found:
+                size = f.tell()
+                f.seek(0)
+
+                try:
+                    unpack(kind, path, f)
+                except (tarfile.TarError, BlobError) as e:
+                    log.warning('Ignoring broken remote cache entry %r: %s', name, e)
+                    found = False
+
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if not found:
+            report.count('remote_cache.miss')
+            return False
+
+        log.debug('Downloaded %r from the remote cache (%s)', name, util.format_size(size))
+        report.count('remote_cache.hit')
+        report.count('bytes_downloaded', size)
+        return True
+
+    def store(self, kind, name, path):
+        if self._executor is None or self.disabled or not self.push:
+            return
+
+        if not valid_name(name):
+            log.debug('%r is not a remote cache entry name, not uploading it', name)
+            return
+
+        future = self._executor.submit(self._upload, kind, name, path)
+
+        with self._lock:
+            self._uploads.append(future)
+
+    def _upload(self, kind, name, path):
+        if self.disabled or not self.push:
+            return
+
+        with tempfile.TemporaryFile() as f:
+            try:
+                pack(kind, path, f)
+            except FileNotFoundError:
+                # evicted in the meantime
+                log.debug('%r is gone, not uploading it', name)
+                return
+            except (OSError, tarfile.TarError) as e:
+                self._error('pack %r for' % name, e)
+                return
+
+            size = f.tell()
+            f.seek(0)
+            digest = file_digest(f)
+
+            try:
+                self.backend.put(name, f, size, digest)
+            except ReadOnlyError as e:
+                if self.push:
+                    self.push = False
+                    log.warning('The remote cache %r is read-only (%s), not uploading anything to it', self.backend, e)
+                return
+            except (BlobError,) + BACKEND_ERRORS as e:
+                self._error('upload %r to' % name, e)
+                return
+
+        self._ok()
+
+        with self._lock:
+            self.uploads += 1
+
+        log.debug('Uploaded %r to the remote cache (%s)', name, util.format_size(size))
+        report.count('remote_cache.upload')
+        report.count('bytes_uploaded', size)
+
+    def close(self, cancel=False):
+        # Waits for the pending uploads. With cancel (e.g. when the build has
+        # failed), only for the ones that have already started.
+        if self._executor is None:
+            return
+
+        with self._lock:
+            uploads, self._uploads = self._uploads, []
+
+        if cancel:
+            for future in uploads:
+                future.cancel()
+
+        pending = len([f for f in uploads if not f.done()])
+
+        if pending:
+            log.info('Waiting for %i uploads to the remote cache', pending)
+
+        for future in uploads:
+            if not future.cancelled():
+                future.result()
+
+        self._executor.shutdown()
+        self._executor = None
+
+        log.info('Remote cache: %i hits, %i misses, %i uploads', self.hits, self.misses, self.uploads)
+
+
+class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+    server_version = 'rmbuild-cache/1'
+
+    def log_message(self, format, *args):
+        log.debug('%s %s', self.address_string(), format % args)
+
+    def _name(self):
+        name = urllib.parse.unquote(urllib.parse.urlparse(self.path).path).lstrip('/')
+
+        try:
+            return check_name(name)
+        except ValueError:
+            self.send_error(400, 'Not a cache entry name')
+            return None
+
+    def _send(self, head_only):
+        name = self._name()
+
+        if name is None:
+            return
+
+        try:
+            f = self.server.store.path_of(name).open('rb')
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            digest = file_digest(f)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-tar')
+            self.send_header('Content-Length', str(size))
+            self.send_header('Digest', digest)
+            self.end_headers()
+
+            if not head_only:
+                shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+
+    def do_GET(self):
+        self._send(False)
+
+    def do_HEAD(self):
+        self._send(True)
+
+    def do_PUT(self):
+        if self.server.read_only:
+            self.send_error(403, 'Read-only cache')
+            return
+
+        name = self._name()
+
+        if name is None:
+            return
+
+        length = self.headers.get('Content-Length')
+
+        if length is None:
+            self.send_error(411)
+            return
+
+        size = int(length)
+
+        if size > MAX_BLOB_SIZE:
+            self.send_error(413)
+            return
+
+        try:
+            self.server.store.put(name, self.rfile, size, parse_digest(self.headers.get('Digest')))
+        except BlobError as e:
+            self.send_error(400, str(e))
+            return
+
+        log.info('Stored %r (%s)', name, util.format_size(size))
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class CacheServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # The reference remote cache server: serves the blobs in a directory to
+    # HTTPBackend. There is no authentication, so only expose it to networks
+    # you trust, or put it behind a proxy that handles that.
+    daemon_threads = True
+
+    def __init__(self, path, address=('localhost', DEFAULT_PORT), read_only=False):
+        self.store = DirectoryBackend(util.make_directory(path))
+        self.read_only = read_only
+        super().__init__(address, CacheRequestHandler)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self.store.path))
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%i/' % (host if host not in ('', '0.0.0.0') else 'localhost', port)
@@ -0,0 +1,102 @@
+import contextlib
+import logging
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .compat import *
+
+# util uses this module, so don't import it here
+log = logging.getLogger(__name__)
+
+FORMAT = 1
+
+_report = None
+
+
+def cpu_times():
+    # (own, children) CPU seconds of the whole process
+    if resource is None:
+        return time.process_time(), 0.0
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+
+class Report(object):
+    # Numbers collected over the course of a build, see BuildInfo.write_report()
+
+    def __init__(self):
+        self.counters = {}
+        self.stages = {}
+        self.packages = {}
+        self.qcc = {}
+        self.start = time.time()
+        self.start_cpu = cpu_times()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s(%i stages)' % (self.__class__.__name__, len(self.stages))
+
+    def count(self, key, amount=1):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # cpu is the time spent in this thread only; child processes and the
+        # process pools are accounted for in the totals
+        start = time.time()
+        start_cpu = time.thread_time()
+
+        try:
+            yield
+        finally:
+            wall = time.time() - start
+            cpu = time.thread_time() - start_cpu
+
+            with self._lock:
+                stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'runs': 0})
+                stage['wall'] += wall
+                stage['cpu'] += cpu
+                stage['runs'] += 1
+
+    def add_package(self, name, **info):
+        with self._lock:
+            self.packages[name] = info
+
+    def add_qcc(self, name, **info):
+        with self._lock:
+            self.qcc[name] = info
+
+    def totals(self):
+        own, children = cpu_times()
+
+        return {
+            'wall': time.time() - self.start,
+            'cpu': own - self.start_cpu[0],
+            'cpu_children': children - self.start_cpu[1],
+        }
+
+
+def start():
+    global _report
+    _report = Report()
+    return _report
+
+
+def stop():
+    global _report
+    current, _report = _report, None
+    return current
+
+
+def count(key, amount=1):
+    # adds to a counter of the running build's report, if there is one
+    if _report is not None:
+        _report.count(key, amount)
@@ -0,0 +1,348 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+from concurrent import futures
+
+from .compat import *
+
+from . import util
+from . import errors
+from . import trace
+
+log = util.logger(__name__)
+
+HISTORY_FILENAME = 'tasktimes.json'
+HISTORY_FORMAT = 1
+
+# Assumed duration of tasks that have never run before, in seconds
+DEFAULT_DURATION = 1.0
+
+# Weight of the latest run in the recorded durations
+HISTORY_WEIGHT = 0.5
+
+
+class Task(object):
+    def __init__(self, name, func, kind, after):
+        self.name = name
+        self.func = func
+        self.kind = kind
+        self.after = after
+        self.waiting = 0
+        self.queued = None
+        self.finished = False
+        self.failed = False
+        self.dependents = []
+        self.future = futures.Future()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.name)
+
+    def cancel(self):
+        # Returns whether the task was cancelled just now. Like the executors
+        # do, notify right away, so that futures.wait() sees it as done.
+        if self.future.cancelled() or not self.future.cancel():
+            return False
+
+        self.future.set_running_or_notify_cancel()
+        return True
+
+
+class CancelToken(object):
+    # Set once the build has failed. Work that takes a while either checks it
+    # regularly, or registers a callback that interrupts it right away.
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s(cancelled=%r)' % (self.__class__.__name__, self.cancelled)
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+
+            self._event.set()
+            callbacks = list(self._callbacks)
+
+        log.debug("Cancelling the build")
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                log.exception("Cancellation callback %r failed", callback)
+
+    def check(self):
+        if self._event.is_set():
+            raise errors.BuildStepAborted
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    @contextlib.contextmanager
+    def on_cancel(self, callback):
+        # callback() is called when the build is cancelled while in this block,
+        # or right away if it already was
+        with self._lock:
+            cancelled = self._event.is_set()
+
+            if not cancelled:
+                self._callbacks.append(callback)
+
+        if cancelled:
+            callback()
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                if callback in self._callbacks:
+                    self._callbacks.remove(callback)
+
+
+class History(object):
+    # How long each task took on previous builds, as a moving average
+
+    def __init__(self, path=None):
+        self.path = path
+        self.durations = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+        if path is not None:
+            self.load()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self.path) if self.path else None)
+
+    def load(self):
+        try:
+            with open(str(self.path)) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            log.warning('Task history %r is corrupted, starting over', str(self.path))
+            return
+
+        if data.get('format') == HISTORY_FORMAT:
+            self.durations = data['durations']
+
+    def save(self):
+        if self.path is None or not self._dirty:
+            return
+
+        with self._lock:
+            data = json.dumps({
+                'format': HISTORY_FORMAT,
+                'durations': self.durations,
+            }, indent=4, sort_keys=True)
+            self._dirty = False
+
+        tmp = self.path.with_name('%s.%i.tmp' % (self.path.name, os.getpid()))
+
+        with open(str(tmp), 'w') as f:
+            f.write(data)
+
+        tmp.replace(self.path)
+
+    def estimate(self, name):
+        return self.durations.get(name, DEFAULT_DURATION)
+
+    def record(self, name, seconds):
+        with self._lock:
+            if name in self.durations:
+                seconds = self.durations[name] * (1 - HISTORY_WEIGHT) + seconds * HISTORY_WEIGHT
+
+            self.durations[name] = seconds
+            self._dirty = True
+
+
+class Scheduler(object):
+    # Runs tasks on a thread pool once everything they depend on has finished,
+    # so no worker thread is ever spent waiting for another task.
+    #
+    # Tasks are named with dotted paths; a dependency on 'qc' means every task
+    # named 'qc' or 'qc.<something>' that has been added so far, which may be
+    # none at all. Dependencies must be added before their dependents. If a
+    # task fails, everything that depends on it is cancelled.
+    #
+    # When there are more runnable tasks than free threads, the one heading
+    # the longest chain of remaining work goes first. The chain lengths are
+    # estimated from the durations recorded in the history on earlier builds.
+    #
+    # Every task has a kind, and limits caps how many tasks of each kind may
+    # run at once; workers caps the total.
+
+    def __init__(self, workers, limits=None, on_failure=None, history=None):
+        if history is None:
+            history = History()
+
+        self.workers = workers
+        self.limits = dict(limits or {})
+        self.on_failure = on_failure
+        self.history = history
+        self.tasks = {}
+        self.all = []
+        self.ready = []
+        self.running = 0
+        self.running_kind = {}
+        self._lock = threading.Lock()
+        self._executor = futures.ThreadPoolExecutor(workers)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.workers)
+
+    def resolve(self, names):
+        deps = []
+
+        for name in names:
+            for task in self.tasks.get(name, ()):
+                if task not in deps:
+                    deps.append(task)
+
+        return deps
+
+    def add(self, name, func, kind, after=()):
+        log.debug("Added %s task for %s (after %s)", kind, name, ', '.join(after) or 'nothing')
+
+        task = Task(name, func, kind, self.resolve(after))
+        subs = name.split('.')
+
+        with self._lock:
+            self.all.append(task)
+
+            for i in range(1, len(subs) + 1):
+                self.tasks.setdefault('.'.join(subs[:i]), []).append(task)
+
+            for dep in task.after:
+                if dep.failed or dep.future.cancelled():
+                    task.cancel()
+                    break
+
+                if not dep.finished:
+                    task.waiting += 1
+                    dep.dependents.append(task)
+
+            if not task.waiting and not task.future.cancelled():
+                task.queued = time.time()
+                self.ready.append(task)
+
+        self._dispatch()
+        return task.future
+
+    def priorities(self):
+        # Estimated time from the start of each task until everything that
+        # depends on it is done. Dependents are always added after the tasks
+        # they depend on, so going backwards visits them first.
+        prio = {}
+
+        for task in reversed(self.all):
+            prio[task] = self.history.estimate(task.name) + max([prio[d] for d in task.dependents] or [0])
+
+        return prio
+
+    def _can_run(self, task):
+        limit = self.limits.get(task.kind)
+        return limit is None or self.running_kind.get(task.kind, 0) < limit
+
+    def _dispatch(self):
+        with self._lock:
+            if len(self.ready) > 1 and self.running < self.workers:
+                prio = self.priorities()
+                self.ready.sort(key=lambda task: -prio[task])
+
+            for task in list(self.ready):
+                if self.running >= self.workers:
+                    break
+
+                if task.future.cancelled():
+                    self.ready.remove(task)
+                    continue
+
+                if not self._can_run(task):
+                    continue
+
+                self.ready.remove(task)
+                task.future.set_running_or_notify_cancel()
+
+                self.running += 1
+                self.running_kind[task.kind] = self.running_kind.get(task.kind, 0) + 1
+                self._executor.submit(self._run, task)
+
+    def _run(self, task):
+        start = time.time()
+
+        try:
+            # queued is how long the task was ready to run but had to wait for a thread
+            with trace.span(task.name, 'task', kind=task.kind, queued=start - task.queued):
+                result = task.func()
+        except BaseException as e:
+            self._finish(task, None, e)
+        else:
+            seconds = time.time() - start
+            log.debug("Finished task for %s in %.3fs", task.name, seconds)
+            self.history.record(task.name, seconds)
+            self._finish(task, result, None)
+
+    def _finish(self, task, result, exception):
+        if exception is not None and self.on_failure is not None:
+            self.on_failure(task, exception)
+
+        with self._lock:
+            self.running -= 1
+            self.running_kind[task.kind] -= 1
+            task.finished = True
+            task.failed = exception is not None
+
+            if exception is None:
+                for dep in task.dependents:
+                    dep.waiting -= 1
+
+                    if not dep.waiting and not dep.future.cancelled():
+                        dep.queued = time.time()
+                        self.ready.append(dep)
+            else:
+                stack = list(task.dependents)
+
+                while stack:
+                    dep = stack.pop()
+
+                    if dep.cancel():
+                        log.debug("Cancelled task for %s because %s failed", dep.name, task.name)
+                        stack.extend(dep.dependents)
+
+        if exception is None:
+            task.future.set_result(result)
+        else:
+            task.future.set_exception(exception)
+
+        self._dispatch()
+
+    def wait(self, *names):
+        # Must not be called from a task for anything it doesn't depend on,
+        # or the pool may run out of threads.
+        for name in names:
+            log.debug("Waiting for %s", name)
+            for task in self.tasks.get(name, ()):
+                task.future.result()
+            log.debug("Done waiting for %s", name)
+
+    def cancel(self):
+        # tasks that are already running are left alone
+        with self._lock:
+            for task in self.all:
+                task.cancel()
+
+    def shutdown(self):
+        self._executor.shutdown()
@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from .compat import *
+
+# util uses this module, so don't import it here
+log = logging.getLogger(__name__)
+
+_tracer = None
+
+
+class Span(object):
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.thread = threading.current_thread()
+        self.start = None
+        self.end = None
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self.name, self.category)
+
+    def __enter__(self):
+        self.tracer._push(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.end = time.time()
+
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+
+        self.tracer._pop(self)
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def add(self, key, amount):
+        self.args[key] = self.args.get(key, 0) + amount
+
+
+class NullSpan(object):
+    # what span() returns when tracing is off
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+    def set(self, **args):
+        pass
+
+    def add(self, key, amount):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+    def __init__(self):
+        self.spans = []
+        self.pid = os.getpid()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s(%i spans)' % (self.__class__.__name__, len(self.spans))
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _push(self, span):
+        self._stack().append(span)
+
+    def _pop(self, span):
+        self._stack().remove(span)
+
+        with self._lock:
+            self.spans.append(span)
+
+    def current(self):
+        stack = self._stack()
+
+        if stack:
+            return stack[-1]
+
+        return NULL_SPAN
+
+    def span(self, name, category, **args):
+        return Span(self, name, category, args)
+
+    def chrome_events(self):
+        # Complete ('X') events in microseconds, plus thread names as metadata
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+
+        tids = {}
+        events = []
+
+        for span in spans:
+            if span.thread not in tids:
+                tids[span.thread] = len(tids) + 1
+                events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': self.pid,
+                    'tid': tids[span.thread],
+                    'args': {'name': span.thread.name},
+                })
+
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': int(span.start * 1000000),
+                'dur': int(span.duration * 1000000),
+                'pid': self.pid,
+                'tid': tids[span.thread],
+                'args': span.args,
+            })
+
+        return events
+
+    def export_chrome(self, path):
+        log.info("Writing a trace of %i spans to %r", len(self.spans), str(path))
+
+        with open(str(path), 'w') as f:
+            json.dump({
+                'traceEvents': self.chrome_events(),
+                'displayTimeUnit': 'ms',
+            }, f)
+
+
+def start():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(name, category, **args):
+    # Use as a context manager. Costs next to nothing unless tracing was started.
+    if _tracer is None:
+        return NULL_SPAN
+
+    return _tracer.span(name, category, **args)
+
+
+def current():
+    # the innermost span open in this thread
+    if _tracer is None:
+        return NULL_SPAN
+
+    return _tracer.current()
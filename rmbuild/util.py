@@ -6,12 +6,22 @@ import hashlib
 import subprocess
 import logging
 import os
+import re
 import atexit
 import shutil
+import threading
+import multiprocessing
+import collections
+import functools
+
+from concurrent import futures
 # import distutils.dir_util
 
 from .compat import *
 from .errors import *
+from . import trace
+from . import report
+from . import materialize
 
 _temp_dirs = []
 
@@ -20,8 +30,12 @@ log = logging.getLogger(__name__)
 QC_INSTALL_FILEEXT = ('.dat', '.lno')
 GIT_EXECUTABLE = 'git'
 HASH_FUNCTION = 'sha1'
+HASH_METHOD = 'legacy'
 HASH_PKG_APPEND_BYTES = b'honk'
 
+# Seconds to give a terminated subprocess before killing it
+KILL_TIMEOUT = 5
+
 
 def hash_constructor():
     return hashlib.new(HASH_FUNCTION)
@@ -131,7 +145,9 @@ def logger(*name):
     return logging.getLogger('.'.join(name))
 
 
-def logged_subprocess(popenargs, logger, log_level=logging.INFO, **kwargs):
+def logged_subprocess(popenargs, logger, log_level=logging.INFO, cancel=None, **kwargs):
+    # If a CancelToken is given, the child is terminated as soon as the build
+    # is cancelled, and killed if it's still around after KILL_TIMEOUT seconds.
     logger.debug("Invoking subprocess: %r", popenargs)
 
     if 'cwd' in kwargs:
@@ -146,29 +162,202 @@ def logged_subprocess(popenargs, logger, log_level=logging.INFO, **kwargs):
         **kwargs
     )
 
-    for line in iter(child.stdout.readline, ''):
-        line = line.strip()
-        if line:
-            logger.log(log_level, "[%s] %s" % (popenargs[0], line))
+    killer = threading.Timer(KILL_TIMEOUT, child.kill)
+    killer.daemon = True
+
+    def terminate():
+        logger.info("Terminating %r", popenargs[0])
+        child.terminate()
+        killer.start()
+
+    with contextlib.ExitStack() as stack:
+        if cancel is not None:
+            stack.enter_context(cancel.on_cancel(terminate))
+
+        for line in iter(child.stdout.readline, ''):
+            line = line.strip()
+            if line:
+                logger.log(log_level, "[%s] %s" % (popenargs[0], line))
+
+        code = child.wait()
+
+    killer.cancel()
 
-    code = child.wait()
     if code:
+        if cancel is not None and cancel.cancelled:
+            raise BuildStepAborted
+
         raise subprocess.CalledProcessError(code, popenargs[0])
 
 
-def copy_tree(src, dst):
+class ProcessPool(object):
+    # A process pool that only starts once something is submitted to it, so
+    # that builds that don't need it (e.g. fully cached ones) don't pay for it.
+    #
+    # The workers come from a fork server where there is one, and are spawned
+    # otherwise. Forking the build itself isn't safe, since it runs threads by
+    # the time anything is submitted. The fork server imports the preload
+    # modules once, so the workers don't have to. As with spawn, scripts that
+    # call rmbuild.main.main() need an "if __name__ == '__main__'" guard.
+
+    def __init__(self, processes, preload=()):
+        self.processes = processes
+        self.preload = list(preload)
+        self._executor = None
+        self._shut_down = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s(%i)' % (self.__class__.__name__, self.processes)
+
+    def _start(self):
+        try:
+            context = multiprocessing.get_context('forkserver')
+        except ValueError:
+            context = multiprocessing.get_context('spawn')
+        else:
+            context.set_forkserver_preload(self.preload)
+
+        log.debug('Starting %i worker processes (%s)', self.processes, context.get_start_method())
+        return futures.ProcessPoolExecutor(self.processes, mp_context=context)
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._shut_down:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+
+            if self._executor is None:
+                self._executor = self._start()
+
+            executor = self._executor
+
+        return executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._shut_down = True
+
+        if executor is not None:
+            executor.shutdown(wait)
+
+
+class LimitedPool(object):
+    # Runs at most 'jobs' of the calls submitted through it on the given pool
+    # at a time and queues the rest, so that everything sharing one pool stays
+    # within its own budget. submit() never blocks.
+
+    def __init__(self, pool, jobs):
+        self.pool = pool
+        self.jobs = jobs
+        self.running = 0
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s(%r, %i)' % (self.__class__.__name__, self.pool, self.jobs)
+
+    def submit(self, fn, *args, **kwargs):
+        future = futures.Future()
+
+        with self._lock:
+            self._queue.append((future, fn, args, kwargs))
+
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                if self.running >= self.jobs or not self._queue:
+                    return
+
+                future, fn, args, kwargs = self._queue.popleft()
+
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                self.running += 1
+
+            try:
+                inner = self.pool.submit(fn, *args, **kwargs)
+            except BaseException as e:
+                with self._lock:
+                    self.running -= 1
+
+                future.set_exception(e)
+                continue
+
+            inner.add_done_callback(functools.partial(self._done, future))
+
+    def _done(self, future, inner):
+        with self._lock:
+            self.running -= 1
+
+        if inner.cancelled():
+            future.set_exception(futures.CancelledError())
+        elif inner.exception() is not None:
+            future.set_exception(inner.exception())
+        else:
+            future.set_result(inner.result())
+
+        self._dispatch()
+
+
+def available_memory():
+    # in bytes, or None if it can't be determined
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def default_jobs(memory_per_job=None, per_cpu=1):
+    # per_cpu jobs per core, but no more than the available memory allows
+    jobs = multiprocessing.cpu_count() * per_cpu
+
+    if memory_per_job is not None:
+        memory = available_memory()
+
+        if memory is not None:
+            jobs = min(jobs, memory // memory_per_job)
+
+    return max(1, int(jobs))
+
+
+def copy_tree(src, dst, snapshot=None, hardlink=False):
     log.debug('copy_tree(): %r ---> %r', str(src), str(dst))
 
     # return distutils.dir_util.copy_tree(str(src), str(dst))
 
     from . import install
-    index = install.build_index(src)
-    install.copy_by_index(index, src, dst)
+
+    with trace.span('copy %s' % src, 'io', dst=str(dst)):
+        index = install.build_index(src, snapshot)
+        install.copy_by_index(index, src, dst, hardlink=hardlink)
 
 
-def copy(src, dst):
+def copy(src, dst, hardlink=False, preserve_times=False):
+    # Reflinks, hard links (only if allowed) or copies, see materialize.py
     log.debug('copy(): %r ---> %r', str(src), str(dst))
-    shutil.copy(str(src), str(dst))
+    dst = pathlib.Path(dst)
+
+    if dst.is_dir():
+        dst = dst / pathlib.Path(src).name
+
+    method = materialize.materialize(src, dst, hardlink=hardlink, preserve_times=preserve_times)
+    size = os.path.getsize(str(dst))
+    report.count('materialize.%s' % method)
+    report.count('bytes_linked' if method in materialize.LINKS else 'bytes_copied', size)
+    return method
 
 
 def clear_directory(path):
@@ -195,6 +384,29 @@ def suppress_logged(log, *ex):
         log.exception("Suppressed exception")
 
 
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+
+    return '%.1f TiB' % size
+
+
+def parse_size(size):
+    # '512M', '10G', '1.5T' or a plain number of bytes
+    if isinstance(size, (int, float)):
+        return int(size)
+
+    units = {'': 0, 'K': 10, 'M': 20, 'G': 30, 'T': 40}
+    match = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)(?:i?B)?\s*$', size, re.IGNORECASE)
+
+    if not match:
+        raise ValueError('Invalid size %r, expected something like 500M or 10G' % size)
+
+    return int(float(match.group(1)) * (1 << units[match.group(2).upper()]))
+
+
 def path(*p):
     return pathlib.Path(p[0]).joinpath(*p[1:])
 
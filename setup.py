@@ -10,6 +10,7 @@ setup(
     author='Andrew "Akari" Alexeyew',
     author_email='akari@alienslab.net',
     license='WTFPL',
-    packages=['rmbuild'],
-    install_requires=['pillow', 'pathlib']
+    packages=['rmbuild', 'rmbuild.bench'],
+    install_requires=['pillow', 'pathlib'],
+    extras_require={'numpy': ['numpy']}
 )
@@ -0,0 +1,131 @@
+import os
+import pathlib
+import random
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from rmbuild import archive
+from rmbuild import util
+
+
+class Pk3WriterTest(unittest.TestCase):
+    # Pk3Writer writes members through zipfile internals, so check that what
+    # it writes reads back intact with the zipfile module of this Python.
+
+    def setUp(self):
+        self.dir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.dir))
+        self.src = self.dir / 'src'
+        self.src.mkdir()
+        rand = random.Random(1)
+
+        self.files = {
+            'maps/readme.txt': b'hello world\n' * 1000,
+            'gfx/noise.tga': bytes(rand.getrandbits(8) for i in range(64 << 10)),
+            'gfx/photo.jpg': bytes(rand.getrandbits(8) for i in range(16 << 10)),
+            'sound/été/音.ogg': b'OggS' + b'\x01' * 5000,
+            # big enough to be passed back from the workers through a file
+            'models/big.md3': b'IDP3' + b'\x00\x01\x02\x03' * (archive.SPILL_SIZE // 2),
+            'empty.cfg': b'',
+        }
+
+        for name, data in self.files.items():
+            path = self.src / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+
+    def write(self, path, pool=None, previous=None, policy=None):
+        pk3 = archive.Pk3Writer(path, pool=pool, policy=policy, spill_dir=self.dir, previous=previous)
+
+        for name in sorted(self.files):
+            pk3.write(self.src / name, name)
+
+        info = zipfile.ZipInfo('textures/link.tga')
+        info.external_attr |= 0o0120000 << 16
+        info.create_system = 3
+        pk3.writestr(info, '../gfx/noise.tga')
+
+        pk3.writestr(zipfile.ZipInfo('über.txt'), 'written as a string')
+        pk3.close()
+        return pk3
+
+    def check(self, path):
+        with zipfile.ZipFile(str(path)) as z:
+            self.assertIsNone(z.testzip())
+            names = z.namelist()
+
+            for name, data in self.files.items():
+                self.assertEqual(z.read(name), data, name)
+
+            link = z.getinfo('textures/link.tga')
+            self.assertEqual(link.external_attr >> 16 & 0o170000, 0o120000)
+            self.assertEqual(z.read(link), b'../gfx/noise.tga')
+            self.assertEqual(z.read('über.txt'), b'written as a string')
+
+            # in the order the members were added
+            self.assertEqual(names, sorted(self.files) + ['textures/link.tga', 'über.txt'])
+            return {i.filename: i for i in z.infolist()}
+
+    def test_compression_policy(self):
+        path = self.dir / 'a.pk3'
+        self.write(path)
+        infos = self.check(path)
+
+        self.assertEqual(infos['gfx/photo.jpg'].compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(infos['sound/été/音.ogg'].compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(infos['maps/readme.txt'].compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(infos['models/big.md3'].compress_type, zipfile.ZIP_DEFLATED)
+        # 'auto' stores what doesn't compress
+        self.assertEqual(infos['gfx/noise.tga'].compress_type, zipfile.ZIP_STORED)
+
+    def test_deflate_everything(self):
+        path = self.dir / 'a.pk3'
+        self.write(path, policy=archive.CompressionPolicy([('*', 9)]))
+        infos = self.check(path)
+
+        for name in self.files:
+            self.assertEqual(infos[name].compress_type, zipfile.ZIP_DEFLATED, name)
+
+    def test_process_pool(self):
+        pool = util.ProcessPool(2, preload=('rmbuild.archive',))
+        self.addCleanup(pool.shutdown)
+
+        path = self.dir / 'a.pk3'
+        self.write(path, pool=pool)
+        self.check(path)
+
+    def test_reuse_previous(self):
+        first = self.dir / 'first.pk3'
+        self.write(first)
+
+        changed = self.src / 'maps/readme.txt'
+        self.files['maps/readme.txt'] = b'changed\n' * 1000
+        changed.write_bytes(self.files['maps/readme.txt'])
+        os.utime(str(changed), (0, 946684800))
+
+        second = self.dir / 'second.pk3'
+        pk3 = self.write(second, previous=first)
+        self.check(second)
+
+        # every file member but the changed one; strings are always written anew
+        self.assertEqual(pk3.reused, len(self.files) - 1)
+
+    def test_abort_removes_archive(self):
+        path = self.dir / 'a.pk3'
+
+        def abort():
+            raise RuntimeError('aborted')
+
+        pk3 = archive.Pk3Writer(path, spill_dir=self.dir, abort=abort)
+        pk3.write(self.src / 'maps/readme.txt', 'maps/readme.txt')
+
+        with self.assertRaises(RuntimeError):
+            pk3.close()
+
+        self.assertFalse(path.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from rmbuild import hashing
+from rmbuild import qcmodule
+
+
+class CompilerDigestTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.dir))
+
+    def test_not_found(self):
+        with mock.patch.dict(os.environ, {'PATH': str(self.dir)}):
+            with self.assertLogs(qcmodule.log, 'DEBUG'):
+                digest = qcmodule.compiler_digest('no-such-qcc')
+
+        self.assertEqual(digest, 'name:no-such-qcc')
+
+    def test_found(self):
+        qcc = self.dir / 'fakeqcc'
+        qcc.write_bytes(b'#!/bin/sh\n')
+        qcc.chmod(0o755)
+
+        with mock.patch.dict(os.environ, {'PATH': str(self.dir)}):
+            digest = qcmodule.compiler_digest('fakeqcc')
+
+        self.assertEqual(digest, hashing.file_digest(qcc))
+
+        # a different compiler binary means different cache keys
+        qcc.write_bytes(b'#!/bin/sh\nexit 0\n')
+
+        with mock.patch.dict(os.environ, {'PATH': str(self.dir)}):
+            self.assertNotEqual(qcmodule.compiler_digest('fakeqcc'), digest)
+
+
+class CacheKeyFlagsTest(unittest.TestCase):
+    def test_defines(self):
+        flags = ['-O3', '-DB=1', '-DRM_BUILD_DATE="today"', '-DA', '-Wall']
+
+        self.assertEqual(
+            qcmodule.cache_key_flags(flags),
+            ['-O3', '-Wall', '-DA', '-DB=1', '-DRM_BUILD_DATE'],
+        )
+
+        self.assertEqual(
+            qcmodule.cache_key_flags(['-DRM_BUILD_DATE="tomorrow"', '-DA', '-O3', '-DB=1', '-Wall']),
+            qcmodule.cache_key_flags(flags),
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import pathlib
+import shutil
+import tempfile
+import unittest
+
+from rmbuild import remote
+
+
+class RemoteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.dir))
+        self.remote = remote.RemoteCache(remote.DirectoryBackend(str(self.dir / 'remote')))
+        self.addCleanup(self.remote.close)
+
+    def entry(self, name, data):
+        path = self.dir / 'local' / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        return path
+
+    def test_round_trip(self):
+        src = self.entry('pkg/zzz-rm-a-0123.pk3', b'PK\x05\x06' + b'\0' * 18)
+        self.remote.store('pkg', 'pkg/zzz-rm-a-0123.pk3', src)
+        self.remote.close()
+
+        dst = self.dir / 'restored' / 'zzz-rm-a-0123.pk3'
+        dst.parent.mkdir()
+
+        self.assertTrue(self.remote.fetch('pkg', 'pkg/zzz-rm-a-0123.pk3', dst))
+        self.assertEqual(dst.read_bytes(), src.read_bytes())
+        self.assertEqual((self.remote.uploads, self.remote.hits), (1, 1))
+
+    def test_unusual_name(self):
+        # skipped, rather than failing the build when the uploads are collected
+        name = 'pkg/zzz-rm-été 2-0123.pk3'
+        src = self.entry(name, b'data')
+
+        self.remote.store('pkg', name, src)
+        self.remote.close()
+
+        self.assertEqual(self.remote.uploads, 0)
+        self.assertFalse(self.remote.fetch('pkg', name, self.dir / 'restored.pk3'))
+        self.assertFalse(self.remote.disabled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import threading
+import time
+import unittest
+
+from concurrent import futures
+
+from rmbuild import errors
+from rmbuild import scheduler
+
+TIMEOUT = 10
+
+
+class SchedulerTest(unittest.TestCase):
+    def scheduler(self, workers=4, **kwargs):
+        s = scheduler.Scheduler(workers, **kwargs)
+        self.addCleanup(s.shutdown)
+        return s
+
+    def wait(self, s):
+        done, not_done = futures.wait([task.future for task in s.all], timeout=TIMEOUT)
+        self.assertFalse(not_done)
+
+    def test_dependency_order(self):
+        s = self.scheduler()
+        order = []
+        lock = threading.Lock()
+
+        def task(name, delay=0):
+            def run():
+                time.sleep(delay)
+
+                with lock:
+                    order.append(name)
+
+                return name
+            return run
+
+        s.add('hash.qc.menu', task('hash.qc.menu', 0.1), 'io')
+        s.add('hash.qc.client', task('hash.qc.client'), 'io', after=['hash.qc.menu'])
+        s.add('hash.pkg.a', task('hash.pkg.a', 0.05), 'io')
+
+        # a dotted prefix means every task under it that was added so far
+        final = s.add('configure', task('configure'), 'io', after=['hash'])
+        self.wait(s)
+
+        self.assertEqual(final.result(), 'configure')
+        self.assertEqual(order[-1], 'configure')
+        self.assertLess(order.index('hash.qc.menu'), order.index('hash.qc.client'))
+
+    def test_unknown_dependency(self):
+        s = self.scheduler()
+        future = s.add('a', lambda: 1, 'io', after=['nothing.here'])
+        self.assertEqual(future.result(TIMEOUT), 1)
+
+    def test_failure_cancels_dependents(self):
+        failures = []
+        s = self.scheduler(on_failure=lambda task, e: failures.append(task.name))
+        ran = []
+
+        def fail():
+            raise ValueError('broken')
+
+        s.add('pkg.a', fail, 'zip')
+        child = s.add('install.a', lambda: ran.append('install.a'), 'io', after=['pkg.a'])
+        grandchild = s.add('srvpkg', lambda: ran.append('srvpkg'), 'io', after=['install'])
+        unrelated = s.add('pkg.b', lambda: ran.append('pkg.b'), 'zip')
+        self.wait(s)
+
+        self.assertIsInstance(s.tasks['pkg.a'][0].future.exception(), ValueError)
+        self.assertTrue(child.cancelled())
+        self.assertTrue(grandchild.cancelled())
+        self.assertEqual(unrelated.result(), None)
+        self.assertEqual(ran, ['pkg.b'])
+        self.assertEqual(failures, ['pkg.a'])
+
+        # added after the failure, so cancelled right away
+        late = s.add('late', lambda: ran.append('late'), 'io', after=['pkg.a'])
+        self.assertTrue(late.cancelled())
+
+    def test_limits(self):
+        s = self.scheduler(workers=6, limits={'qcc': 2, 'zip': 1})
+        lock = threading.Lock()
+        running = {}
+        peak = {}
+
+        def task(kind):
+            def run():
+                with lock:
+                    running[kind] = running.get(kind, 0) + 1
+                    peak[kind] = max(peak.get(kind, 0), running[kind])
+
+                time.sleep(0.05)
+
+                with lock:
+                    running[kind] -= 1
+            return run
+
+        for i in range(5):
+            s.add('qcc.%i' % i, task('qcc'), 'qcc')
+            s.add('zip.%i' % i, task('zip'), 'zip')
+            s.add('io.%i' % i, task('io'), 'io')
+
+        self.wait(s)
+
+        self.assertEqual(peak['qcc'], 2)
+        self.assertEqual(peak['zip'], 1)
+        self.assertGreater(peak['io'], 1)
+
+    def test_workers_limit(self):
+        s = self.scheduler(workers=1)
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def run():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+        for i in range(4):
+            s.add('io.%i' % i, run, 'io')
+
+        self.wait(s)
+        self.assertEqual(running[1], 1)
+
+    def test_cancel(self):
+        s = self.scheduler(workers=1)
+        gate = threading.Event()
+        first = s.add('a', lambda: gate.wait(TIMEOUT), 'io')
+        second = s.add('b', lambda: None, 'io')
+
+        s.cancel()
+        gate.set()
+        self.wait(s)
+
+        # running tasks are left alone
+        self.assertTrue(first.result())
+        self.assertTrue(second.cancelled())
+
+
+class CancelTokenTest(unittest.TestCase):
+    def test_check(self):
+        token = scheduler.CancelToken()
+        token.check()
+        token.cancel()
+
+        with self.assertRaises(errors.BuildStepAborted):
+            token.check()
+
+    def test_on_cancel(self):
+        token = scheduler.CancelToken()
+        calls = []
+
+        with token.on_cancel(lambda: calls.append('inside')):
+            self.assertEqual(calls, [])
+            token.cancel()
+            self.assertEqual(calls, ['inside'])
+
+        # only once
+        token.cancel()
+        self.assertEqual(calls, ['inside'])
+
+    def test_on_cancel_after_block(self):
+        token = scheduler.CancelToken()
+        calls = []
+
+        with token.on_cancel(lambda: calls.append('gone')):
+            pass
+
+        token.cancel()
+        self.assertEqual(calls, [])
+
+    def test_on_cancel_already_cancelled(self):
+        token = scheduler.CancelToken()
+        token.cancel()
+        calls = []
+
+        with token.on_cancel(lambda: calls.append('now')):
+            self.assertEqual(calls, ['now'])
+
+        self.assertEqual(calls, ['now'])
+
+    def test_failing_callback(self):
+        token = scheduler.CancelToken()
+        calls = []
+
+        def broken():
+            raise RuntimeError('broken')
+
+        with token.on_cancel(broken), token.on_cancel(lambda: calls.append('still called')):
+            token.cancel()
+
+        self.assertTrue(token.cancelled)
+        self.assertEqual(calls, ['still called'])
+
+
+if __name__ == '__main__':
+    unittest.main()
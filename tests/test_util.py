@@ -0,0 +1,98 @@
+import operator
+import threading
+import time
+import unittest
+
+from concurrent import futures
+
+from rmbuild import util
+
+TIMEOUT = 10
+
+
+class LimitedPoolTest(unittest.TestCase):
+    def executor(self, workers):
+        executor = futures.ThreadPoolExecutor(workers)
+        self.addCleanup(executor.shutdown)
+        return executor
+
+    def test_limits(self):
+        # one shared pool, like deflating and image conversion in a build
+        shared = self.executor(6)
+        pools = {
+            'compress': util.LimitedPool(shared, 2),
+            'image': util.LimitedPool(shared, 1),
+        }
+
+        lock = threading.Lock()
+        running = {}
+        peak = {}
+
+        def task(kind):
+            with lock:
+                running[kind] = running.get(kind, 0) + 1
+                peak[kind] = max(peak.get(kind, 0), running[kind])
+
+            time.sleep(0.05)
+
+            with lock:
+                running[kind] -= 1
+
+            return kind
+
+        submitted = [pools[kind].submit(task, kind) for i in range(5) for kind in pools]
+        done, not_done = futures.wait(submitted, timeout=TIMEOUT)
+
+        self.assertFalse(not_done)
+        self.assertEqual([f.result() for f in submitted], ['compress', 'image'] * 5)
+        self.assertEqual(peak, {'compress': 2, 'image': 1})
+        self.assertEqual(pools['compress'].running, 0)
+
+    def test_exception(self):
+        pool = util.LimitedPool(self.executor(2), 1)
+
+        def fail():
+            raise ValueError('broken')
+
+        failed = pool.submit(fail)
+        after = pool.submit(operator.add, 1, 2)
+
+        with self.assertRaises(ValueError):
+            failed.result(TIMEOUT)
+
+        self.assertEqual(after.result(TIMEOUT), 3)
+
+    def test_cancel_queued(self):
+        pool = util.LimitedPool(self.executor(2), 1)
+        gate = threading.Event()
+
+        first = pool.submit(gate.wait, TIMEOUT)
+        second = pool.submit(operator.add, 1, 2)
+        third = pool.submit(operator.add, 3, 4)
+
+        self.assertTrue(second.cancel())
+        self.assertFalse(first.cancel())
+        gate.set()
+
+        self.assertTrue(first.result(TIMEOUT))
+        self.assertEqual(third.result(TIMEOUT), 7)
+        self.assertTrue(second.cancelled())
+
+    def test_process_pool(self):
+        processes = util.ProcessPool(2)
+        self.addCleanup(processes.shutdown)
+        pool = util.LimitedPool(processes, 1)
+
+        submitted = [pool.submit(operator.mul, i, i) for i in range(6)]
+        self.assertEqual([f.result(TIMEOUT) for f in submitted], [i * i for i in range(6)])
+
+    def test_shut_down(self):
+        processes = util.ProcessPool(1)
+        processes.shutdown()
+
+        with self.assertRaises(RuntimeError):
+            util.LimitedPool(processes, 1).submit(operator.add, 1, 2).result(TIMEOUT)
+
+
+if __name__ == '__main__':
+    unittest.main()